@@ -0,0 +1,81 @@
+"""Time PersistentObjectPool.gc on heaps of different sizes.
+
+Each heap is a root list of containers (alternately lists, dicts and sets)
+holding a few small objects, plus some cyclic garbage.  gc is run with one
+mark thread and with --threads threads, and the counts of the two are
+checked to be the same.  The pool files are created in --dir, which should
+be on the persistent memory (or a tmpfs) to time the mark phase rather than
+the disk.
+
+    python benchmarks/gc_mark.py --sizes 1000,10000,100000 --threads 4
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+from nvm import pmemobj
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def build_heap(pop, size):
+    with pop.transaction():
+        pop.root = pop.new(pmemobj.PersistentList)
+        for i in range(size):
+            kind = i % 3
+            if kind == 0:
+                obj = pop.new(pmemobj.PersistentList, [i, str(i), 2**70 + i])
+            elif kind == 1:
+                obj = pop.new(pmemobj.PersistentDict, {str(i): i, 'n': -i})
+            else:
+                obj = pop.new(pmemobj.PersistentSet, [str(i), i])
+            pop.root.append(obj)
+        for i in range(size // 100):
+            garbage = pop.new(pmemobj.PersistentList, [str(i)])
+            garbage.append(pop.new(pmemobj.PersistentDict, {'back': garbage}))
+
+
+def time_gc(fn, size, threads, pool_size):
+    if os.path.exists(fn):
+        os.remove(fn)
+    pop = pmemobj.create(fn, pool_size=pool_size)
+    try:
+        build_heap(pop, size)
+        start = _clock()
+        result = pop.gc(threads=threads)
+        return _clock() - start, result
+    finally:
+        pop.close()
+        os.remove(fn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma separated numbers of containers")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="mark threads to compare with one")
+    parser.add_argument('--dir', default='.',
+                        help="directory for the pool files")
+    parser.add_argument('--pool-size', type=int, default=1 << 30,
+                        help="size of each pool in bytes")
+    args = parser.parse_args()
+    fn = os.path.join(args.dir, 'gc_mark.pmem')
+    print('{:>10} {:>10} {:>10} {:>8}'.format(
+        'containers', '1 thread', '{} threads'.format(args.threads),
+        'speedup'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        one, one_result = time_gc(fn, size, 1, args.pool_size)
+        many, many_result = time_gc(fn, size, args.threads, args.pool_size)
+        if one_result != many_result:
+            raise AssertionError("gc results differ for {} containers:"
+                                 " {} != {}".format(size, one_result,
+                                                    many_result))
+        print('{:>10} {:>9.3f}s {:>9.3f}s {:>7.2f}x'.format(
+            size, one, many, one / many))
+
+
+if __name__ == '__main__':
+    main()
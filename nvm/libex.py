@@ -4,9 +4,13 @@ ffi = FFI()
 pmemobj_structs = """
     /* for pmemobj.py */
     typedef PMEMoid PObjPtr;
+    /* clean_shutdown is 1 while the pool is closed after a clean close,
+       and 0 while it is open or after a crash. */
     typedef struct {
         PObjPtr type_table;
         PObjPtr root_object;
+        size_t layout_revision;
+        size_t clean_shutdown;
         } PRoot;
     typedef struct {
         size_t ob_refcnt;
@@ -25,17 +29,239 @@ pmemobj_structs = """
         PObject ob_base;
         double fval;
         } PFloatObject;
+    /* ob_size is the length of ob_sval, which holds UTF-8 without a
+       terminating NUL.  ob_flags bit 0 is set if it is all ASCII. */
+    typedef struct {
+        PVarObject ob_base;
+        size_t ob_flags;
+        char ob_sval[];
+        } PStrObject;
+    typedef struct {
+        PVarObject ob_base;
+        char ob_sval[];
+        } PBytesObject;
+    /* Data is stored in chunks of chunk_size bytes, which are zero beyond
+       size.  chunks points to an array of nchunks chunk pointers. */
+    typedef struct {
+        PObject ob_base;
+        size_t size;
+        size_t chunk_size;
+        size_t nchunks;
+        PObjPtr chunks;
+        } PBlobObject;
+    /* ob_size is 0 when ival is the value.  Otherwise ival is the sign and
+       ob_digit holds ob_size bytes of magnitude, least significant first. */
+    typedef struct {
+        PVarObject ob_base;
+        int64_t ival;
+        unsigned char ob_digit[];
+        } PIntObject;
+    typedef struct {
+        size_t me_hash;
+        PObjPtr me_key;
+        PObjPtr me_value;
+        } PDictEntry;
+    typedef struct {
+        PObject ob_base;
+        size_t ma_used;
+        size_t ma_fill;
+        size_t ma_mask;
+        PObjPtr ma_table;
+        size_t ma_oldmask;
+        size_t ma_migrated;
+        PObjPtr ma_oldtable;
+        } PDictObject;
+    typedef struct {
+        size_t me_hash;
+        PObjPtr me_key;
+        } PSetEntry;
+    typedef struct {
+        PObject ob_base;
+        size_t ma_used;
+        size_t ma_fill;
+        size_t ma_mask;
+        PObjPtr ma_table;
+        size_t ma_oldmask;
+        size_t ma_migrated;
+        PObjPtr ma_oldtable;
+        } PSetObject;
+    /* A node of a PBTreeObject of order keys per node.  slots holds the
+       keys, in order, in its first order entries, then the node's other
+       pointers: for a leaf the value of each key, for an interior node
+       nkeys + 1 children, child i holding the keys from key i - 1 up to
+       (but not including) key i.  next links each leaf to the one after it.
+       */
+    typedef struct {
+        size_t nkeys;
+        size_t is_leaf;
+        PObjPtr next;
+        PObjPtr slots[];
+        } PBTreeNode;
+    typedef struct {
+        PObject ob_base;
+        size_t size;
+        size_t order;
+        PObjPtr root;
+        } PBTreeObject;
+
+    """
+
+helpers_source = """
+    /* for pmemobj.py */
+    /* Catalog the allocations of pop, starting at *cursor (the first one if
+       *cursor is OID_NULL), storing up to max of them in the arrays.  For
+       allocations of pobject_type_num, which are PObjects, ob_types and
+       refcnts get their ob_type and ob_refcnt; for others they get 0.
+       Set *cursor to the allocation after the last one stored (OID_NULL if
+       there are no more) and return the number stored. */
+    static size_t pynvm_obj_catalog(PMEMobjpool *pop, PMEMoid *cursor,
+                                    uint64_t pobject_type_num, PMEMoid *oids,
+                                    uint64_t *type_nums, size_t *ob_types,
+                                    size_t *refcnts, size_t max)
+    {
+        PMEMoid oid = cursor->off == 0 ? pmemobj_first(pop) : *cursor;
+        size_t n;
+        for (n = 0; n < max && oid.off != 0; n++) {
+            uint64_t type_num = pmemobj_type_num(oid);
+            oids[n] = oid;
+            type_nums[n] = type_num;
+            if (type_num == pobject_type_num) {
+                const PObject *obj = pmemobj_direct(oid);
+                ob_types[n] = obj->ob_type;
+                refcnts[n] = obj->ob_refcnt;
+            } else {
+                ob_types[n] = refcnts[n] = 0;
+            }
+            oid = pmemobj_next(oid);
+        }
+        *cursor = oid;
+        return n;
+    }
+
+    /* Layouts of the containers whose references pynvm_obj_refs reads.
+       A set's object and table entries start like a dict's. */
+    #define PYNVM_REFS_LIST 1
+    #define PYNVM_REFS_DICT 2
+    #define PYNVM_REFS_SET 3
+
+    /* Store up to max (at least 2) of the non-NULL references held by the
+       containers oids[*index] to oids[n - 1] in refs, starting at item or
+       table slot *slot of the first.  layouts gives each container's
+       layout.  Set *index and *slot to where to continue (*index is n when
+       all have been read) and return the number stored. */
+    static size_t pynvm_obj_refs(const PMEMoid *oids, const int *layouts,
+                                 size_t n, size_t *index, size_t *slot,
+                                 PMEMoid *refs, size_t max)
+    {
+        size_t count = 0;
+        for (; *index < n; (*index)++, *slot = 0) {
+            const void *body = pmemobj_direct(oids[*index]);
+            if (layouts[*index] == PYNVM_REFS_LIST) {
+                const PListObject *list = body;
+                const PObjPtr *items = pmemobj_direct(list->ob_items);
+                for (; *slot < list->ob_base.ob_size; (*slot)++) {
+                    if (count == max)
+                        return count;
+                    if (items[*slot].off != 0)
+                        refs[count++] = items[*slot];
+                }
+            } else {
+                const PDictObject *dict = body;
+                int values = layouts[*index] == PYNVM_REFS_DICT;
+                size_t size = values ? sizeof(PDictEntry) : sizeof(PSetEntry);
+                const char *old = pmemobj_direct(dict->ma_oldtable);
+                const char *table = pmemobj_direct(dict->ma_table);
+                size_t nold = old ? dict->ma_oldmask + 1 : 0;
+                size_t nslots = nold + (table ? dict->ma_mask + 1 : 0);
+                /* The old table's slots before ma_migrated have moved. */
+                if (*slot < dict->ma_migrated && *slot < nold)
+                    *slot = dict->ma_migrated;
+                for (; *slot < nslots; (*slot)++) {
+                    const PSetEntry *entry = (const PSetEntry *)(*slot < nold
+                        ? old + *slot * size : table + (*slot - nold) * size);
+                    /* EMPTY_HASH and DUMMY_HASH mark unused slots. */
+                    if (entry->me_hash <= 1)
+                        continue;
+                    if (count + 2 > max)
+                        return count;
+                    if (entry->me_key.off != 0)
+                        refs[count++] = entry->me_key;
+                    if (values && ((const PDictEntry *)entry)->me_value.off)
+                        refs[count++] = ((const PDictEntry *)entry)->me_value;
+                }
+            }
+        }
+        return count;
+    }
+
+    /* for pmemblk.py */
+    static int pynvm_blk_set_zero_range(PMEMblkpool *pbp, long long start,
+                                        long long count)
+    {
+        long long blockno;
+        for (blockno = start; blockno < start + count; blockno++)
+            if (pmemblk_set_zero(pbp, blockno) < 0)
+                return -1;
+        return 0;
+    }
+
+    /* Read blocks start..stop-1 into buf until one whose first size bytes
+       are not all zeros, and return its number; return stop if there is
+       none, -1 on error. */
+    static long long pynvm_blk_next_nonzero(PMEMblkpool *pbp, char *buf,
+                                            size_t size, long long start,
+                                            long long stop)
+    {
+        long long blockno;
+        for (blockno = start; blockno < stop; blockno++) {
+            if (pmemblk_read(pbp, buf, blockno) < 0)
+                return -1;
+            if (buf[0] != 0 || memcmp(buf, buf + 1, size - 1) != 0)
+                return blockno;
+        }
+        return stop;
+    }
 
+    /* Verify the trailing little-endian CRC32 of blocks start..stop-1,
+       storing the numbers of the blocks that don't match or are in the
+       error state in bad.  Return the number of bad blocks, -1 on error. */
+    static long long pynvm_blk_scrub(PMEMblkpool *pbp, char *buf,
+                                     long long start, long long stop,
+                                     long long *bad)
+    {
+        size_t bsize = pmemblk_bsize(pbp);
+        size_t psize = bsize - 4;
+        const unsigned char *crc = (const unsigned char *)buf + psize;
+        long long blockno, nbad = 0;
+        for (blockno = start; blockno < stop; blockno++) {
+            if (pmemblk_read(pbp, buf, blockno) < 0) {
+                if (errno != EIO)
+                    return -1;
+                bad[nbad++] = blockno;
+                continue;
+            }
+            if (buf[0] == 0 && memcmp(buf, buf + 1, bsize - 1) == 0)
+                continue;
+            if (crc32(0L, (const Bytef *)buf, psize) !=
+                    ((uLong)crc[0] | (uLong)crc[1] << 8 |
+                     (uLong)crc[2] << 16 | (uLong)crc[3] << 24))
+                bad[nbad++] = blockno;
+        }
+        return nbad;
+    }
     """
 
 ffi.set_source("_pmem",
                """
+                   #include <errno.h>
+                   #include <string.h>
+                   #include <zlib.h>
                    #include <libpmem.h>
                    #include <libpmemlog.h>
                    #include <libpmemblk.h>
                    #include <libpmemobj.h>
-               """ + pmemobj_structs,
-               libraries=['pmem', 'pmemlog', 'pmemblk', 'pmemobj'])
+               """ + pmemobj_structs + helpers_source,
+               libraries=['pmem', 'pmemlog', 'pmemblk', 'pmemobj', 'z'])
 
 ffi.cdef("""
     /* libpmem */
@@ -92,6 +318,12 @@ ffi.cdef("""
     const char *pmemblk_check_version(
         unsigned major_required,
         unsigned minor_required);
+    int pynvm_blk_set_zero_range(PMEMblkpool *pbp, long long start,
+        long long count);
+    long long pynvm_blk_next_nonzero(PMEMblkpool *pbp, char *buf,
+        size_t size, long long start, long long stop);
+    long long pynvm_blk_scrub(PMEMblkpool *pbp, char *buf,
+        long long start, long long stop, long long *bad);
 
     /* libpmemobj */
     typedef ... va_list;
@@ -137,6 +369,14 @@ ffi.cdef("""
     PMEMoid pmemobj_first(PMEMobjpool *pop);
     PMEMoid pmemobj_next(PMEMoid oid);
     uint64_t pmemobj_type_num(PMEMoid oid);
+    size_t pynvm_obj_catalog(PMEMobjpool *pop, PMEMoid *cursor,
+        uint64_t pobject_type_num, PMEMoid *oids, uint64_t *type_nums,
+        size_t *ob_types, size_t *refcnts, size_t max);
+    #define PYNVM_REFS_LIST ...
+    #define PYNVM_REFS_DICT ...
+    #define PYNVM_REFS_SET ...
+    size_t pynvm_obj_refs(const PMEMoid *oids, const int *layouts, size_t n,
+        size_t *index, size_t *slot, PMEMoid *refs, size_t max);
 
 """ + pmemobj_structs)
 
@@ -7,17 +7,61 @@
 
 .. seealso:: `NVML libpmemblk documentation <http://pmem.io/nvml/libpmemblk/libpmemblk.3.html>`_.
 """
+import collections
+import errno
+import itertools
+import multiprocessing
 import os
+import struct
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
 from _pmem import lib, ffi
 
+#: Number of trailing bytes of each block used by the checksumming mode.
+CHECKSUM_SIZE = 4
+
+_CRC = struct.Struct('<I')
+# Data of the last block of a checksummed pool, which records the mode.
+_CHECKSUM_MARKER = b'PYNVM-BLK-CSUM\0\0'
+# Number of blocks a scrub worker verifies per call into C.
+_SCRUB_CHUNK = 64 * 1024
+
+
+class ChecksumError(RuntimeError):
+    """This exception is raised when a block read from a checksummed
+    :class:`BlockPool` does not match its checksum. The number of the
+    block is available as the `block_num` attribute.
+    """
+    def __init__(self, block_num):
+        super(ChecksumError, self).__init__(
+            "Checksum mismatch in block {}".format(block_num))
+        self.block_num = block_num
+
 
 class BlockPool(object):
     """This class represents the Block Pool opened or created using
     :func:`~nvm.pmemblk.create()` or :func:`~nvm.pmemblk.open()`.
+
+    When checksum is True, the last :data:`CHECKSUM_SIZE` bytes of every
+    block hold a CRC32 of the rest of the block. It is written together with
+    the data (so it cannot be torn from it), and verified by every read. In
+    this mode `block_size` is the usable size of a block, :meth:`bsize`
+    still returns the size of the blocks in the pool. Blocks that were never
+    written or were zeroed read back as zeros and are always valid.
+
+    The mode is recorded in the pool by :func:`~nvm.pmemblk.create()`: a
+    checksummed pool reserves its last block for a marker, so :meth:`nblock`
+    is one less than in a plain pool of the same size, and
+    :func:`~nvm.pmemblk.open()` refuses to open a pool in the wrong mode.
     """
-    def __init__(self, block_pool):
+    def __init__(self, block_pool, checksum=False):
         self.block_pool = block_pool
+        self.checksum = checksum
         self.block_size = self.bsize()
+        if checksum:
+            self.block_size -= CHECKSUM_SIZE
+        self._marker_block = lib.pmemblk_nblock(block_pool) - 1
 
     def close(self):
         """This method closes the memory pool. The block memory pool itself
@@ -44,6 +88,8 @@ class BlockPool(object):
         :return: usable space in block memory pool in number of blocks.
         """
         ret = lib.pmemblk_nblock(self.block_pool)
+        if self.checksum:
+            ret -= 1
         return ret
 
     def read(self, block_num):
@@ -54,12 +100,40 @@ class BlockPool(object):
 
         :return: data at block.
         """
-        data = ffi.new("char[]", self.block_size)
+        self._check_block(block_num)
+        data = ffi.new("char[]", self.bsize())
         ret = lib.pmemblk_read(self.block_pool, data, block_num)
         if ret == -1:
-            raise RuntimeError(ffi.string(ret))
+            raise RuntimeError(os.strerror(ffi.errno))
+        if self.checksum:
+            self._verify(data, block_num)
+            data[self.block_size] = b'\0'
         return ffi.string(data)
 
+    def readinto(self, buf, block_num):
+        """This method reads a block from memory pool at specified block number
+        into buf, which must be a cffi char buffer or a writable Python buffer
+        of at least one block in size. Unlike :meth:`read`, the data is not
+        truncated at the first NUL byte and no new buffer is allocated.
+
+        :return: On success, zero is returned. On error, an exception
+                 will be raised.
+        """
+        self._check_block(block_num)
+        if not isinstance(buf, ffi.CData):
+            buf = ffi.from_buffer(buf)
+        if self.checksum:
+            raw = ffi.new("char[]", self.bsize())
+            ret = lib.pmemblk_read(self.block_pool, raw, block_num)
+        else:
+            ret = lib.pmemblk_read(self.block_pool, buf, block_num)
+        if ret == -1:
+            raise RuntimeError(os.strerror(ffi.errno))
+        if self.checksum:
+            self._verify(raw, block_num)
+            ffi.memmove(buf, raw, self.block_size)
+        return ret
+
     def write(self, data, block_num):
         """This method writes a block from data to block number blockno in the
         memory pool. The write is atomic with respect to other reads and
@@ -70,6 +144,9 @@ class BlockPool(object):
         :return: On success, zero is returned. On error, an exception
                  will be raised.
         """
+        self._check_block(block_num)
+        if self.checksum:
+            data = self._seal(data)
         ret = lib.pmemblk_write(self.block_pool, data, block_num)
         if ret == -1:
             raise RuntimeError(os.strerror(ffi.errno))
@@ -84,11 +161,67 @@ class BlockPool(object):
         :return: On success, zero is returned. On error, an exception will
                  be raised.
         """
+        self._check_block(block_num)
         ret = lib.pmemblk_set_zero(self.block_pool, block_num)
         if ret == -1:
             raise RuntimeError(os.strerror(ffi.errno))
         return ret
 
+    def set_zero_range(self, start, count):
+        """This method writes zeros to count blocks starting at block number
+        start, as :meth:`set_zero` does for a single block. The loop over the
+        blocks runs in C, so trimming a large range costs one call from
+        Python.
+
+        .. note:: Each block is zeroed atomically, but the range as a whole
+                  is not; after a crash a prefix of the range may have been
+                  zeroed.
+
+        :return: On success, zero is returned. On error, an exception will
+                 be raised.
+        """
+        if start < 0 or count < 0 or start + count > self.nblock():
+            raise ValueError("Block range {}+{} outside of pool".format(
+                             start, count))
+        ret = lib.pynvm_blk_set_zero_range(self.block_pool, start, count)
+        if ret == -1:
+            raise RuntimeError(os.strerror(ffi.errno))
+        return ret
+
+    def iter_nonzero(self, start=0, stop=None):
+        """This method iterates over the blocks from block number start up to
+        (but not including) stop, skipping blocks that read back as all
+        zeros (in checksum mode, blocks whose data is all zeros, whatever
+        their checksum). Blocks are read into a single reusable buffer and
+        the zero check runs in C, so scanning a sparse pool costs time
+        proportional to the number of blocks, not Python calls per block.
+
+        .. note:: The data yielded is a view on the reusable buffer and is
+                  only valid until the iteration advances; use `bytes(data)`
+                  to keep a copy.
+
+        :param start: first block number to scan (default 0).
+        :param stop: block number to stop at (default `nblock()`).
+        :return: an iterator of `(block_num, data)` pairs.
+        """
+        nblock = self.nblock()
+        if stop is None or stop > nblock:
+            stop = nblock
+        buf = ffi.new("char[]", self.bsize())
+        data = ffi.buffer(buf, self.block_size)
+        block_num = start
+        while block_num < stop:
+            block_num = lib.pynvm_blk_next_nonzero(
+                self.block_pool, buf, self.block_size, block_num, stop)
+            if block_num == -1:
+                raise RuntimeError(os.strerror(ffi.errno))
+            if block_num == stop:
+                return
+            if self.checksum:
+                self._verify(buf, block_num)
+            yield block_num, data
+            block_num += 1
+
     def set_error(self, block_num):
         """This method sets the error state for block number blockno in memory
         pool. A block in the error state returns errno EIO when read. Writing
@@ -97,13 +230,511 @@ class BlockPool(object):
         :return: On success, zero is returned. On error, an exception will
                  be raised.
         """
+        self._check_block(block_num)
         ret = lib.pmemblk_set_error(self.block_pool, block_num)
         if ret == -1:
             raise RuntimeError(os.strerror(ffi.errno))
         return ret
 
+    def scrub(self, workers=None, mark=True):
+        """This method verifies the checksum of every block in a checksummed
+        pool, and returns the sorted list of the numbers of the blocks that
+        are corrupt or already in the error state. The pool is split into
+        ranges that are verified by a pool of worker threads; each range is
+        read and checked in C without holding the GIL.
+
+        :param workers: number of worker threads (default to the number of
+                        CPUs).
+        :param mark: if True (the default), put each bad block in the error
+                     state with :meth:`set_error`, so that reading it fails
+                     until it is written again.
+        :return: list of bad block numbers.
+        :raises ValueError: if the pool has no checksums, or workers is less
+                            than 1.
+        """
+        if not self.checksum:
+            raise ValueError("scrub requires a pool opened with checksum=True")
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        elif workers < 1:
+            raise ValueError("workers must be at least 1, got {}".format(
+                             workers))
+        nblock = self.nblock()
+        step = max(1, min(_SCRUB_CHUNK, -(-nblock // workers)))
+        ranges = [(start, min(start + step, nblock))
+                  for start in range(0, nblock, step)]
+        thread_pool = ThreadPool(workers)
+        try:
+            results = thread_pool.map(self._scrub_range, ranges)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+        bad = sorted(itertools.chain.from_iterable(results))
+        if mark:
+            for block_num in bad:
+                self.set_error(block_num)
+        return bad
+
+    def _scrub_range(self, block_range):
+        start, stop = block_range
+        buf = ffi.new("char[]", self.bsize())
+        bad = ffi.new("long long[]", stop - start)
+        ret = lib.pynvm_blk_scrub(self.block_pool, buf, start, stop, bad)
+        if ret == -1:
+            raise RuntimeError(os.strerror(ffi.errno))
+        return list(bad[0:ret])
+
+    def _check_block(self, block_num):
+        # The marker block is outside the pool as seen through this object.
+        if self.checksum and block_num == self._marker_block:
+            raise RuntimeError(os.strerror(errno.EINVAL))
+
+    def _seal(self, data):
+        # Return a raw block holding data followed by its checksum.
+        if len(data) > self.block_size:
+            raise ValueError("Data larger than block size {}".format(
+                             self.block_size))
+        raw = ffi.new("char[]", self.bsize())
+        ffi.memmove(raw, data, len(data))
+        crc = zlib.crc32(ffi.buffer(raw, self.block_size)) & 0xffffffff
+        ffi.buffer(raw)[self.block_size:] = _CRC.pack(crc)
+        return raw
+
+    def _has_marker(self):
+        # Whether the last block holds a valid checksum mode marker.
+        raw = ffi.new("char[]", self.bsize())
+        if lib.pmemblk_read(self.block_pool, raw, self._marker_block) == -1:
+            return False
+        expected = ffi.buffer(self._seal(_CHECKSUM_MARKER))[:]
+        return ffi.buffer(raw)[:] == expected
+
+    def _verify(self, raw, block_num):
+        payload = ffi.buffer(raw, self.block_size)
+        crc = zlib.crc32(payload) & 0xffffffff
+        if _CRC.unpack_from(ffi.buffer(raw), self.block_size)[0] != crc:
+            if ffi.buffer(raw)[:] != b'\0' * self.bsize():
+                raise ChecksumError(block_num)
+
+
+# BlockStore on-media layout.  Block 0 holds the superblock, followed by the
+# allocation bitmap and the head bitmap (one bit per block each); everything
+# after that is available for records.
+_STORE_MAGIC = b'PNVMBST1'
+_STORE_VERSION = 1
+# magic, version, nblock, map_blocks
+_SUPER = struct.Struct('<8sIQQ')
+_HEAD_MAGIC = b'PBSH'
+# magic, version, seq, value_len, key_len, n_extents
+_HEAD = struct.Struct('<4sIQQII')
+# start block, block count
+_EXTENT = struct.Struct('<QI')
+
+_Record = collections.namedtuple('_Record', 'head seq size extents')
+
+
+class BlockStore(object):
+    """This class is a crash-safe key/value blob store kept inside a
+    :class:`BlockPool`.
+
+    Each value is stored as a record: a head block holding the key, the
+    value length and the list of extents (runs of contiguous blocks) holding
+    the value, followed by the extents themselves.  Values small enough to
+    fit in the head block after the key are stored inline and cost a
+    single block.  A free-block bitmap and a head bitmap are kept in blocks
+    reserved at the start of the pool, and the key index is rebuilt in DRAM
+    from the head blocks when the store is opened.
+
+    Since block writes are atomic, setting a record's bit in the head
+    bitmap is the commit point of a :meth:`put`: blocks are marked
+    allocated and written first, and the blocks of a replaced record are
+    released only afterwards.  A crash can therefore at worst leak blocks
+    or leave two versions of a record, and both are repaired the next time
+    the store is opened.
+
+    Free space is tracked in DRAM as extents, binned by the power of two
+    below their length, and a running count of free blocks. Allocating or
+    releasing a record takes time proportional to its number of extents
+    plus the number of bins (the log of the pool size), except when no
+    extent in a larger bin exists: the bin of the requested length is then
+    searched, which is linear in the number of extents in it.  Opening the
+    store scans the whole pool once.
+
+    .. note:: Opening a pool that does not contain a store formats it,
+              discarding whatever the blocks held before.
+
+    :param block_pool: the :class:`BlockPool` to keep the store in.
+    """
+    def __init__(self, block_pool):
+        self.block_pool = block_pool
+        self.block_size = block_pool.block_size
+        self._nblock = block_pool.nblock()
+        self._buf = ffi.new("char[]", self.block_size)
+        self._map_bits = self.block_size * 8
+        map_blocks = -(-self._nblock // self._map_bits)
+        self._alloc_start = 1
+        self._head_start = self._alloc_start + map_blocks
+        self._data_start = self._head_start + map_blocks
+        if (self.block_size < _HEAD.size + _EXTENT.size or
+                self._data_start >= self._nblock):
+            raise ValueError("Block pool is too small for a BlockStore")
+        self._map_blocks = map_blocks
+        self._index = {}
+        self._seq = 0
+        self._nfree = 0
+        # start -> length, and end -> start, of each free extent.
+        self._free_starts = {}
+        self._free_ends = {}
+        # The starts of the extents whose length has bit_length() i + 1.
+        self._free_bins = [set() for _ in range(self._nblock.bit_length())]
+        self._alloc_map = bytearray(map_blocks * self.block_size)
+        self._head_map = bytearray(map_blocks * self.block_size)
+        magic, version, nblock, stored_map_blocks = _SUPER.unpack_from(
+            self._read_block(0))
+        if magic != _STORE_MAGIC:
+            self._format()
+        elif (version != _STORE_VERSION or nblock != self._nblock or
+                stored_map_blocks != map_blocks):
+            raise RuntimeError("Incompatible BlockStore layout in pool")
+        else:
+            self._load()
+
+    def close(self):
+        """This method closes the underlying block pool."""
+        self.block_pool.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return self._coerce_key(key) in self._index
 
-def open(filename, block_size=0):
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def keys(self):
+        """This method returns the list of keys in the store.
+
+        :return: the keys, as byte strings.
+        """
+        return list(self._index)
+
+    def nfree(self):
+        """This method returns the number of blocks not used by any record.
+
+        :return: number of free blocks.
+        """
+        return self._nfree
+
+    def put(self, key, value):
+        """This method stores value under key, replacing any previous value.
+        Only the blocks of the new record and the bitmap blocks covering
+        them are written. On recovery the key is guaranteed to map to either
+        the old or the new value.
+
+        :param key: a byte string (unicode strings are encoded as UTF-8).
+        :param value: a bytes-like object.
+        """
+        key = self._coerce_key(key)
+        value = memoryview(value)
+        if value.itemsize != 1:
+            value = memoryview(value.tobytes())
+        size = len(value)
+        meta = _HEAD.size + len(key)
+        if meta > self.block_size:
+            raise ValueError("Key too long for block size {}".format(
+                             self.block_size))
+        if meta + size <= self.block_size:
+            nblocks = 0
+        else:
+            nblocks = -(-size // self.block_size)
+        max_extents = (self.block_size - meta) // _EXTENT.size
+        extents = self._allocate(nblocks + 1, max_extents + 1)
+        head = extents[0][0]
+        if extents[0][1] == 1:
+            extents = extents[1:]
+        else:
+            extents[0] = (head + 1, extents[0][1] - 1)
+        if len(extents) > max_extents:
+            self._release(head, extents, write=False)
+            raise MemoryError("Free space too fragmented for a {} byte"
+                              " value".format(size))
+        self._seq += 1
+        record = _Record(head, self._seq, size, tuple(extents))
+        try:
+            self._write_map(self._alloc_map, self._alloc_start,
+                            self._blocks_of(record))
+            pos = 0
+            for start, count in extents:
+                for block_num in range(start, start + count):
+                    self._write_block(value[pos:pos + self.block_size],
+                                      block_num)
+                    pos += self.block_size
+            header = _HEAD.pack(_HEAD_MAGIC, _STORE_VERSION, record.seq,
+                                size, len(key), len(extents))
+            body = [header] + [_EXTENT.pack(*e) for e in extents] + [key]
+            if not extents:
+                body.append(value.tobytes())
+            self._write_block(b''.join(body), head)
+        except Exception:
+            self._release(head, extents)
+            raise
+        old = self._index.get(key)
+        # Setting the head bit commits the record.  The old head bit is
+        # cleared only after that write, so a crash in between leaves both
+        # records and recovery keeps the newer; when both bits live in the
+        # same bitmap block the replacement is a single write.
+        self._set_bit(self._head_map, head, 1)
+        if old is not None:
+            self._set_bit(self._head_map, old.head, 0)
+        self._write_map(self._head_map, self._head_start, [head])
+        if (old is not None and
+                old.head // self._map_bits != head // self._map_bits):
+            self._write_map(self._head_map, self._head_start, [old.head])
+        self._index[key] = record
+        if old is not None:
+            self._release(old.head, old.extents)
+
+    def get(self, key, default=None):
+        """This method returns the value stored under key, or default if
+        there is no such key. Only the blocks holding the value are read.
+
+        :return: the value, as a byte string.
+        """
+        record = self._index.get(self._coerce_key(key))
+        if record is None:
+            return default
+        if not record.extents:
+            data = self._read_block(record.head)
+            offset = _HEAD.size + _HEAD.unpack_from(data)[4]
+            return data[offset:offset + record.size]
+        result = bytearray(record.size)
+        dest = ffi.from_buffer(result)
+        full_blocks = record.size // self.block_size
+        pos = 0
+        for start, count in record.extents:
+            for block_num in range(start, start + count):
+                if pos < full_blocks:
+                    self.block_pool.readinto(dest + pos * self.block_size,
+                                             block_num)
+                else:
+                    tail = record.size - pos * self.block_size
+                    self.block_pool.readinto(self._buf, block_num)
+                    result[-tail:] = ffi.buffer(self._buf, tail)[:]
+                pos += 1
+        return bytes(result)
+
+    def delete(self, key):
+        """This method removes key and its value from the store. Clearing the
+        record's head bit is the commit point, after which its blocks are
+        returned to the free-block bitmap.
+
+        :raises KeyError: if key is not in the store.
+        """
+        key = self._coerce_key(key)
+        record = self._index.pop(key)
+        self._set_bit(self._head_map, record.head, 0)
+        self._write_map(self._head_map, self._head_start, [record.head])
+        self._release(record.head, record.extents)
+
+    # Internal helpers.
+
+    @staticmethod
+    def _coerce_key(key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return key
+
+    @staticmethod
+    def _blocks_of(record):
+        blocks = [record.head]
+        for start, count in record.extents:
+            blocks.extend(range(start, start + count))
+        return blocks
+
+    @staticmethod
+    def _set_bit(bitmap, block_num, value):
+        if value:
+            bitmap[block_num >> 3] |= 1 << (block_num & 7)
+        else:
+            bitmap[block_num >> 3] &= ~(1 << (block_num & 7)) & 0xff
+
+    def _read_block(self, block_num):
+        self.block_pool.readinto(self._buf, block_num)
+        return ffi.buffer(self._buf)[:]
+
+    def _write_block(self, data, block_num):
+        size = len(data)
+        ffi.memmove(self._buf, data, size)
+        if size < self.block_size:
+            ffi.buffer(self._buf)[size:] = b'\0' * (self.block_size - size)
+        self.block_pool.write(self._buf, block_num)
+
+    def _write_map(self, bitmap, map_start, block_nums):
+        bsize = self.block_size
+        for i in sorted(set(b // self._map_bits for b in block_nums)):
+            self._write_block(bitmap[i * bsize:(i + 1) * bsize],
+                              map_start + i)
+
+    def _allocate(self, count, max_extents):
+        """Reserve count free blocks in DRAM and return them as extents.
+
+        A contiguous run is preferred, taken from the smallest bin whose
+        extents are all long enough, then from the bin of count itself;
+        otherwise the longest free extents are used.
+        """
+        if count > self._nfree:
+            raise MemoryError("Not enough free blocks for {}"
+                              " blocks".format(count))
+        bins = self._free_bins
+        first = count.bit_length() - 1
+        start = None
+        for i in range(first + 1, len(bins)):
+            if bins[i]:
+                start = next(iter(bins[i]))
+                break
+        else:
+            for free_start in bins[first]:
+                if self._free_starts[free_start] >= count:
+                    start = free_start
+                    break
+        if start is not None:
+            extents = [(start, count)]
+        else:
+            # No bin above first holds an extent, so go down from first.
+            extents = []
+            need = count
+            for i in range(first, -1, -1):
+                for free_start in bins[i]:
+                    if len(extents) == max_extents:
+                        raise MemoryError("Not enough free blocks for {}"
+                                          " blocks".format(count))
+                    n = min(self._free_starts[free_start], need)
+                    extents.append((free_start, n))
+                    need -= n
+                    if not need:
+                        break
+                if not need:
+                    break
+        for start, n in extents:
+            length = self._remove_extent(start)
+            if length > n:
+                self._insert_extent(start + n, length - n)
+            for block_num in range(start, start + n):
+                self._set_bit(self._alloc_map, block_num, 1)
+        self._nfree -= count
+        return extents
+
+    def _release(self, head, extents, write=True):
+        blocks = self._blocks_of(_Record(head, 0, 0, extents))
+        for block_num in blocks:
+            self._set_bit(self._alloc_map, block_num, 0)
+        self._insert_extent(head, 1)
+        for start, count in extents:
+            self._insert_extent(start, count)
+        self._nfree += len(blocks)
+        if write:
+            self._write_map(self._alloc_map, self._alloc_start, blocks)
+
+    def _insert_extent(self, start, count):
+        # Add a free extent, merging it with the free extents around it.
+        before = self._free_ends.get(start)
+        if before is not None:
+            count += self._remove_extent(before)
+            start = before
+        if start + count in self._free_starts:
+            count += self._remove_extent(start + count)
+        self._free_starts[start] = count
+        self._free_ends[start + count] = start
+        self._free_bins[count.bit_length() - 1].add(start)
+
+    def _remove_extent(self, start):
+        count = self._free_starts.pop(start)
+        del self._free_ends[start + count]
+        self._free_bins[count.bit_length() - 1].remove(start)
+        return count
+
+    def _format(self):
+        for i in range(2 * self._map_blocks):
+            self.block_pool.set_zero(self._alloc_start + i)
+        for block_num in range(self._data_start):
+            self._set_bit(self._alloc_map, block_num, 1)
+        self._write_map(self._alloc_map, self._alloc_start,
+                        range(self._data_start))
+        # Writing the superblock last makes the format atomic.
+        self._write_block(_SUPER.pack(_STORE_MAGIC, _STORE_VERSION,
+                                      self._nblock, self._map_blocks), 0)
+        self._insert_extent(self._data_start, self._nblock - self._data_start)
+        self._nfree = self._nblock - self._data_start
+
+    def _load(self):
+        bsize = self.block_size
+        for i in range(self._map_blocks):
+            self.block_pool.readinto(self._buf, self._alloc_start + i)
+            self._alloc_map[i * bsize:(i + 1) * bsize] = ffi.buffer(
+                self._buf)[:]
+            self.block_pool.readinto(self._buf, self._head_start + i)
+            self._head_map[i * bsize:(i + 1) * bsize] = ffi.buffer(
+                self._buf)[:]
+        # Bulk scan: read every head block marked in the head bitmap.
+        stale = []
+        for i, byte in enumerate(self._head_map):
+            if not byte:
+                continue
+            for bit in range(8):
+                if not byte & (1 << bit):
+                    continue
+                head = (i << 3) + bit
+                data = self._read_block(head)
+                magic, version, seq, size, key_len, n_extents = (
+                    _HEAD.unpack_from(data))
+                if magic != _HEAD_MAGIC or head < self._data_start:
+                    stale.append(head)
+                    continue
+                offset = _HEAD.size
+                extents = []
+                for _ in range(n_extents):
+                    extents.append(_EXTENT.unpack_from(data, offset))
+                    offset += _EXTENT.size
+                key = data[offset:offset + key_len]
+                record = _Record(head, seq, size, tuple(extents))
+                old = self._index.get(key)
+                if old is not None:
+                    # A crash interrupted a replacement; the newer one wins.
+                    if old.seq > seq:
+                        old, record = record, old
+                    stale.append(old.head)
+                self._index[key] = record
+                self._seq = max(self._seq, seq)
+        if stale:
+            for head in stale:
+                self._set_bit(self._head_map, head, 0)
+            self._write_map(self._head_map, self._head_start, stale)
+        # The allocation bitmap may hold blocks leaked by a crash; recompute
+        # it from the records and rewrite any bitmap block that differs.
+        alloc_map = bytearray(len(self._alloc_map))
+        used = bytearray(self._nblock)
+        for block_num in range(self._data_start):
+            self._set_bit(alloc_map, block_num, 1)
+        for record in self._index.values():
+            for block_num in self._blocks_of(record):
+                used[block_num] = 1
+                self._set_bit(alloc_map, block_num, 1)
+        start = used.find(b'\0', self._data_start)
+        while start != -1:
+            end = used.find(b'\1', start)
+            if end == -1:
+                end = self._nblock
+            self._insert_extent(start, end - start)
+            self._nfree += end - start
+            start = used.find(b'\0', end)
+        dirty = [i * self._map_bits for i in range(self._map_blocks)
+                 if alloc_map[i * bsize:(i + 1) * bsize] !=
+                    self._alloc_map[i * bsize:(i + 1) * bsize]]
+        self._alloc_map = alloc_map
+        self._write_map(self._alloc_map, self._alloc_start, dirty)
+
+
+def open(filename, block_size=0, checksum=None):
     """This function opens an existing block memory pool, returning a memory pool.
 
     .. note:: If an error prevents the pool from being opened, this function
@@ -117,16 +748,30 @@ def open(filename, block_size=0):
                      :func:`~nvm.pmemblk.create()` method.
                      The application must have permission to open the file and
                      memory map it with read/write permissions.
+    :param checksum: whether the pool uses the checksumming mode of
+                     :class:`BlockPool`. By default the mode the pool was
+                     created with is used.
     :return: the block memory pool.
     :rtype: BlockPool
+    :raises ValueError: if checksum is given and does not match the mode
+                        the pool was created with.
     """
+    if sys.version_info[0] > 2 and hasattr(filename, 'encode'):
+        filename = filename.encode(errors='surrogateescape')
     ret = lib.pmemblk_open(filename, block_size)
     if ret == ffi.NULL:
         raise RuntimeError(os.strerror(ffi.errno))
-    return BlockPool(ret)
+    recorded = BlockPool(ret, checksum=True)._has_marker()
+    if checksum is None:
+        checksum = recorded
+    elif checksum != recorded:
+        lib.pmemblk_close(ret)
+        raise ValueError("Pool was created with checksum={}".format(recorded))
+    return BlockPool(ret, checksum=checksum)
 
 
-def create(filename, block_size, pool_size=1024 * 1024 * 2, mode=0666):
+def create(filename, block_size, pool_size=1024 * 1024 * 2, mode=0o666,
+           checksum=False):
     """This function function creates a block memory pool with the given
     total pool size divided up into as many elements of block size as will
     fit in the pool.
@@ -143,13 +788,24 @@ def create(filename, block_size, pool_size=1024 * 1024 * 2, mode=0666):
     :param block_size: the size of the blocks.
     :param pool_size: the size of the pool (default to 2MB).
     :param mode: specifies the permissions to use when creating the file.
+    :param checksum: if True, use the checksumming mode of
+                     :class:`BlockPool`, and record it in the pool.
     :return: the new block memory pool created.
     :rtype: BlockPool
     """
+    if sys.version_info[0] > 2 and hasattr(filename, 'encode'):
+        filename = filename.encode(errors='surrogateescape')
     ret = lib.pmemblk_create(filename, block_size, pool_size, mode)
     if ret == ffi.NULL:
         raise RuntimeError(os.strerror(ffi.errno))
-    return BlockPool(ret)
+    pool = BlockPool(ret, checksum=checksum)
+    if checksum:
+        marker = pool._seal(_CHECKSUM_MARKER)
+        if lib.pmemblk_write(ret, marker, pool._marker_block) == -1:
+            err = ffi.errno
+            pool.close()
+            raise RuntimeError(os.strerror(err))
+    return pool
 
 
 def check(filename, block_size=0):
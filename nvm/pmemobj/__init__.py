@@ -1,2 +1,6 @@
 from .pool import open, create, MIN_POOL_SIZE, PersistentObjectPool
 from .list import PersistentList
+from .dict import PersistentDict
+from .set import PersistentSet
+from .blob import PersistentBlob
+from .btree import PersistentBTree
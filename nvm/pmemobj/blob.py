@@ -0,0 +1,214 @@
+import os
+
+from .pool import BLOB_CHUNK_TYPE_NUM, MAX_OBJ_SIZE, _readonly_view
+
+from _pmem import ffi    # XXX refactor to make this import unneeded
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def _byte_view(data):
+    view = memoryview(data)
+    if view.itemsize != 1:
+        view = memoryview(view.tobytes())
+    return view
+
+
+class PersistentBlob(object):
+    """Persistent binary data of any size, read and written like a file.
+
+    The data is split into chunks of chunk_size bytes, each a separate
+    allocation, so a blob is not limited to MAX_OBJ_SIZE, and growing it
+    never copies the existing data.  Each write is a transaction, and can
+    be made part of a larger one.  The read/write position is not
+    persistent: it is 0 whenever the blob is resurrected.
+    """
+
+    # XXX locking!
+
+    def __init__(self, data=b'', chunk_size=DEFAULT_CHUNK_SIZE, **kw):
+        if '__manager__' not in kw:
+            raise ValueError("__manager__ is required")
+        mm = self.__manager__ = kw.pop('__manager__')
+        if '_oid' not in kw:
+            if not 0 < chunk_size <= MAX_OBJ_SIZE:
+                raise ValueError("chunk_size must be between 1 and {}, not"
+                                 " {}".format(MAX_OBJ_SIZE, chunk_size))
+            with mm.transaction():
+                self._oid = mm.malloc(ffi.sizeof('PBlobObject'))
+                ob = ffi.cast('PObject *', mm.direct(self._oid))
+                ob.ob_type = mm._get_type_code(PersistentBlob)
+                self._body = ffi.cast('PBlobObject *', mm.direct(self._oid))
+                self._body.chunk_size = chunk_size
+                self._pos = 0
+                self.write(data)
+        else:
+            self._oid = kw.pop('_oid')
+            self._body = ffi.cast('PBlobObject *', mm.direct(self._oid))
+        self._pos = 0
+
+    def _chunk_ptrs(self):
+        if not self._body.nchunks:
+            return None
+        mm = self.__manager__
+        return ffi.cast('PObjPtr *', mm.direct(self._body.chunks))
+
+    def _pieces(self, pos, size):
+        """Generate (chunk_index, offset, length) covering size bytes at pos.
+        """
+        chunk_size = self._body.chunk_size
+        end = pos + size
+        while pos < end:
+            index, offset = divmod(pos, chunk_size)
+            length = min(chunk_size - offset, end - pos)
+            yield index, offset, length
+            pos += length
+
+    def _chunk(self, chunk_ptrs, index):
+        return ffi.cast('char *', self.__manager__.direct(chunk_ptrs[index]))
+
+    def _resize_chunks(self, count):
+        """Allocate or free chunks so that there are count of them."""
+        mm = self.__manager__
+        body = self._body
+        old_count = body.nchunks
+        if count == old_count:
+            return
+        chunk_ptrs = self._chunk_ptrs()
+        for i in range(count, old_count):
+            mm.free(chunk_ptrs[i])
+        mm.snapshot_range(ffi.addressof(body, 'nchunks'),
+                          ffi.sizeof('size_t') + ffi.sizeof('PObjPtr'))
+        if old_count:
+            body.chunks = mm.realloc_ptrs(body.chunks, count)
+        else:
+            body.chunks = mm.malloc_ptrs(count)
+        body.nchunks = count
+        # The pointer array is new memory, so needs no snapshot.
+        chunk_ptrs = self._chunk_ptrs()
+        for i in range(old_count, count):
+            chunk_ptrs[i] = mm.malloc(body.chunk_size,
+                                      type_num=BLOB_CHUNK_TYPE_NUM)
+
+    def _set_size(self, size):
+        mm = self.__manager__
+        mm.snapshot_range(ffi.addressof(self._body, 'size'),
+                          ffi.sizeof('size_t'))
+        self._body.size = size
+
+    def __len__(self):
+        return self._body.size
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self._body.size + offset
+        else:
+            raise ValueError("invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        """Read into the writable buffer b, returning the number of bytes read.
+        """
+        view = _byte_view(b)
+        size = max(0, min(len(view), self._body.size - self._pos))
+        chunk_ptrs = self._chunk_ptrs()
+        done = 0
+        for index, offset, length in self._pieces(self._pos, size):
+            view[done:done + length] = ffi.buffer(
+                self._chunk(chunk_ptrs, index) + offset, length)
+            done += length
+        self._pos += size
+        return size
+
+    def read(self, size=-1):
+        """Read up to size bytes (all, if size is negative) and return them.
+        """
+        available = max(0, self._body.size - self._pos)
+        if size is None or size < 0 or size > available:
+            size = available
+        buf = bytearray(size)
+        self.readinto(buf)
+        return bytes(buf)
+
+    def write(self, data):
+        """Write data at the current position, returning its length."""
+        mm = self.__manager__
+        view = _byte_view(data)
+        size = len(view)
+        if not size:
+            return 0
+        end = self._pos + size
+        with mm.transaction():
+            old_count = self._body.nchunks
+            chunk_size = self._body.chunk_size
+            self._resize_chunks(max(old_count, -(-end // chunk_size)))
+            chunk_ptrs = self._chunk_ptrs()
+            done = 0
+            for index, offset, length in self._pieces(self._pos, size):
+                ptr = self._chunk(chunk_ptrs, index) + offset
+                if index < old_count:
+                    mm.snapshot_range(ptr, length)
+                ffi.memmove(ptr, view[done:done + length], length)
+                done += length
+            if end > self._body.size:
+                self._set_size(end)
+        self._pos = end
+        return size
+
+    def truncate(self, size=None):
+        """Resize to size bytes (default the current position).
+
+        Growing the blob fills it with zero bytes.  The position is not
+        changed.
+        """
+        mm = self.__manager__
+        body = self._body
+        if size is None:
+            size = self._pos
+        if size < 0:
+            raise ValueError("negative size value {}".format(size))
+        with mm.transaction():
+            count = -(-size // body.chunk_size)
+            if size < body.size:
+                # Keep the bytes beyond size zero, so that growing the blob
+                # again doesn't bring back old data.
+                tail = min(body.size, count * body.chunk_size) - size
+                if tail:
+                    ptr = self._chunk(self._chunk_ptrs(), count - 1)
+                    ptr += size - (count - 1) * body.chunk_size
+                    mm.snapshot_range(ptr, tail)
+                    ffi.memmove(ptr, b'\0' * tail, tail)
+                self._resize_chunks(count)
+            else:
+                self._resize_chunks(max(count, body.nchunks))
+            self._set_size(size)
+        return size
+
+    def iter_chunks(self):
+        """Generate memoryviews of the data, one per chunk, without copying.
+
+        The views refer to persistent memory directly; they must not be
+        written to, and are invalid once the blob is changed.
+        """
+        chunk_ptrs = self._chunk_ptrs()
+        for index, offset, length in self._pieces(0, self._body.size):
+            yield _readonly_view(self._chunk(chunk_ptrs, index), length)
+
+    def __repr__(self):
+        return "{}(<{} bytes>)".format(self.__class__.__name__, len(self))
+
+    # Additional methods required by the pmemobj API.
+
+    def _deallocate(self):
+        with self.__manager__.transaction():
+            self._resize_chunks(0)
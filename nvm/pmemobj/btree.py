@@ -0,0 +1,590 @@
+from .compat import recursive_repr, abc
+from .pool import BTREE_NODE_TYPE_NUM
+
+from _pmem import ffi    # XXX refactor to make this import unneeded
+
+# Nodes are a page by default.  A node must be able to hold MIN_ORDER keys,
+# so that both halves of a split one hold at least two.
+DEFAULT_NODE_SIZE = 4096
+MIN_ORDER = 4
+
+
+class PersistentBTree(abc.MutableMapping):
+    """Persistent sorted mapping, kept in a B+tree.
+
+    Keys must be persistable and comparable with each other, and are kept in
+    order.  The items are held in the leaves of the tree, which are linked
+    in key order, so finding a key, min and max, and floor_key and
+    ceiling_key cost O(log n), and iterating over k items with irange costs
+    O(log n + k).  Each node holds up to order keys, which is set from
+    node_size (in bytes) when the tree is created; a page by default, or a
+    few cache lines for small trees.  Keys and values are stored as object
+    pointers, so ints, floats and bools are held in the nodes themselves
+    (see MemoryManager._inline).  Splitting, merging and shifting items
+    only snapshot the slots of the nodes they change.
+    """
+
+    # XXX locking!
+
+    _body_type = 'PBTreeObject'
+    # A count of the changes made to the shape of the tree, which tells
+    # iterators the node they are on may be gone.
+    _v_changes = 0
+
+    def __init__(self, *args, **kw):
+        if '__manager__' not in kw:
+            raise ValueError("__manager__ is required")
+        mm = self.__manager__ = kw.pop('__manager__')
+        node_size = kw.pop('node_size', DEFAULT_NODE_SIZE)
+        if len(args) > 1:
+            raise TypeError("PersistentBTree takes at most 1"
+                            " argument, {} given".format(len(args)))
+        if '_oid' in kw:
+            self._oid = kw.pop('_oid')
+            self._body = ffi.cast('PBTreeObject *', mm.direct(self._oid))
+            if args or kw:
+                self.update(*args, **kw)
+            return
+        order = ((node_size - ffi.sizeof('PBTreeNode') -
+                  ffi.sizeof('PObjPtr')) // (2 * ffi.sizeof('PObjPtr')))
+        if order < MIN_ORDER:
+            raise ValueError("node_size must be at least {}, not {}".format(
+                             self._node_size(MIN_ORDER), node_size))
+        with mm.transaction():
+            self._oid = mm.malloc(ffi.sizeof('PBTreeObject'))
+            ob = ffi.cast('PObject *', mm.direct(self._oid))
+            ob.ob_type = mm._get_type_code(PersistentBTree)
+            self._body = ffi.cast('PBTreeObject *', mm.direct(self._oid))
+            self._body.order = order
+            if args or kw:
+                self.update(*args, **kw)
+
+    # Reading and writing nodes.
+
+    @staticmethod
+    def _node_size(order):
+        return (ffi.sizeof('PBTreeNode') +
+                (2 * order + 1) * ffi.sizeof('PObjPtr'))
+
+    def _node(self, oid):
+        return ffi.cast('PBTreeNode *', self.__manager__.direct(oid))
+
+    def _new_node(self, is_leaf):
+        """Return the oid and node of a new, empty node."""
+        oid = self.__manager__.malloc(self._node_size(self._body.order),
+                                      type_num=BTREE_NODE_TYPE_NUM)
+        node = self._node(oid)
+        node.is_leaf = is_leaf
+        return oid, node
+
+    def _others(self, node):
+        """Return a pointer to node's values or children."""
+        return node.slots + self._body.order
+
+    @staticmethod
+    def _read(base, start, stop):
+        """Return the oids base[start] to base[stop - 1], as tuples."""
+        if start >= stop:
+            return []
+        # Each PObjPtr is two uint64_ts, so the block can be unpacked as those.
+        words = ffi.unpack(ffi.cast('uint64_t *', base + start),
+                           2 * (stop - start))
+        return list(zip(words[0::2], words[1::2]))
+
+    def _store(self, node, key_start, keys, other_start, others, new=False):
+        """Replace node's keys from key_start on with keys, and its values or
+        children from other_start on with others.
+
+        The slots from each start to the further of the old end and the new
+        one are snapshotted, unless the node is new.
+        """
+        mm = self.__manager__
+        ptr_size = ffi.sizeof('PObjPtr')
+        nkeys = node.nkeys
+        nothers = nkeys if node.is_leaf else nkeys + 1
+        for base, start, used, oids in (
+                (node.slots, key_start, nkeys, keys),
+                (self._others(node), other_start, nothers, others)):
+            end = max(used, start + len(oids))
+            if not new and end > start:
+                mm.snapshot_range(base + start, (end - start) * ptr_size)
+            if oids:
+                ffi.memmove(base + start, ffi.new('PObjPtr[]', oids),
+                            len(oids) * ptr_size)
+        if key_start + len(keys) != nkeys:
+            if not new:
+                mm.snapshot_range(ffi.addressof(node, 'nkeys'),
+                                  ffi.sizeof('size_t'))
+            node.nkeys = key_start + len(keys)
+
+    def _put(self, base, index, oid):
+        self.__manager__.snapshot_range(base + index, ffi.sizeof('PObjPtr'))
+        base[index] = oid
+
+    def _set_next(self, node, oid):
+        self.__manager__.snapshot_range(ffi.addressof(node, 'next'),
+                                        ffi.sizeof('PObjPtr'))
+        node.next = oid
+
+    def _set_header(self, size, root):
+        body = self._body
+        self.__manager__.snapshot_range(ffi.addressof(body, 'size'),
+                                        ffi.sizeof('PBTreeObject') -
+                                        ffi.sizeof('PObject'))
+        body.size = size
+        body.root = root
+
+    # Searching.
+
+    def _bisect(self, node, key, right):
+        """Return where key goes in node's keys, as bisect_left would, or
+        bisect_right if right is true.
+
+        Only the keys the search looks at are resurrected.
+        """
+        resurrect = self.__manager__.resurrect
+        keys = node.slots
+        lo, hi = 0, node.nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = resurrect(keys[mid])
+            if (not key < k) if right else k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _descend(self, key, right=False):
+        """Return the path to where key is or would go in the leaves.
+
+        The path is a list of (oid, node, index) from the root down.  For
+        an interior node, index is the child followed; for the leaf, it is
+        where key goes among its keys, bisected left or right as for
+        _bisect.  The tree must not be empty.
+        """
+        mm = self.__manager__
+        path = []
+        oid = mm.otuple(self._body.root)
+        while True:
+            node = self._node(oid)
+            if node.is_leaf:
+                path.append((oid, node, self._bisect(node, key, right)))
+                return path
+            i = self._bisect(node, key, True)
+            path.append((oid, node, i))
+            oid = mm.otuple(self._others(node)[i])
+
+    def _find(self, key):
+        """Return the leaf holding key and key's index in it, or None, None.
+        """
+        if self._body.size == 0:
+            return None, None
+        _, leaf, i = self._descend(key)[-1]
+        if (i < leaf.nkeys and
+                not key < self.__manager__.resurrect(leaf.slots[i])):
+            return leaf, i
+        return None, None
+
+    def _end_leaf(self, oid, last):
+        """Return the first (or last) leaf of the subtree at oid."""
+        node = self._node(oid)
+        while not node.is_leaf:
+            node = self._node(self._others(node)[node.nkeys if last else 0])
+        return node
+
+    def _scan(self, lo=None, hi=None, inclusive=(True, True)):
+        """Generate (leaf, index) for each item from lo to hi in order.
+
+        A bound of None means that end of the tree.  The keys of each leaf
+        are read as the scan reaches it.  Changing the shape of the tree
+        while the generator is suspended makes it raise RuntimeError.
+        """
+        mm = self.__manager__
+        if self._body.size == 0:
+            return
+        if lo is None:
+            leaf = self._end_leaf(self._body.root, last=False)
+            i = 0
+        else:
+            _, leaf, i = self._descend(lo, right=not inclusive[0])[-1]
+        changes = self._v_changes
+        resurrect = mm.resurrect
+        while True:
+            keys = self._read(leaf.slots, i, leaf.nkeys)
+            next_oid = mm.otuple(leaf.next)
+            for key in keys:
+                if hi is not None:
+                    k = resurrect(key)
+                    if hi < k or not (inclusive[1] or k < hi):
+                        return
+                yield leaf, i
+                if self._v_changes != changes:
+                    raise RuntimeError("PersistentBTree changed size during"
+                                       " iteration")
+                i += 1
+            if next_oid == mm.OID_NULL:
+                return
+            leaf = self._node(next_oid)
+            i = 0
+
+    # Inserting.
+
+    def _insert(self, path, key, other):
+        """Insert key in the leaf at the end of path, with value other.
+
+        A full node is split in two, and its parent gets the key dividing
+        them and the new node, and so on up; if the root splits, a new
+        root is made above the two halves.
+        """
+        mm = self.__manager__
+        order = self._body.order
+        while path:
+            oid, node, i = path.pop()
+            is_leaf = node.is_leaf
+            j = i if is_leaf else i + 1
+            nkeys = node.nkeys
+            keys = self._read(node.slots, i, nkeys)
+            others = self._read(self._others(node), j,
+                                nkeys if is_leaf else nkeys + 1)
+            if nkeys < order:
+                self._store(node, i, [key] + keys, j, [other] + others)
+                return
+            key, other = self._split(oid, node, i, key, other)
+        root_oid, root = self._new_node(is_leaf=False)
+        self._store(root, 0, [key], 0, [mm.otuple(self._body.root), other],
+                    new=True)
+        self._set_header(self._body.size, root_oid)
+
+    def _split(self, oid, node, i, key, other):
+        """Split the full node oid, inserting key and other at i.
+
+        Return the key dividing the halves and the oid of the new right one.
+        """
+        mm = self.__manager__
+        is_leaf = node.is_leaf
+        nkeys = node.nkeys
+        others = self._read(self._others(node), 0,
+                            nkeys if is_leaf else nkeys + 1)
+        keys = self._read(node.slots, 0, nkeys)
+        keys.insert(i, key)
+        others.insert(i if is_leaf else i + 1, other)
+        mid = len(keys) // 2
+        right_oid, right = self._new_node(is_leaf)
+        start = min(i, mid)
+        if is_leaf:
+            # The right half's first key is copied up, so is a new reference.
+            up = keys[mid]
+            mm.incref(up)
+            self._store(node, start, keys[start:mid], start, others[start:mid])
+            self._store(right, 0, keys[mid:], 0, others[mid:], new=True)
+            right.next = node.next
+            self._set_next(node, right_oid)
+        else:
+            # The middle key moves up.
+            up = keys[mid]
+            self._store(node, start, keys[start:mid],
+                        start, others[start:mid + 1])
+            self._store(right, 0, keys[mid + 1:], 0, others[mid + 1:],
+                        new=True)
+        return up, right_oid
+
+    # Deleting.
+
+    def _remove(self, path):
+        """Remove the item at the end of path from its leaf, and rebalance.
+
+        The key and value are not decrefed.
+        """
+        mm = self.__manager__
+        minimum = self._body.order // 2
+        oid, leaf, i = path[-1]
+        nkeys = leaf.nkeys
+        self._store(leaf, i, self._read(leaf.slots, i + 1, nkeys),
+                    i, self._read(self._others(leaf), i + 1, nkeys))
+        # A node left with too few keys takes one from a sibling, or is
+        # merged with it, which takes a key from the parent.
+        while len(path) > 1:
+            oid, node, _ = path.pop()
+            if node.nkeys >= minimum:
+                return
+            _, parent, i = path[-1]
+            if not self._rebalance(parent, i, node):
+                return
+        root_oid, root, _ = path[0]
+        if root.nkeys == 0:
+            if root.is_leaf:
+                new_root = mm.OID_NULL
+            else:
+                new_root = mm.otuple(self._others(root)[0])
+            self._set_header(self._body.size, new_root)
+            mm.free(root_oid)
+
+    def _rebalance(self, parent, i, node):
+        """Refill node, child i of parent, from a sibling.
+
+        Return True if node was merged with a sibling, so that parent has
+        one key fewer.
+        """
+        minimum = self._body.order // 2
+        children = self._others(parent)
+        if i > 0:
+            left = self._node(children[i - 1])
+            if left.nkeys > minimum:
+                self._take_from_left(parent, i, left, node)
+                return False
+        if i < parent.nkeys:
+            right = self._node(children[i + 1])
+            if right.nkeys > minimum:
+                self._take_from_right(parent, i, node, right)
+                return False
+        if i > 0:
+            self._merge(parent, i - 1, left, node)
+        else:
+            self._merge(parent, i, node, right)
+        return True
+
+    def _take_from_left(self, parent, i, left, node):
+        mm = self.__manager__
+        nleft = left.nkeys
+        left_key = mm.otuple(left.slots[nleft - 1])
+        keys = self._read(node.slots, 0, node.nkeys)
+        if node.is_leaf:
+            others = self._read(self._others(node), 0, node.nkeys)
+            moved = self._read(self._others(left), nleft - 1, nleft)
+            self._store(left, nleft - 1, [], nleft - 1, [])
+            self._store(node, 0, [left_key] + keys, 0, moved + others)
+            # The parent's key is a copy of node's new first key.
+            mm.decref(parent.slots[i - 1])
+            mm.incref(left_key)
+        else:
+            others = self._read(self._others(node), 0, node.nkeys + 1)
+            moved = self._read(self._others(left), nleft, nleft + 1)
+            self._store(left, nleft - 1, [], nleft, [])
+            self._store(node, 0, [mm.otuple(parent.slots[i - 1])] + keys,
+                        0, moved + others)
+        self._put(parent.slots, i - 1, left_key)
+
+    def _take_from_right(self, parent, i, node, right):
+        mm = self.__manager__
+        nright = right.nkeys
+        keys = self._read(right.slots, 0, nright)
+        nkeys = node.nkeys
+        if node.is_leaf:
+            others = self._read(self._others(right), 0, nright)
+            self._store(node, nkeys, keys[:1], nkeys, others[:1])
+            self._store(right, 0, keys[1:], 0, others[1:])
+            # The parent's key is a copy of right's new first key.
+            mm.decref(parent.slots[i])
+            mm.incref(keys[1])
+            self._put(parent.slots, i, keys[1])
+        else:
+            others = self._read(self._others(right), 0, nright + 1)
+            self._store(node, nkeys, [mm.otuple(parent.slots[i])],
+                        nkeys + 1, others[:1])
+            self._store(right, 0, keys[1:], 0, others[1:])
+            self._put(parent.slots, i, keys[0])
+
+    def _merge(self, parent, i, left, right):
+        """Merge right, child i + 1 of parent, into left, child i."""
+        mm = self.__manager__
+        children = self._others(parent)
+        right_oid = mm.otuple(children[i + 1])
+        nleft = left.nkeys
+        nright = right.nkeys
+        keys = self._read(right.slots, 0, nright)
+        if left.is_leaf:
+            self._store(left, nleft, keys, nleft,
+                        self._read(self._others(right), 0, nright))
+            self._set_next(left, mm.otuple(right.next))
+            # The parent's key was a copy.
+            mm.decref(parent.slots[i])
+        else:
+            # The parent's key moves down between the two halves.
+            self._store(left, nleft, [mm.otuple(parent.slots[i])] + keys,
+                        nleft + 1, self._read(self._others(right), 0,
+                                              nright + 1))
+        nparent = parent.nkeys
+        self._store(parent, i, self._read(parent.slots, i + 1, nparent),
+                    i + 1, self._read(children, i + 2, nparent + 1))
+        mm.free(right_oid)
+
+    # Methods and properties needed to implement the ABC required methods.
+
+    def __getitem__(self, key):
+        leaf, i = self._find(key)
+        if leaf is None:
+            raise KeyError(key)
+        return self.__manager__.resurrect(self._others(leaf)[i])
+
+    def __setitem__(self, key, value):
+        mm = self.__manager__
+        path = self._descend(key) if self._body.size else None
+        with mm.transaction():
+            v_oid = mm.persist(value)
+            mm.incref(v_oid)
+            if path is not None:
+                _, leaf, i = path[-1]
+                if (i < leaf.nkeys and
+                        not key < mm.resurrect(leaf.slots[i])):
+                    values = self._others(leaf)
+                    old_oid = mm.otuple(values[i])
+                    self._put(values, i, v_oid)
+                    mm.xdecref(old_oid)
+                    return
+            self._v_changes += 1
+            k_oid = mm.persist(key)
+            mm.incref(k_oid)
+            if path is None:
+                leaf_oid, leaf = self._new_node(is_leaf=True)
+                self._store(leaf, 0, [k_oid], 0, [v_oid], new=True)
+                self._set_header(1, leaf_oid)
+            else:
+                self._insert(path, k_oid, v_oid)
+                self._set_header(self._body.size + 1,
+                                 mm.otuple(self._body.root))
+
+    def __delitem__(self, key):
+        mm = self.__manager__
+        if self._body.size == 0:
+            raise KeyError(key)
+        path = self._descend(key)
+        _, leaf, i = path[-1]
+        if i >= leaf.nkeys or key < mm.resurrect(leaf.slots[i]):
+            raise KeyError(key)
+        self._v_changes += 1
+        with mm.transaction():
+            k_oid = mm.otuple(leaf.slots[i])
+            v_oid = mm.otuple(self._others(leaf)[i])
+            self._remove(path)
+            self._set_header(self._body.size - 1, mm.otuple(self._body.root))
+            mm.decref(k_oid)
+            mm.xdecref(v_oid)
+
+    def __iter__(self):
+        resurrect = self.__manager__.resurrect
+        for leaf, i in self._scan():
+            yield resurrect(leaf.slots[i])
+
+    def __len__(self):
+        return self._body.size
+
+    # Additional mapping methods not provided by the ABC.
+
+    def __contains__(self, key):
+        return self._find(key)[0] is not None
+
+    @recursive_repr()
+    def __repr__(self):
+        return "{}({{{}}})".format(self.__class__.__name__,
+                                   ', '.join("{!r}: {!r}".format(k, v)
+                                             for k, v in self.items()))
+
+    def clear(self):
+        mm = self.__manager__
+        if self._body.root.off == 0:
+            return
+        self._v_changes += 1
+        with mm.transaction():
+            oids = [mm.otuple(oid) for oid in self._traverse()]
+            nodes = [oid for oid, node in self._nodes()]
+            # Empty the header before decrefing so that a cycle leading back
+            # here finds an empty tree.
+            self._set_header(0, mm.OID_NULL)
+            for oid in oids:
+                mm.xdecref(oid)
+            for oid in nodes:
+                mm.free(oid)
+
+    # Sorted mapping methods.
+
+    def irange(self, lo=None, hi=None, inclusive=(True, True)):
+        """Generate the keys from lo to hi, in order.
+
+        A bound of None leaves that end open.  inclusive says whether keys
+        equal to lo and to hi are included.
+        """
+        resurrect = self.__manager__.resurrect
+        for leaf, i in self._scan(lo, hi, inclusive):
+            yield resurrect(leaf.slots[i])
+
+    def irange_items(self, lo=None, hi=None, inclusive=(True, True)):
+        """Generate the (key, value) pairs with keys from lo to hi, in order.
+
+        The bounds are as for irange.
+        """
+        resurrect = self.__manager__.resurrect
+        for leaf, i in self._scan(lo, hi, inclusive):
+            yield resurrect(leaf.slots[i]), resurrect(self._others(leaf)[i])
+
+    def min(self):
+        """Return the smallest key; raise ValueError if the tree is empty."""
+        if self._body.size == 0:
+            raise ValueError("min() of an empty PersistentBTree")
+        leaf = self._end_leaf(self._body.root, last=False)
+        return self.__manager__.resurrect(leaf.slots[0])
+
+    def max(self):
+        """Return the largest key; raise ValueError if the tree is empty."""
+        if self._body.size == 0:
+            raise ValueError("max() of an empty PersistentBTree")
+        leaf = self._end_leaf(self._body.root, last=True)
+        return self.__manager__.resurrect(leaf.slots[leaf.nkeys - 1])
+
+    def ceiling_key(self, key):
+        """Return the smallest key >= key; raise KeyError if there is none.
+        """
+        mm = self.__manager__
+        if self._body.size:
+            _, leaf, i = self._descend(key)[-1]
+            if i == leaf.nkeys and leaf.next.off != 0:
+                # Every key of the next leaf is larger.
+                leaf, i = self._node(leaf.next), 0
+            if i < leaf.nkeys:
+                return mm.resurrect(leaf.slots[i])
+        raise KeyError(key)
+
+    def floor_key(self, key):
+        """Return the largest key <= key; raise KeyError if there is none.
+        """
+        mm = self.__manager__
+        if self._body.size:
+            path = self._descend(key, right=True)
+            _, leaf, i = path[-1]
+            if i > 0:
+                return mm.resurrect(leaf.slots[i - 1])
+            # The largest key of the nearest subtree to the left.
+            for _, node, i in reversed(path[:-1]):
+                if i > 0:
+                    leaf = self._end_leaf(self._others(node)[i - 1],
+                                          last=True)
+                    return mm.resurrect(leaf.slots[leaf.nkeys - 1])
+        raise KeyError(key)
+
+    # Additional methods required by the pmemobj API.
+
+    def _nodes(self):
+        """Generate (oid, node) for every node, parents before children."""
+        mm = self.__manager__
+        if self._body.root.off == 0:
+            return
+        stack = [mm.otuple(self._body.root)]
+        while stack:
+            oid = stack.pop()
+            node = self._node(oid)
+            yield oid, node
+            if not node.is_leaf:
+                stack.extend(self._read(self._others(node), 0,
+                                        node.nkeys + 1))
+
+    def _traverse(self):
+        for oid, node in self._nodes():
+            keys = node.slots
+            for i in range(node.nkeys):
+                yield keys[i]
+            if node.is_leaf:
+                values = self._others(node)
+                for i in range(node.nkeys):
+                    yield values[i]
+
+    def _deallocate(self):
+        self.clear()
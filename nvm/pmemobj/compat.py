@@ -23,3 +23,22 @@ except ImportError:
                 return result
             return wrapper
         return decorating_function
+
+try:
+    int.from_bytes
+except AttributeError:
+    import binascii
+    def int_to_bytes(n):
+        'Return the non-negative int n as little-endian bytes'
+        h = '%x' % n
+        return binascii.unhexlify('0' * (len(h) % 2) + h)[::-1]
+    def int_from_bytes(b):
+        'Return the non-negative int stored in little-endian bytes b'
+        return int(binascii.hexlify(b[::-1]), 16)
+else:
+    def int_to_bytes(n):
+        'Return the non-negative int n as little-endian bytes'
+        return n.to_bytes((n.bit_length() + 7) // 8, 'little')
+    def int_from_bytes(b):
+        'Return the non-negative int stored in little-endian bytes b'
+        return int.from_bytes(b, 'little')
@@ -0,0 +1,87 @@
+from .compat import recursive_repr, abc
+from .hashtable import _HashTable, _phash
+
+from _pmem import ffi    # XXX refactor to make this import unneeded
+
+
+class PersistentDict(_HashTable, abc.MutableMapping):
+    """Persistent version of the 'dict' type.
+
+    Each entry of the hash table holds the key's persistent hash alongside
+    the key and value pointers.  Iteration order is arbitrary.
+    """
+
+    # XXX locking!
+
+    _body_type = 'PDictObject'
+    _entry_type = 'PDictEntry'
+    _has_values = True
+
+    def __init__(self, *args, **kw):
+        if '__manager__' not in kw:
+            raise ValueError("__manager__ is required")
+        mm = self.__manager__ = kw.pop('__manager__')
+        if '_oid' not in kw:
+            with mm.transaction():
+                self._oid = mm.malloc(ffi.sizeof('PDictObject'))
+                ob = ffi.cast('PObject *', mm.direct(self._oid))
+                ob.ob_type = mm._get_type_code(PersistentDict)
+        else:
+            self._oid = kw.pop('_oid')
+        self._body = ffi.cast('PDictObject *', mm.direct(self._oid))
+        if len(args) > 1:
+            raise TypeError("PersistentDict takes at most 1"
+                            " argument, {} given".format(len(args)))
+        if args or kw:
+            self.update(*args, **kw)
+
+    # Methods and properties needed to implement the ABC required methods.
+
+    def __getitem__(self, key):
+        table, i = self._lookup(key, _phash(key))
+        if table is None:
+            raise KeyError(key)
+        return self.__manager__.resurrect(table[i].me_value)
+
+    def __setitem__(self, key, value):
+        mm = self.__manager__
+        h = _phash(key)
+        table, i = self._lookup(key, h)
+        with mm.transaction():
+            v_oid = mm.persist(value)
+            if table is None:
+                self._insert_new(h, mm.persist(key), v_oid)
+            else:
+                entry = table[i]
+                mm.snapshot_range(ffi.addressof(entry, 'me_value'),
+                                  ffi.sizeof('PObjPtr'))
+                old_oid = mm.otuple(entry.me_value)
+                entry.me_value = v_oid
+                mm.incref(v_oid)
+                mm.xdecref(old_oid)
+            self._migrate()
+
+    def __delitem__(self, key):
+        mm = self.__manager__
+        table, i = self._lookup(key, _phash(key))
+        if table is None:
+            raise KeyError(key)
+        with mm.transaction():
+            self._delete_entry(table, i)
+            self._migrate()
+
+    def __iter__(self):
+        mm = self.__manager__
+        for table, i in self._iter_entries():
+            yield mm.resurrect(table[i].me_key)
+
+    # Additional dict methods not provided by the ABC.
+
+    def __contains__(self, key):
+        return self._lookup(key, _phash(key))[0] is not None
+
+    @recursive_repr()
+    def __repr__(self):
+        return "{}({{{}}})".format(self.__class__.__name__,
+                                   ', '.join("{!r}: {!r}".format(k, v)
+                                             for k, v in self.items()))
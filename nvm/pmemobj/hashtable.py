@@ -0,0 +1,361 @@
+import numbers
+import struct
+import zlib
+
+from .pool import POBJPTR_ARRAY_TYPE_NUM
+
+from _pmem import ffi    # XXX refactor to make this import unneeded
+
+# Values of me_hash that mark a slot as never used or as deleted.  _phash
+# never returns them, so any other value means the slot holds an entry.
+EMPTY_HASH = 0
+DUMMY_HASH = 1
+# The table is grown when it would become more than 2/3 full, to a size
+# larger than GROWTH_RATE times the number of entries (as in CPython).
+MIN_SIZE = 8
+GROWTH_RATE = 3
+PERTURB_SHIFT = 5
+# Number of slots of the old table moved to the new one per mutation while
+# an incremental resize is in progress.
+MIGRATE_BATCH = 16
+
+_MASK64 = (1 << 64) - 1
+_HASH_MODULUS = (1 << 61) - 1
+_NONE_HASH = 0x5bd1e995
+_DOUBLE = struct.Struct('<d')
+
+
+def _hash_bytes(b):
+    return zlib.crc32(b) & 0xffffffff | (zlib.adler32(b) & 0xffffffff) << 32
+
+
+def _phash(obj):
+    """Return a hash for obj that is stable across processes.
+
+    The hash is stored in the pool, so unlike hash() it must not depend on
+    PYTHONHASHSEED, the Python version, or the platform.  As with hash(),
+    numbers that compare equal hash equal, as do text and byte strings that
+    are equal on python2.  The stored bytes of a persistent str (see
+    MemoryManager.str_buffer) hash the same as the str.  Raise TypeError for
+    types we can't hash.
+    """
+    if obj is None:
+        h = _NONE_HASH
+    elif isinstance(obj, float) and not obj.is_integer():
+        h = _hash_bytes(_DOUBLE.pack(obj))
+    elif isinstance(obj, (numbers.Integral, float)):
+        h = int(obj) % _HASH_MODULUS
+    elif isinstance(obj, (bytes, memoryview)):
+        h = _hash_bytes(obj)
+    elif hasattr(obj, 'encode'):
+        h = _hash_bytes(obj.encode('utf-8'))
+    else:
+        raise TypeError("Can't compute a persistent hash for {!r}".format(
+                        obj.__class__))
+    h &= _MASK64
+    if h <= DUMMY_HASH:
+        h += DUMMY_HASH + 1
+    return h
+
+
+def _probe(h, mask):
+    """Generate the slot indexes to try for hash h, CPython style."""
+    i = h & mask
+    perturb = h
+    while True:
+        yield i
+        perturb >>= PERTURB_SHIFT
+        i = (i * 5 + perturb + 1) & mask
+
+
+class _HashTable(object):
+    """Open addressing hash table shared by the persistent dict and set.
+
+    Each entry holds the key's persistent hash alongside the key pointer (and
+    the value pointer, for a dict), so that a lookup only resurrects keys
+    whose hash matches.  When the table needs to grow, a new table is
+    allocated and the entries are moved to it a few slots per mutation, so no
+    single operation pays for the whole resize.
+
+    Subclasses set _body_type and _entry_type to the C types of their object
+    and of their table entries, and _has_values to say whether entries have
+    an me_value field.  The object type must have the fields of PDictObject.
+    """
+
+    _body_type = None
+    _entry_type = None
+    _has_values = False
+
+    def _table(self, oid):
+        mm = self.__manager__
+        oid = mm.otuple(oid)
+        if oid == mm.OID_NULL:
+            return None
+        return ffi.cast(self._entry_type + ' *', mm.direct(oid))
+
+    def _tables(self):
+        """Return (table, mask, first_slot) for the tables that hold entries.
+
+        While a resize is in progress the slots of the old table before
+        ma_migrated have all been moved to the new table.
+        """
+        body = self._body
+        tables = []
+        old = self._table(body.ma_oldtable)
+        if old is not None:
+            tables.append((old, body.ma_oldmask, body.ma_migrated))
+        table = self._table(body.ma_table)
+        if table is not None:
+            tables.append((table, body.ma_mask, 0))
+        return tables
+
+    def _lookup(self, key, h):
+        """Return (table, index) of the entry for key, or (None, -1)."""
+        mm = self.__manager__
+        for table, mask, _ in self._tables():
+            for i in _probe(h, mask):
+                entry = table[i]
+                entry_hash = entry.me_hash
+                if entry_hash == EMPTY_HASH:
+                    break
+                if entry_hash == h and mm.equals(entry.me_key, key):
+                    return table, i
+        return None, -1
+
+    @staticmethod
+    def _free_slot(table, mask, h, claimed=()):
+        """Return (index, was_empty) of the first unused slot for h.
+
+        Slots in claimed are treated as used.
+        """
+        for i in _probe(h, mask):
+            if i in claimed:
+                continue
+            entry_hash = table[i].me_hash
+            if entry_hash == EMPTY_HASH:
+                return i, True
+            if entry_hash == DUMMY_HASH:
+                return i, False
+
+    def _entry_size(self):
+        return ffi.sizeof(self._entry_type)
+
+    def _snapshot_header(self, first_field):
+        """Snapshot the header fields from first_field to the end."""
+        offset = ffi.offsetof(self._body_type, first_field)
+        self.__manager__.snapshot_range(
+            ffi.addressof(self._body, first_field),
+            ffi.sizeof(self._body_type) - offset)
+
+    def _clear_entry(self, entry):
+        mm = self.__manager__
+        entry.me_hash = DUMMY_HASH
+        entry.me_key = mm.OID_NULL
+        if self._has_values:
+            entry.me_value = mm.OID_NULL
+
+    def _insert_new(self, h, k_oid, v_oid=None):
+        """Store a new entry; the key must not already be in the table."""
+        mm = self.__manager__
+        body = self._body
+        if (body.ma_fill + 1) * 3 > (body.ma_mask + 1) * 2:
+            self._start_resize()
+        table = self._table(body.ma_table)
+        i, was_empty = self._free_slot(table, body.ma_mask, h)
+        mm.snapshot_range(ffi.addressof(table, i), self._entry_size())
+        entry = table[i]
+        entry.me_hash = h
+        entry.me_key = k_oid
+        mm.incref(k_oid)
+        if self._has_values:
+            entry.me_value = v_oid
+            mm.incref(v_oid)
+        mm.snapshot_range(ffi.addressof(body, 'ma_used'),
+                          2 * ffi.sizeof('size_t'))
+        body.ma_used += 1
+        if was_empty:
+            body.ma_fill += 1
+
+    def _bulk_insert(self, entries):
+        """Store new entries from a list of (hash, key_oid, value_oid).
+
+        The keys must be distinct and not already be in the table.  If the
+        table has to grow it is rebuilt in one go; otherwise the slots are
+        chosen first, so that the table is snapshotted with a single range.
+        """
+        mm = self.__manager__
+        body = self._body
+        if not entries:
+            return
+        count = len(entries)
+        fresh = False
+        if (mm.otuple(body.ma_oldtable) != mm.OID_NULL or
+                (body.ma_fill + count) * 3 > (body.ma_mask + 1) * 2):
+            self._rebuild(body.ma_used + count)
+            fresh = True
+        table = self._table(body.ma_table)
+        mask = body.ma_mask
+        slots = []
+        claimed = set()
+        filled = 0
+        for h, _, _ in entries:
+            i, was_empty = self._free_slot(table, mask, h, claimed)
+            claimed.add(i)
+            slots.append(i)
+            filled += was_empty
+        if not fresh:
+            # Memory allocated in this transaction needs no snapshot.
+            lo, hi = min(claimed), max(claimed)
+            mm.snapshot_range(ffi.addressof(table, lo),
+                              (hi - lo + 1) * self._entry_size())
+        for i, (h, k_oid, v_oid) in zip(slots, entries):
+            entry = table[i]
+            entry.me_hash = h
+            entry.me_key = k_oid
+            mm.incref(k_oid)
+            if self._has_values:
+                entry.me_value = v_oid
+                mm.incref(v_oid)
+        mm.snapshot_range(ffi.addressof(body, 'ma_used'),
+                          2 * ffi.sizeof('size_t'))
+        body.ma_used += count
+        body.ma_fill += filled
+
+    def _rebuild(self, count):
+        """Move all entries to a new table with room for count entries."""
+        mm = self.__manager__
+        body = self._body
+        newsize = MIN_SIZE
+        while count * 3 >= newsize * 2:
+            newsize <<= 1
+        new_oid = mm.malloc(newsize * self._entry_size(),
+                            type_num=POBJPTR_ARRAY_TYPE_NUM)
+        table = ffi.cast(self._entry_type + ' *', mm.direct(new_oid))
+        mask = newsize - 1
+        # The old tables are freed rather than modified, so they need no
+        # snapshot either.
+        for old, i in self._iter_entries():
+            table[self._free_slot(table, mask, old[i].me_hash)[0]] = old[i]
+        old_tables = [mm.otuple(body.ma_table), mm.otuple(body.ma_oldtable)]
+        self._snapshot_header('ma_fill')
+        body.ma_fill = body.ma_used
+        body.ma_mask = mask
+        body.ma_table = new_oid
+        body.ma_oldtable = mm.OID_NULL
+        body.ma_oldmask = body.ma_migrated = 0
+        for oid in old_tables:
+            if oid != mm.OID_NULL:
+                mm.free(oid)
+
+    def _start_resize(self):
+        mm = self.__manager__
+        body = self._body
+        # Only one resize can be in progress; finish any earlier one.
+        self._migrate(None)
+        newsize = MIN_SIZE
+        while newsize <= body.ma_used * GROWTH_RATE:
+            newsize <<= 1
+        new_table = mm.malloc(newsize * self._entry_size(),
+                              type_num=POBJPTR_ARRAY_TYPE_NUM)
+        self._snapshot_header('ma_fill')
+        old_table = mm.otuple(body.ma_table)
+        if old_table == mm.OID_NULL:
+            body.ma_table = new_table
+        else:
+            body.ma_oldtable = old_table
+            body.ma_oldmask = body.ma_mask
+            body.ma_migrated = 0
+            body.ma_table = new_table
+        body.ma_mask = newsize - 1
+        body.ma_fill = 0
+
+    def _migrate(self, count=MIGRATE_BATCH):
+        """Move the next count slots (all if None) of the old table."""
+        mm = self.__manager__
+        body = self._body
+        old = self._table(body.ma_oldtable)
+        if old is None:
+            return
+        size = body.ma_oldmask + 1
+        start = body.ma_migrated
+        stop = size if count is None else min(size, start + count)
+        table = self._table(body.ma_table)
+        mask = body.ma_mask
+        mm.snapshot_range(ffi.addressof(old, start),
+                          (stop - start) * self._entry_size())
+        filled = 0
+        for j in range(start, stop):
+            entry = old[j]
+            if entry.me_hash <= DUMMY_HASH:
+                continue
+            # The references move with the entry, so no refcount changes.
+            i, was_empty = self._free_slot(table, mask, entry.me_hash)
+            mm.snapshot_range(ffi.addressof(table, i), self._entry_size())
+            table[i] = entry
+            filled += was_empty
+            self._clear_entry(entry)
+        self._snapshot_header('ma_fill')
+        body.ma_fill += filled
+        if stop == size:
+            mm.free(body.ma_oldtable)
+            body.ma_oldtable = mm.OID_NULL
+            body.ma_oldmask = 0
+            body.ma_migrated = 0
+        else:
+            body.ma_migrated = stop
+
+    def _delete_entry(self, table, i):
+        """Remove the entry at table[i] and decref its references."""
+        mm = self.__manager__
+        entry = table[i]
+        mm.snapshot_range(ffi.addressof(table, i), self._entry_size())
+        oids = [mm.otuple(entry.me_key)]
+        if self._has_values:
+            oids.append(mm.otuple(entry.me_value))
+        self._clear_entry(entry)
+        mm.snapshot_range(ffi.addressof(self._body, 'ma_used'),
+                          ffi.sizeof('size_t'))
+        self._body.ma_used -= 1
+        for oid in oids:
+            mm.xdecref(oid)
+
+    def _iter_entries(self):
+        """Generate (table, index) for each entry in the table."""
+        for table, mask, first in self._tables():
+            for i in range(first, mask + 1):
+                if table[i].me_hash > DUMMY_HASH:
+                    yield table, i
+
+    def __len__(self):
+        return self._body.ma_used
+
+    def clear(self):
+        mm = self.__manager__
+        body = self._body
+        if body.ma_used == 0 and body.ma_fill == 0:
+            return
+        with mm.transaction():
+            oids = [mm.otuple(oid) for oid in self._traverse()]
+            tables = [mm.otuple(body.ma_table), mm.otuple(body.ma_oldtable)]
+            # Empty the header before decrefing so that a cycle leading back
+            # here finds an empty table.
+            self._snapshot_header('ma_used')
+            body.ma_used = body.ma_fill = body.ma_mask = 0
+            body.ma_oldmask = body.ma_migrated = 0
+            body.ma_table = body.ma_oldtable = mm.OID_NULL
+            for oid in oids:
+                mm.xdecref(oid)
+            for oid in tables:
+                if oid != mm.OID_NULL:
+                    mm.free(oid)
+
+    # Additional methods required by the pmemobj API.
+
+    def _traverse(self):
+        for table, i in self._iter_entries():
+            yield table[i].me_key
+            if self._has_values:
+                yield table[i].me_value
+
+    def _deallocate(self):
+        self.clear()
@@ -6,12 +6,34 @@ from _pmem import ffi    # XXX refactor to make this import unneeded
 
 
 class PersistentList(abc.MutableSequence):
-    """Persistent version of the 'list' type."""
+    """Persistent version of the 'list' type.
+
+    Slices can be read, assigned and deleted.  Reading one reads the oids of
+    the range in one block and returns a normal list, so its items are
+    resurrected at once rather than lazily: the slice is a copy, which must
+    not depend on this list's references to keep its items alive.
+    Assigning or deleting one is a single transaction that resizes the list
+    once and moves the items after the slice in one block; insert and
+    deleting an item work the same way.  extend and append are slice
+    assignments at the end of the list, so building a list with extend costs
+    one transaction however many items it gets.  sort and reverse work out
+    the new order in memory and write the reordered pointers back in one
+    block.
+    """
 
     # XXX locking!
     # XXX All bookkeeping attrs should be _v_xxxx so that all other attrs
     #     (other than __manager__) can be made persistent.
 
+    _body_type = 'PListObject'
+    # The number of oids a scan of the list reads at a time.
+    _scan_batch = 256
+    # The items pointer, cached under the offset of the ob_items it was made
+    # from, and a count of the changes made to the list, which tells scans
+    # to read the oids again.
+    _v_items = (0, None)
+    _v_changes = 0
+
     def __init__(self, *args, **kw):
         if '__manager__' not in kw:
             raise ValueError("__manager__ is required")
@@ -45,14 +67,23 @@ class PersistentList(abc.MutableSequence):
 
     @property
     def _items(self):
-        mm = self.__manager__
-        ob_items = mm.otuple(self._body.ob_items)
-        if ob_items == mm.OID_NULL:
-            return None
-        return ffi.cast('PObjPtr *', mm.direct(ob_items))
+        # Checking the offset also catches ob_items being restored by an
+        # aborted transaction.
+        off = self._body.ob_items.off
+        cached_off, items = self._v_items
+        if off != cached_off:
+            if off == 0:
+                items = None
+            else:
+                items = ffi.cast('PObjPtr *',
+                                 self.__manager__.direct(self._body.ob_items))
+            self._v_items = off, items
+        return items
 
     def _resize(self, newsize):
         mm = self.__manager__
+        self._v_changes += 1
+        self._v_items = (0, None)
         allocated = self._allocated
         # Only realloc if we don't have enough space already.
         if (allocated >= newsize and newsize >= allocated >> 1):
@@ -79,66 +110,186 @@ class PersistentList(abc.MutableSequence):
             ffi.cast('PVarObject *', self._body).ob_size = newsize
 
     def insert(self, index, value):
-        mm = self.__manager__
+        # As for list.insert, an index past either end is clamped to it,
+        # just like the bounds of a slice.
+        self._setslice(slice(index, index), (value,))
+
+    def append(self, value):
+        self.extend((value,))
+
+    def extend(self, values):
         size = self._size
-        newsize = size + 1
-        with mm.transaction():
-            self._resize(newsize)
-            if index < 0:
-                index += size
-                if index < 0:
-                    index = 0
-            if index > size:
-                index = size
-            items = self._items
-            mm.snapshot_range(items + index,
-                              ffi.offsetof('PObjPtr *', newsize))
-            for i in range(size, index, -1):
-                items[i] = items[i-1]
-            v_oid = mm.persist(value)
-            mm.incref(v_oid)
-            items[index] = v_oid
+        self._setslice(slice(size, size), values)
 
     def _normalize_index(self, index):
         try:
             index = int(index)
         except TypeError:
-            # Assume it is a slice
-            # XXX fixme
-            raise NotImplementedError("Slicing not yet implemented")
+            raise TypeError("list indices must be integers or slices, not"
+                            " {}".format(index.__class__.__name__))
         if index < 0:
             index += self._size
         if index < 0 or index >= self._size:
             raise IndexError(index)
         return index
 
+    def _read_oids(self, start, stop):
+        """Return the oids of items start to stop - 1, as tuples."""
+        if start >= stop:
+            return []
+        # Each PObjPtr is two uint64_ts, so the block can be unpacked as those.
+        words = ffi.unpack(ffi.cast('uint64_t *', self._items + start),
+                           2 * (stop - start))
+        return list(zip(words[0::2], words[1::2]))
+
+    def _slice_oids(self, index):
+        """Return the oids of the items selected by the slice index.
+
+        The oids from the lowest index to the highest are read in one block.
+        """
+        indexes = range(*index.indices(self._size))
+        if not len(indexes):
+            return []
+        lo = min(indexes[0], indexes[-1])
+        oids = self._read_oids(lo, max(indexes[0], indexes[-1]) + 1)
+        return [oids[i - lo] for i in indexes]
+
+    def _iter_oids(self, start=0, reverse=False):
+        """Generate the oids of the items from start on, as tuples.
+
+        The oids are read a batch at a time.  If the list is changed while
+        the generator is suspended, it goes on from the same index of the
+        changed list, as a list iterator does.
+        """
+        i = start
+        step = -1 if reverse else 1
+        while 0 <= i < self._size:
+            changes = self._v_changes
+            if reverse:
+                oids = reversed(self._read_oids(
+                    max(0, i - self._scan_batch + 1), i + 1))
+            else:
+                oids = self._read_oids(
+                    i, min(self._size, i + self._scan_batch))
+            for oid in oids:
+                yield oid
+                i += step
+                if self._v_changes != changes:
+                    break
+
+    def _setslice(self, index, values):
+        mm = self.__manager__
+        self._v_changes += 1
+        size = self._size
+        start, stop, step = index.indices(size)
+        # values may be (or depend on) this list, so copy it first.
+        values = list(values)
+        if step != 1:
+            indexes = range(start, stop, step)
+            if len(values) != len(indexes):
+                raise ValueError("attempt to assign sequence of size {} to"
+                                 " extended slice of size {}".format(
+                                 len(values), len(indexes)))
+            if not values:
+                return
+            lo = min(indexes[0], indexes[-1])
+            hi = max(indexes[0], indexes[-1]) + 1
+            with mm.transaction():
+                new_oids = [mm.persist(value) for value in values]
+                items = self._items
+                mm.snapshot_range(items + lo,
+                                  (hi - lo) * ffi.sizeof('PObjPtr'))
+                for i, oid in zip(indexes, new_oids):
+                    mm.xdecref(items[i])
+                    items[i] = oid
+                    mm.incref(oid)
+            return
+        stop = max(start, stop)
+        newsize = size - (stop - start) + len(values)
+        if start == stop and not values:
+            return
+        with mm.transaction():
+            new_oids = [mm.persist(value) for value in values]
+            old_oids = self._read_oids(start, stop)
+            allocated = self._allocated
+            if newsize > size:
+                self._resize(newsize)
+            items = self._items
+            # Every slot from start to the larger of the two ends changes.
+            # Those past the old end must be in the transaction too, or they
+            # would not be flushed when it commits; but if the items were
+            # just reallocated, they are new memory that the commit flushes
+            # anyway.
+            end = max(size, newsize)
+            if end > start and self._allocated == allocated:
+                mm.snapshot_range(items + start,
+                                  (end - start) * ffi.sizeof('PObjPtr'))
+            if stop - start != len(values) and size > stop:
+                ffi.memmove(items + start + len(values), items + stop,
+                            (size - stop) * ffi.sizeof('PObjPtr'))
+            if new_oids:
+                ffi.memmove(items + start, ffi.new('PObjPtr[]', new_oids),
+                            len(new_oids) * ffi.sizeof('PObjPtr'))
+            for oid in new_oids:
+                mm.incref(oid)
+            for oid in old_oids:
+                mm.xdecref(oid)
+            if newsize < size:
+                self._resize(newsize)
+
+    def _delslice(self, index):
+        mm = self.__manager__
+        size = self._size
+        indexes = range(*index.indices(size))
+        if not len(indexes):
+            return
+        if indexes[0] > indexes[-1]:
+            indexes = indexes[::-1]
+        lo = indexes[0]
+        with mm.transaction():
+            items = self._items
+            mm.snapshot_range(items + lo, (size - lo) * ffi.sizeof('PObjPtr'))
+            for i in indexes:
+                mm.xdecref(items[i])
+            # Move each run of kept items down over the gaps in one block.
+            dest = lo
+            for i, next_i in zip(indexes, list(indexes[1:]) + [size]):
+                run = next_i - i - 1
+                if run:
+                    ffi.memmove(items + dest, items + i + 1,
+                                run * ffi.sizeof('PObjPtr'))
+                    dest += run
+            self._resize(size - len(indexes))
+
     def __setitem__(self, index, value):
         mm = self.__manager__
+        if isinstance(index, slice):
+            self._setslice(index, value)
+            return
         index = self._normalize_index(index)
+        self._v_changes += 1
         items = self._items
         with mm.transaction():
             v_oid = mm.persist(value)
             mm.snapshot_range(ffi.addressof(items, index),
-                              ffi.sizeof('PObjPtr *'))
+                              ffi.sizeof('PObjPtr'))
             mm.xdecref(items[index])
             items[index] = v_oid
             mm.incref(v_oid)
 
     def __delitem__(self, index):
-        mm = self.__manager__
+        if isinstance(index, slice):
+            self._delslice(index)
+            return
         index = self._normalize_index(index)
-        size = self._size
-        newsize = size - 1
-        items = self._items
-        with mm.transaction():
-            mm.snapshot_range(ffi.addressof(items, index),
-                              ffi.offsetof('PObjPtr *', size))
-            mm.decref(items[index])
-            for i in range(index, newsize):
-                items[i] = items[i+1]
-            self._resize(newsize)
+        self._delslice(slice(index, index + 1))
 
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            # Not lazy: a view holding the oids would have nothing keeping
+            # them alive once this list changed.
+            resurrect = self.__manager__.resurrect
+            return [resurrect(oid) for oid in self._slice_oids(index)]
         index = self._normalize_index(index)
         items = self._items
         return self.__manager__.resurrect(items[index])
@@ -146,26 +297,101 @@ class PersistentList(abc.MutableSequence):
     def __len__(self):
         return self._size
 
+    def __iter__(self):
+        resurrect = self.__manager__.resurrect
+        for oid in self._iter_oids():
+            yield resurrect(oid)
+
+    def __reversed__(self):
+        resurrect = self.__manager__.resurrect
+        for oid in self._iter_oids(self._size - 1, reverse=True):
+            yield resurrect(oid)
+
+    # Searches and comparisons use the manager's equals, which matches a
+    # persistent value by its oid and a str or int by its stored bytes before
+    # resorting to resurrecting the item.
+
+    def __contains__(self, value):
+        equals = self.__manager__.equals
+        return any(equals(oid, value) for oid in self._iter_oids())
+
+    def index(self, value, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self._size)
+        equals = self.__manager__.equals
+        for i, oid in enumerate(self._iter_oids(start), start):
+            if i >= stop:
+                break
+            if equals(oid, value):
+                return i
+        raise ValueError("{!r} is not in list".format(value))
+
+    def count(self, value):
+        equals = self.__manager__.equals
+        return sum(1 for oid in self._iter_oids() if equals(oid, value))
+
+    def _reorder(self, oids):
+        """Write oids, a reordering of the items, over the items array.
+
+        The list holds the same references afterward, so no refcounts
+        change.
+        """
+        mm = self.__manager__
+        self._v_changes += 1
+        items = self._items
+        nbytes = len(oids) * ffi.sizeof('PObjPtr')
+        with mm.transaction():
+            mm.snapshot_range(items, nbytes)
+            ffi.memmove(items, ffi.new('PObjPtr[]', oids), nbytes)
+
+    def reverse(self):
+        size = self._size
+        if size > 1:
+            self._reorder(self._read_oids(0, size)[::-1])
+
     # Additional list methods not provided by the ABC.
 
+    def sort(self, key=None, reverse=False):
+        size = self._size
+        if size < 2:
+            return
+        oids = self._read_oids(0, size)
+        changes = self._v_changes
+        resurrect = self.__manager__.resurrect
+        keys = [resurrect(oid) for oid in oids]
+        if key is not None:
+            keys = [key(k) for k in keys]
+        order = sorted(range(size), key=keys.__getitem__, reverse=reverse)
+        if self._v_changes != changes:
+            raise ValueError("list modified during sort")
+        self._reorder([oids[i] for i in order])
+
     @recursive_repr()
     def __repr__(self):
         return "{}([{}])".format(self.__class__.__name__,
                                  ', '.join("{!r}".format(x) for x in self))
 
     def __eq__(self, other):
+        mm = self.__manager__
+        if (isinstance(other, PersistentList) and
+                other.__manager__ is mm):
+            if self._size != other._size:
+                return False
+            oids_equal = mm.oids_equal
+            return all(oids_equal(oid, other_oid) for oid, other_oid
+                       in zip(self._iter_oids(), other._iter_oids()))
         try:
             ol = len(other)
-        except AttributeError:
+        except (AttributeError, TypeError):
             return NotImplemented
         if len(self) != ol:
             return False
-        for i in range(len(self)):
+        equals = mm.equals
+        for i, oid in enumerate(self._iter_oids()):
             try:
                 ov = other[i]
             except (AttributeError, IndexError):
                 return NotImplemented
-            if self[i] != ov:
+            if not equals(oid, ov):
                 return False
         return True
 
@@ -1,14 +1,20 @@
+import bisect
 import collections
 import errno
 if not hasattr(errno, 'ECANCELED'):
     errno.ECANCELED = 125  # 2.7 errno doesn't define this, so guess.
 import logging
 import os
+import struct
 import sys
+from multiprocessing.pool import ThreadPool
 from pickle import whichmodule
-from threading import RLock
+from threading import Event, RLock, Thread
+import time
+import weakref
 
 from _pmem import lib, ffi
+from .compat import int_from_bytes, int_to_bytes
 from .list import PersistentList
 
 log = logging.getLogger('nvm.pmemobj')
@@ -18,13 +24,64 @@ tlog = logging.getLogger('nvm.pmemobj.trace')
 # version as the layout will allow us to provide backward compatibility.
 layout_info = (0, 0, 1)
 layout_version = 'pypmemobj-{}.{}.{}'.format(*layout_info).encode()
+# Changes to how objects are encoded within that layout are numbered, and
+# the revision a pool was written with is kept in its root.  Opening a pool
+# with an older revision upgrades it in place, using the _upgrade_to_<N>
+# methods of PersistentObjectPool.  Pools from before revisions were
+# recorded read as revision 0.
+LAYOUT_REVISION = 3
 
 MIN_POOL_SIZE = lib.PMEMOBJ_MIN_POOL
 MAX_OBJ_SIZE = lib.PMEMOBJ_MAX_ALLOC_SIZE
 OID_NULL = (lib.OID_NULL.pool_uuid_lo, lib.OID_NULL.off)
+# Default number of immutable objects MemoryManager keeps resurrected.
+OBJ_CACHE_SIZE = 10000
+# The number of allocations _catalog asks the C helper for at a time.
+_CATALOG_BATCH = 4096
+# The number of references _referents asks the C helper for at a time.
+_REFS_BATCH = 4096
+# The number of containers gc gives a mark thread at a time.
+_MARK_CHUNK = 1024
+# Objects allocated since the last full collection are in one of this many
+# young generations; the rest are old.  See PersistentObjectPool.gc.
+YOUNG_GENERATIONS = 2
+# The most objects the oldest young generation holds.  Past that, it is
+# promoted to old, so that only collecting the younger generations doesn't
+# keep a set of every object that survived them.
+OLDEST_YOUNG_LIMIT = 100000
 # Arbitrary numbers.
 POBJECT_TYPE_NUM = 20
 POBJPTR_ARRAY_TYPE_NUM = 21
+BLOB_CHUNK_TYPE_NUM = 22
+BTREE_NODE_TYPE_NUM = 23
+
+# PStrObject ob_flags bits.
+PSTR_ASCII = 1
+
+# Small immutable values are stored in the PObjPtr itself instead of in an
+# allocated object: pool_uuid_lo holds one of these tags, which no real pool
+# uuid will realistically have, and off holds the value's 64 bits.  None is
+# OID_NULL.
+TAG_INT = 1
+TAG_FLOAT = 2
+TAG_BOOL = 3
+_TAGS = frozenset((TAG_INT, TAG_FLOAT, TAG_BOOL))
+
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+_UINT64 = struct.Struct('<Q')
+_DOUBLE = struct.Struct('<d')
+_INT_TYPES = (int, type(1 << 64))
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# The layouts, by _body_type, of the containers whose references the C
+# helper used by gc can read.  Other containers are traversed in python.
+_REF_LAYOUTS = {
+    'PListObject': lib.PYNVM_REFS_LIST,
+    'PDictObject': lib.PYNVM_REFS_DICT,
+    'PSetObject': lib.PYNVM_REFS_SET,
+    }
 
 
 # XXX move this to a central location and use in all libraries.
@@ -64,6 +121,71 @@ def _check_null(value):
         _raise_per_errno()
     return value
 
+def _readonly_view(ptr, size):
+    """Return a memoryview of size bytes at ptr, read-only if possible."""
+    view = memoryview(ffi.buffer(ptr, size))
+    # toreadonly is new in python 3.8.
+    return view.toreadonly() if hasattr(view, 'toreadonly') else view
+
+def _catalog(pool_ptr, cursor=OID_NULL, limit=None):
+    """Catalog the allocations in a pool, starting at cursor.
+
+    Start at the first allocation if cursor is OID_NULL, and stop after
+    limit of them if limit is not None.  Return lists of the oids, their
+    pmemobj type numbers, and for PObjects their ob_type and ob_refcnt (0
+    for other allocations), followed by the oid of the next allocation
+    (OID_NULL if there are none left).  The heap is walked by a C helper,
+    which fills arrays with up to _CATALOG_BATCH allocations per call.
+    """
+    batch = _CATALOG_BATCH if limit is None else min(limit, _CATALOG_BATCH)
+    c_cursor = ffi.new('PMEMoid *', cursor)
+    c_oids = ffi.new('PMEMoid[]', batch)
+    c_type_nums = ffi.new('uint64_t[]', batch)
+    c_ob_types = ffi.new('size_t[]', batch)
+    c_refcnts = ffi.new('size_t[]', batch)
+    # Each PMEMoid is two uint64_ts, so the oids can be unpacked as those.
+    c_oid_words = ffi.cast('uint64_t *', c_oids)
+    oids, type_nums, ob_types, refcnts = [], [], [], []
+    while True:
+        n = lib.pynvm_obj_catalog(pool_ptr, c_cursor, POBJECT_TYPE_NUM,
+                                  c_oids, c_type_nums, c_ob_types, c_refcnts,
+                                  batch)
+        words = ffi.unpack(c_oid_words, 2 * n)
+        oids.extend(zip(words[0::2], words[1::2]))
+        type_nums.extend(ffi.unpack(c_type_nums, n))
+        ob_types.extend(ffi.unpack(c_ob_types, n))
+        refcnts.extend(ffi.unpack(c_refcnts, n))
+        cursor = (c_cursor.pool_uuid_lo, c_cursor.off)
+        if cursor == OID_NULL:
+            break
+        if limit is not None:
+            if len(oids) >= limit:
+                break
+            batch = min(batch, limit - len(oids))
+    return oids, type_nums, ob_types, refcnts, cursor
+
+def _referents(oids, layouts):
+    """Return the references held by the containers oids, as tuples.
+
+    layouts gives the _REF_LAYOUTS value for each container.  The containers
+    are read by a C helper, with the GIL released, so several threads can
+    run this at once.  NULL references are left out.
+    """
+    n = len(oids)
+    c_oids = ffi.new('PMEMoid[]', oids)
+    c_layouts = ffi.new('int[]', layouts)
+    c_index = ffi.new('size_t *')
+    c_slot = ffi.new('size_t *')
+    c_refs = ffi.new('PMEMoid[]', _REFS_BATCH)
+    c_ref_words = ffi.cast('uint64_t *', c_refs)
+    refs = []
+    while c_index[0] < n:
+        count = lib.pynvm_obj_refs(c_oids, c_layouts, n, c_index, c_slot,
+                                   c_refs, _REFS_BATCH)
+        words = ffi.unpack(c_ref_words, 2 * count)
+        refs.extend(zip(words[0::2], words[1::2]))
+    return refs
+
 def _check_errno(errno):
     """Raise an error if errno is not zero."""
     if errno:
@@ -131,29 +253,43 @@ def _find_class_from_string(cls_string):
     return res
 
 
+CacheInfo = collections.namedtuple(
+    'CacheInfo', 'hits misses evictions maxsize currsize persistent')
+
+
 class _ObjCache(object):
+    """Map oids to the python objects that represent them, and back.
+
+    Persistent objects (those with a __manager__) are held weakly: their
+    state lives in the pool, so they can simply be resurrected again once
+    nothing else refers to them.  Other objects are kept in an LRU of at most
+    maxsize entries, which also lets persist reuse the oid of a recently
+    seen equal immutable.  Entries added during a transaction are kept apart
+    until it commits, so that an abort can drop them.
+    """
 
-    def __init__(self):
-        # XXX WeakValueDictionary?
-        self._resurrect = {}
+    def __init__(self, maxsize=OBJ_CACHE_SIZE):
+        if maxsize < 0:
+            raise ValueError("cache size must not be negative")
+        self.maxsize = maxsize
+        self._weak = weakref.WeakValueDictionary()
+        self._resurrect = collections.OrderedDict()
         self._persist = {}
         self._trans_resurrect = {}
         self._trans_persist = {}
+        self.hits = self.misses = self.evictions = 0
 
     def pkey(self, obj):
         # Use the object as the key if it is immutable (hashable) because we
         # only need to persist one equivalent copy.  For mutables use the
         # object id, since we must persist each instance even if they are
-        # otherwise equal.
+        # otherwise equal.  The LRU holds the object while its id is a key.
         return obj if getattr(obj, '__hash__', None) else id(obj)
 
     def clear(self):
-        # XXX I'm not sure we can get away with mapping OID_NULL
-        # to None here, but try it and see.
+        self._weak.clear()
         self._resurrect.clear()
-        self._resurrect[OID_NULL] = None
         self._persist.clear()
-        self._persist[None] = OID_NULL
         self.clear_transaction_cache()
 
     def clear_transaction_cache(self):
@@ -161,20 +297,38 @@ class _ObjCache(object):
         self._trans_resurrect.clear()
         self._trans_persist.clear()
 
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize,
+                         len(self._resurrect), len(self._weak))
+
     def obj_from_oid(self, oid):
         """Return object cached for oid, or raise KeyError."""
+        if oid == OID_NULL:
+            return None
         try:
             obj = self._trans_resurrect[oid]
             tlog.debug('found in transaction cache: %r %r', oid, obj)
+            self.hits += 1
             return obj
         except KeyError:
             pass
-        obj = self._resurrect[oid]
+        obj = self._resurrect.pop(oid, None)
+        if obj is not None:
+            # Move it to the most recently used end.
+            self._resurrect[oid] = obj
+        else:
+            obj = self._weak.get(oid)
+            if obj is None:
+                self.misses += 1
+                raise KeyError(oid)
         tlog.debug('found in cache: %r %r', oid, obj)
+        self.hits += 1
         return obj
 
     def oid_from_obj(self, obj):
         """Return oid cached for obj, or raise KeyError."""
+        if obj is None:
+            return OID_NULL
         key = self.pkey(obj)
         try:
             oid = self._trans_persist[key]
@@ -187,64 +341,162 @@ class _ObjCache(object):
         return oid
 
     def cache(self, oid, obj, in_transaction=False):
-        key = self.pkey(obj)
-        tlog.debug('caching (in_trasaction=%s) %r %r (key %r)',
-                   in_transaction, oid, obj, key)
+        tlog.debug('caching (in_trasaction=%s) %r %r',
+                   in_transaction, oid, obj)
+        if obj.__class__ is bytearray:
+            # Stored by value but mutable, so neither a cached copy nor the
+            # oid cached for the object would stay in step with the pool.
+            return
+        persistent = hasattr(obj, '__manager__')
         if in_transaction:
             self._trans_resurrect[oid] = obj
-            self._trans_persist[key] = oid
+            if not persistent:
+                self._trans_persist[self.pkey(obj)] = oid
+        elif persistent:
+            # persist uses the object's _oid, so no reverse mapping is
+            # needed (and an id could be reused once the object is gone).
+            self._weak[oid] = obj
         else:
-            self._resurrect[oid] = obj
-            self._persist[key] = oid
+            self._remember(oid, obj)
+
+    def _remember(self, oid, obj):
+        lru = self._resurrect
+        self._forget(oid)
+        lru[oid] = obj
+        self._persist[self.pkey(obj)] = oid
+        while len(lru) > self.maxsize:
+            self._forget(next(iter(lru)))
+            self.evictions += 1
+
+    def _forget(self, oid):
+        obj = self._resurrect.pop(oid, None)
+        if obj is not None:
+            key = self.pkey(obj)
+            if self._persist.get(key) == oid:
+                del self._persist[key]
 
     def cache_transactionally(self, oid, obj):
         self.cache(oid, obj, in_transaction=True)
 
     def commit_transaction_cache(self):
         tlog.debug('committing transaction cache %s', self._trans_resurrect)
-        self._resurrect.update(self._trans_resurrect)
-        self._trans_resurrect.clear()
-        self._persist.update(self._trans_persist)
-        self._trans_persist.clear()
+        for oid, obj in self._trans_resurrect.items():
+            self.cache(oid, obj)
+        self.clear_transaction_cache()
 
     def purge(self, oid):
         if oid in self._trans_resurrect:
-            obj = self._trans_resurrect[oid]
+            obj = self._trans_resurrect.pop(oid)
             tlog.debug('purging %s %s from transaction caches', oid, obj)
-            del self._trans_resurrect[oid]
-            del self._trans_persist[self.pkey(obj)]
-        elif oid in self._resurrect:
-            obj = self._resurrect[oid]
-            tlog.debug('purging %s %s from caches', oid, obj)
-            del self._resurrect[oid]
-            del self._persist[self.pkey(obj)]
-        else:
-            tlog.debug('not in cache: %r', oid)
+            self._trans_persist.pop(self.pkey(obj), None)
+        self._forget(oid)
+        self._weak.pop(oid, None)
+
+
+class _RangeSet(object):
+    """A set of addresses, kept as sorted, disjoint [start, end) ranges."""
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def clear(self):
+        del self._starts[:]
+        del self._ends[:]
+
+    def add(self, start, end):
+        """Add [start, end), returning the parts of it that were not present.
+
+        Ranges that overlap or touch the new one are merged with it.
+        """
+        starts, ends = self._starts, self._ends
+        i = j = bisect.bisect_left(ends, start)
+        missing = []
+        pos = start
+        while j < len(starts) and starts[j] <= end:
+            if starts[j] > pos:
+                missing.append((pos, starts[j]))
+            pos = max(pos, ends[j])
+            j += 1
+        if pos < end:
+            missing.append((pos, end))
+        if i < j:
+            start = min(start, starts[i])
+            end = max(end, ends[j - 1])
+        starts[i:j] = [start]
+        ends[i:j] = [end]
+        return missing
 
 
 class _Transaction(object):
+    """The pool's transaction, with nesting done here rather than by pmemobj.
+
+    Only the outermost begin or __enter__ starts a pmemobj transaction;
+    nested ones just push onto the stack.  As with pmemobj's own nesting, an
+    abort at any level aborts the whole transaction, and the levels above it
+    raise when they end.
+    """
 
     _FREE = 'F'
     _CONTEXT = 'C'
 
-    def __init__(self, pool_ptr, obj_cache):
+    def __init__(self, pool_ptr, obj_cache, before_commit=None,
+                 after_commit=None):
         self.pool_ptr = pool_ptr
         self._obj_cache = obj_cache
+        self._before_commit = before_commit
+        self._after_commit = after_commit
         self._trans_stack = []
+        self._errno = errno.ECANCELED
+        # Net refcount change per oid, the PObjects allocated, the oids
+        # freed, and the address ranges snapshotted, in the current outermost
+        # transaction.  before_commit applies the refcount changes.
+        self.refcount_deltas = {}
+        self.allocated = []
+        self.freed = set()
+        self.snapshots = _RangeSet()
 
     @property
     def depth(self):
         return len(self._trans_stack)
 
+    def _tx_begin(self):
+        self._errno = errno.ECANCELED
+        _check_errno(lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+
+    def _tx_abort(self, errno):
+        self._errno = errno
+        lib.pmemobj_tx_abort(errno)
+
+    def _raise_aborted(self):
+        """Raise the error a nested transaction gets when ending aborted."""
+        ffi.errno = self._errno
+        _raise_per_errno()
+
     def _context_abort(self, msg):
-        lib.pmemobj_tx_abort(errno.ECANCELED)
+        self._tx_abort(errno.ECANCELED)
         raise RuntimeError('Transaction aborted: ' + msg)
 
+    def _clear(self):
+        self.refcount_deltas.clear()
+        del self.allocated[:]
+        self.freed.clear()
+        self.snapshots.clear()
+
+    def _discard(self):
+        self._obj_cache.clear_transaction_cache()
+        self._clear()
+
+    def _committed(self):
+        if self._after_commit is not None:
+            self._after_commit()
+        self._clear()
+
     def begin(self):
         """Start a new (sub)transaction."""
         tlog.debug('start_transaction %s', self._trans_stack)
-        _check_errno(
-            lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        if not self._trans_stack:
+            self._tx_begin()
         self._trans_stack.append(self._FREE)
 
     def commit(self):
@@ -254,53 +506,88 @@ class _Transaction(object):
             raise RuntimeError("commit called outside of transaction")
         if self._trans_stack[-1] != self._FREE:
             self._context_abort("Non-context commit inside a context")
+        if len(self._trans_stack) > 1:
+            self._trans_stack.pop()
+            if lib.pmemobj_tx_stage() != lib.TX_STAGE_WORK:
+                self._raise_aborted()
+            return
+        if self._before_commit is not None:
+            self._before_commit()
         self._trans_stack.pop()
         lib.pmemobj_tx_commit()
         _check_errno(lib.pmemobj_tx_end())
+        self._committed()
 
     def abort(self, errno=errno.ECANCELED):
         """Abort the current (sub)transaction."""
         tlog.debug('abort_transaction: %s %s', errno, self._trans_stack)
         if not self._trans_stack:
             raise RuntimeError("abort called outside of transaction")
-        lib.pmemobj_tx_abort(errno)
-        self._obj_cache.clear_transaction_cache()
+        self._tx_abort(errno)
+        self._discard()
         if self._trans_stack[-1] == self._FREE:
             self._trans_stack.pop()
+            if self._trans_stack:
+                self._raise_aborted()
             # This will raise ECANCELED.
             _check_errno(lib.pmemobj_tx_end())
 
     def __enter__(self):
         self._trans_stack.append(self._CONTEXT)
         tlog.debug('__enter__ %s', self._trans_stack)
-        _check_errno(lib.pmemobj_tx_begin(self.pool_ptr, ffi.NULL, ffi.NULL))
+        if len(self._trans_stack) == 1:
+            self._tx_begin()
         return self
 
     def __exit__(self, *args):
         tlog.debug('__exit__: %s, %s', self._trans_stack, args)
+        if (args[0] is None and self._trans_stack == [self._CONTEXT]
+                and self._before_commit is not None
+                and lib.pmemobj_tx_stage() == lib.TX_STAGE_WORK):
+            # Run this while we are still in the outermost transaction, so
+            # that what it does is part of it, and transactions it opens are
+            # nested ones.
+            try:
+                self._before_commit()
+            except BaseException:
+                self.__exit__(*sys.exc_info())
+                raise
         if self._trans_stack.pop() == self._FREE:
             while self._trans_stack.pop() == self._FREE:
+                pass
+            if not self._trans_stack:
+                lib.pmemobj_tx_abort(errno.ECANCELED)
                 lib.pmemobj_tx_end()
+                self._discard()
+                raise RuntimeError('Transaction aborted: Non-context'
+                                   ' transaction open at context end.')
             self._context_abort("Non-context transaction open at context end.")
         stage = lib.pmemobj_tx_stage()
+        if stage == lib.TX_STAGE_WORK and args[0] is not None:
+            log.debug('aborting: %r', args[1])
+            # We have a Python exception that didn't result from an error
+            # in the pmemobj library, so manually roll back the transaction
+            # since the python block won't have completed.
+            self._tx_abort(errno.ECANCELED)
+            stage = lib.pmemobj_tx_stage()
+        if self._trans_stack:
+            if stage != lib.TX_STAGE_WORK:
+                self._discard()
+                if args[0] is None:
+                    self._raise_aborted()
+            return
         if stage == lib.TX_STAGE_WORK:
-            if args[0] is None:
-                tlog.debug('committing')
-                # If this fails we get a non-zero errno from tx_end.
-                lib.pmemobj_tx_commit()
-            else:
-                log.debug('aborting: %r', args[1])
-                # We have a Python exception that didn't result from an error
-                # in the pmemobj library, so manually roll back the transaction
-                # since the python block won't have completed.
-                lib.pmemobj_tx_abort(errno.ECANCELED)
+            tlog.debug('committing')
+            # If this fails we get a non-zero errno from tx_end.
+            lib.pmemobj_tx_commit()
         err = lib.pmemobj_tx_end()
         if err:
-            self._obj_cache.clear_transaction_cache()
+            self._discard()
             if err != errno.ECANCELED or args[0] is None:
                 _raise_per_errno()
-        elif not self._trans_stack:
+        else:
             self._obj_cache.commit_transaction_cache()
+            self._committed()
 
 
 class MemoryManager(object):
@@ -311,18 +598,37 @@ class MemoryManager(object):
     """
 
     # XXX create should be a keyword-only arg but we don't have those in 2.7.
-    def __init__(self, pool_ptr, type_table=None):
+    def __init__(self, pool_ptr, type_table=None, cache_size=OBJ_CACHE_SIZE):
         log.debug('MemoryManager.__init__: %r', pool_ptr)
         self._pool_ptr = pool_ptr
         self._track_free = None
-        self._obj_cache = _ObjCache()
-        self._transaction = _Transaction(self._pool_ptr, self._obj_cache)
+        # The _IncrementalGC of a collection in progress, if any.
+        self._collector = None
+        # The sets of oids in each young generation, youngest first.
+        self._generations = [set() for i in range(YOUNG_GENERATIONS)]
+        self._obj_cache = _ObjCache(cache_size)
+        self._transaction = _Transaction(self._pool_ptr, self._obj_cache,
+                                         self._apply_refcounts,
+                                         self._add_young)
+        # The type table is a list of strs, so those two types are always
+        # the first two entries in it.
+        self._type_table = None
+        self._index_types([_class_string(PersistentList), _class_string(str)])
         self._init_caches()
 
     def transaction(self):
         """Return a (context manager) object that represents a transaction."""
         return self._transaction
 
+    def cache_info(self):
+        """Return statistics about the cache of resurrected objects.
+
+        The result has the hits and misses of cache lookups, the number of
+        evictions from the LRU of immutables, its maxsize and currsize, and
+        the number of persistent objects currently held weakly.
+        """
+        return self._obj_cache.info()
+
     #
     # Memory management
     #
@@ -345,6 +651,10 @@ class MemoryManager(object):
         if oid == self.OID_NULL:
             _raise_per_errno()
         log.debug('malloced oid: %s', oid)
+        if type_num == POBJECT_TYPE_NUM:
+            self._transaction.allocated.append(oid)
+        if self._collector is not None:
+            self._collector.allocated(oid)
         return oid
 
     def malloc_ptrs(self, count):
@@ -368,11 +678,17 @@ class MemoryManager(object):
             return OID_NULL
         if type_num is None:
             type_num = lib.pmemobj_type_num(oid)
-        oid = self.otuple(lib.pmemobj_tx_zrealloc(oid, size, type_num))
-        if oid == self.OID_NULL:
+        new_oid = self.otuple(lib.pmemobj_tx_zrealloc(oid, size, type_num))
+        if new_oid == self.OID_NULL:
             _raise_per_errno()
-        log.debug('oid: %s', oid)
-        return oid
+        log.debug('oid: %s', new_oid)
+        if new_oid != oid:
+            self._forget(oid)
+            if type_num == POBJECT_TYPE_NUM:
+                self._transaction.allocated.append(new_oid)
+            if self._collector is not None:
+                self._collector.allocated(new_oid)
+        return new_oid
 
     def realloc_ptrs(self, oid, count):
         oid = self.otuple(oid)
@@ -386,7 +702,24 @@ class MemoryManager(object):
         oid = self.otuple(oid)
         log.debug('free: %r', oid)
         _check_errno(lib.pmemobj_tx_free(oid))
+        self._forget(oid)
+
+    def _forget(self, oid):
+        """Drop what we know about oid, which is being freed."""
         self._obj_cache.purge(oid)
+        # Pending refcount changes to a freed object no longer matter.
+        self._transaction.refcount_deltas.pop(oid, None)
+        self._transaction.freed.add(oid)
+        for generation in self._generations:
+            generation.discard(oid)
+        if self._collector is not None:
+            self._collector.forget(oid)
+
+    def _add_young(self):
+        """Put the PObjects allocated by a committed transaction in gen 0."""
+        trans = self._transaction
+        self._generations[0].update(oid for oid in trans.allocated
+                                    if oid not in trans.freed)
 
     def direct(self, oid):
         """Return the real memory address where oid lives."""
@@ -394,8 +727,18 @@ class MemoryManager(object):
         return _check_null(lib.pmemobj_direct(oid))
 
     def snapshot_range(self, ptr, size):
+        """Add size bytes at ptr to the transaction's undo log.
+
+        Only the parts not already snapshotted in this transaction are added.
+        """
         tlog.debug('snapshot %s %s', ptr, size)
-        lib.pmemobj_tx_add_range_direct(ptr, size)
+        trans = self._transaction
+        if not trans.depth:
+            lib.pmemobj_tx_add_range_direct(ptr, size)
+            return
+        start = int(ffi.cast('uintptr_t', ptr))
+        for lo, hi in trans.snapshots.add(start, start + size):
+            lib.pmemobj_tx_add_range_direct(ffi.cast('void *', lo), hi - lo)
 
     #
     # Object Management
@@ -404,15 +747,71 @@ class MemoryManager(object):
     def _init_caches(self):
         # We have a couple of special cases to avoid infinite regress.
         self._type_code_cache = {PersistentList: 0, str: 1}
+        self._resurrectors = {}
         self._obj_cache.clear()
 
+    def _index_types(self, type_strings):
+        """Set up the code <-> class index from the type table's strings."""
+        self._type_strings = list(type_strings)
+        self._type_codes = {s: i for i, s in enumerate(self._type_strings)}
+        # Classes are looked up on first use.
+        self._type_classes = [PersistentList, str]
+        self._type_classes.extend([None] * (len(self._type_strings) - 2))
+
     def _resurrect_type_table(self, oid):
-        """Resurrect the type table from oid.
+        """Resurrect the type table from oid, and index it.
 
         This is a private method for coordination between the
         PersistentObjectPool and the MemoryManager.
         """
         self._type_table = self.resurrect(oid)
+        self._index_types(self._type_table)
+
+    def _sync_type_index(self):
+        """Drop types whose addition to the type table was rolled back."""
+        if self._type_table is None:
+            return
+        size = len(self._type_table)
+        if size == len(self._type_strings):
+            return
+        for cls_str in self._type_strings[size:]:
+            del self._type_codes[cls_str]
+        del self._type_strings[size:]
+        del self._type_classes[size:]
+        self._type_code_cache = {cls: code for cls, code
+                                 in self._type_code_cache.items()
+                                 if code < size}
+        self._resurrectors = {code: f for code, f
+                              in self._resurrectors.items() if code < size}
+
+    def _type_class(self, type_code):
+        """Return the class for type_code, importing it if needed."""
+        cls = self._type_classes[type_code]
+        if cls is None:
+            cls = _find_class_from_string(self._type_strings[type_code])
+            self._type_classes[type_code] = cls
+        return cls
+
+    def _resurrector(self, type_code):
+        """Return the function (oid, obj_ptr) -> obj for type_code."""
+        try:
+            return self._resurrectors[type_code]
+        except KeyError:
+            pass
+        if type_code >= len(self._type_strings):
+            raise ValueError("unknown type code {}".format(type_code))
+        cls_str = self._type_strings[type_code]
+        method = getattr(self, '_resurrect_' + cls_str.replace(':', '_'), None)
+        if method is None:
+            # It must be a persistent type.
+            cls = self._type_class(type_code)
+            def resurrector(oid, obj_ptr):
+                return cls(__manager__=self, _oid=oid)
+        else:
+            def resurrector(oid, obj_ptr):
+                return method(obj_ptr)
+        self._resurrectors[type_code] = resurrector
+        return resurrector
 
     def _create_type_table(self):
         """Create an initial type table and return its oid.
@@ -436,24 +835,29 @@ class MemoryManager(object):
         Create the type table entry if required.
         """
         log.debug('get_type_code: %r', cls)
+        self._sync_type_index()
         try:
             return self._type_code_cache[cls]
         except KeyError:
             pass
         cls_str = _class_string(cls)
-        try:
-            code = self._type_table.index(cls_str)
-            log.debug('type_code for %s: %r', cls_str, code)
-            return code
-        except ValueError:
+        code = self._type_codes.get(cls_str)
+        if code is None:
             self._type_table.append(cls_str)
-            code = len(self._type_table) - 1
+            code = len(self._type_strings)
+            self._type_strings.append(cls_str)
+            self._type_codes[cls_str] = code
+            self._type_classes.append(cls)
             log.debug('new type_code for %s: %r', cls_str, code)
-            return code
+        self._type_code_cache[cls] = code
+        return code
 
     def persist(self, obj):
         """Store obj in persistent memory and return its oid."""
         log.debug('persist: %r', obj)
+        oid = self._inline(obj)
+        if oid is not None:
+            return oid
         try:
             return self._obj_cache.oid_from_obj(obj)
         except KeyError:
@@ -475,113 +879,307 @@ class MemoryManager(object):
         """Return python object representing the data stored at oid."""
         oid = self.otuple(oid)
         tlog.debug('resurrect: %r', oid)
+        if oid[0] in _TAGS:
+            return self._resurrect_inline(oid)
         try:
             return self._obj_cache.obj_from_oid(oid)
         except KeyError:
             pass
         obj_ptr = ffi.cast('PObject *', self.direct(oid))
-        type_code = obj_ptr.ob_type
-        # The special cases are to avoid infinite regress in the type table.
-        if type_code == 0:
-            obj = PersistentList(__manager__=self, _oid=oid)
-            self._obj_cache.cache(oid, obj)
-            log.debug('resurrect PersistentList: %s %r', oid, obj)
-            return obj
-        if type_code == 1:
-            cls_str = 'builtins:str'
-        else:
-            cls_str = self._type_table[type_code]
-        resurrector = '_resurrect_' + cls_str.replace(':', '_')
-        if not hasattr(self, resurrector):
-            # It must be a persistent type.
-            cls = find_class_from_string(cls_str)
-            res = cls(__manager__=self, _oid=oid)
-            log.debug('resurrect %r: persistent type (%r): %r',
-                      oid, cls_str, res)
-            return res
-        obj = getattr(self, resurrector)(obj_ptr)
+        obj = self._resurrector(obj_ptr.ob_type)(oid, obj_ptr)
         self._obj_cache.cache(oid, obj)
-        log.debug('resurrect %r: immutable type (%r): %r',
-                  oid, resurrector, obj)
+        log.debug('resurrect %r: %r', oid, obj)
         return obj
 
+    @staticmethod
+    def _inline(obj):
+        """Return obj encoded as a tagged oid, or None if it must be stored.
+        """
+        cls = obj.__class__
+        if cls is bool:
+            return (TAG_BOOL, int(obj))
+        if cls is float:
+            return (TAG_FLOAT, _UINT64.unpack(_DOUBLE.pack(obj))[0])
+        if cls in _INT_TYPES and _INT64_MIN <= obj <= _INT64_MAX:
+            return (TAG_INT, obj & 0xffffffffffffffff)
+        return None
+
+    @staticmethod
+    def _resurrect_inline(oid):
+        tag, value = oid
+        if tag == TAG_INT:
+            return value - (1 << 64) if value >> 63 else int(value)
+        if tag == TAG_FLOAT:
+            return _DOUBLE.unpack(_UINT64.pack(value))[0]
+        return bool(value)
+
+    def is_inline(self, oid):
+        """Return True if oid holds its value itself (or is OID_NULL).
+
+        Such oids don't point to memory, so must not be passed to direct.
+        """
+        oid = self.otuple(oid)
+        return oid[0] in _TAGS or oid == OID_NULL
+
     def _persist_builtins_str(self, s):
         type_code = self._get_type_code(s.__class__)
         if sys.version_info[0] > 2:
-            s = s.encode('utf-8')
+            b = s.encode('utf-8')
+            # UTF-8 uses one byte per character only for ASCII.
+            is_ascii = len(b) == len(s)
+        else:
+            b = s
+            is_ascii = False
+        return self._new_str(b, is_ascii, type_code)
+
+    def _new_str(self, b, is_ascii, type_code):
         with self.transaction():
-            p_str_oid = self.malloc(ffi.sizeof('PObject') + len(s) + 1)
-            p_str = ffi.cast('PObject *', self.direct(p_str_oid))
-            p_str.ob_type = type_code
-            body = ffi.cast('char *', p_str) + ffi.sizeof('PObject')
-            ffi.buffer(body, len(s))[:] = s
+            p_str_oid = self.malloc(ffi.sizeof('PStrObject') + len(b))
+            p_str = ffi.cast('PStrObject *', self.direct(p_str_oid))
+            p_str.ob_base.ob_base.ob_type = type_code
+            p_str.ob_base.ob_size = len(b)
+            p_str.ob_flags = PSTR_ASCII if is_ascii else 0
+            ffi.memmove(p_str.ob_sval, b, len(b))
         return p_str_oid
 
     def _resurrect_builtins_str(self, obj_ptr):
-        body = ffi.cast('char *', obj_ptr) + ffi.sizeof('PObject')
-        s = ffi.string(body)
+        p_str = ffi.cast('PStrObject *', obj_ptr)
+        s = ffi.buffer(p_str.ob_sval, p_str.ob_base.ob_size)[:]
         if sys.version_info[0] > 2:
-            s = s.decode('utf-8')
+            s = s.decode('ascii' if p_str.ob_flags & PSTR_ASCII else 'utf-8')
         return s
 
-    def _persist_builtins_float(self, f):
-        type_code = self._get_type_code(f.__class__)
-        with self.transaction():
-            p_float_oid = self.malloc(ffi.sizeof('PFloatObject'))
-            p_float = ffi.cast('PObject *', self.direct(p_float_oid))
-            p_float.ob_type = type_code
-            p_float = ffi.cast('PFloatObject *', p_float)
-            p_float.fval = f
-        return p_float_oid
+    def str_buffer(self, oid):
+        """Return a memoryview of the UTF-8 bytes of the str stored at oid.
 
+        This gives the length, and allows comparing or hashing the string,
+        without decoding it.  The view refers to persistent memory directly;
+        it must not be written to, and is invalid once the string is freed.
+        """
+        if self.is_inline(oid):
+            raise TypeError("{} is not a persistent str".format(oid))
+        p_str = ffi.cast('PStrObject *', self.direct(oid))
+        if p_str.ob_base.ob_base.ob_type != self._type_code_cache[str]:
+            raise TypeError("{} is not a persistent str".format(oid))
+        return _readonly_view(p_str.ob_sval, p_str.ob_base.ob_size)
+
+    def _persist_builtins_bytes(self, b):
+        type_code = self._get_type_code(b.__class__)
+        with self.transaction():
+            p_bytes_oid = self.malloc(ffi.sizeof('PBytesObject') + len(b))
+            p_bytes = ffi.cast('PBytesObject *', self.direct(p_bytes_oid))
+            p_bytes.ob_base.ob_base.ob_type = type_code
+            p_bytes.ob_base.ob_size = len(b)
+            ffi.memmove(p_bytes.ob_sval, b, len(b))
+        return p_bytes_oid
+    # A bytearray is stored by value: later changes to it are not persisted,
+    # and it is never cached, so each persist stores its current contents.
+    _persist_builtins_bytearray = _persist_builtins_bytes
+
+    def _resurrect_builtins_bytes(self, obj_ptr):
+        p_bytes = ffi.cast('PBytesObject *', obj_ptr)
+        return ffi.buffer(p_bytes.ob_sval, p_bytes.ob_base.ob_size)[:]
+
+    def _resurrect_builtins_bytearray(self, obj_ptr):
+        p_bytes = ffi.cast('PBytesObject *', obj_ptr)
+        return bytearray(ffi.buffer(p_bytes.ob_sval, p_bytes.ob_base.ob_size))
+
+    def bytes_buffer(self, oid):
+        """Return a memoryview of the bytes or bytearray stored at oid.
+
+        Unlike resurrecting the object, this does not copy the data.  The
+        same restrictions as for str_buffer apply.
+        """
+        if self.is_inline(oid):
+            raise TypeError("{} is not a persistent bytes".format(oid))
+        p_bytes = ffi.cast('PBytesObject *', self.direct(oid))
+        cls_str = self._type_strings[p_bytes.ob_base.ob_base.ob_type]
+        if cls_str not in (_class_string(bytes), _class_string(bytearray)):
+            raise TypeError("{} is not a persistent bytes".format(oid))
+        return _readonly_view(p_bytes.ob_sval, p_bytes.ob_base.ob_size)
+
+    def equals(self, oid, obj):
+        """Return True if the object stored at oid is obj or equal to it.
+
+        A persistent object is compared by its oid, and a str or int against
+        the stored bytes, rather than resurrecting what is at oid.
+        """
+        oid = self.otuple(oid)
+        try:
+            other = self._obj_cache.obj_from_oid(oid)
+        except KeyError:
+            if getattr(obj, '__manager__', None) is self:
+                if self.otuple(obj._oid) == oid:
+                    return True
+            elif not self.is_inline(oid):
+                result = self._raw_equals(oid, obj)
+                if result is not None:
+                    return result
+            other = self.resurrect(oid)
+        return other is obj or other == obj
+
+    def _raw_equals(self, oid, obj):
+        """Compare obj with the str or int stored at oid, without resurrecting.
+
+        Return None if obj is not a str or int, or oid holds something else.
+        """
+        cls = obj.__class__
+        if cls is not str and cls not in _INT_TYPES:
+            return None
+        ob = ffi.cast('PVarObject *', self.direct(oid))
+        type_code = ob.ob_base.ob_type
+        str_code = self._type_code_cache[str]
+        int_code = self._type_codes.get(_class_string(1 .__class__))
+        if type_code not in (str_code, int_code):
+            return None
+        if (type_code == str_code) != (cls is str):
+            # A str never equals an int.
+            return False
+        size = ob.ob_size
+        if cls is str:
+            if sys.version_info[0] > 2:
+                try:
+                    obj = obj.encode('utf-8')
+                except UnicodeEncodeError:
+                    # Such as a lone surrogate, which can't be persisted, so
+                    # no stored str equals it.
+                    return False
+            return (size == len(obj) and
+                    _readonly_view(ffi.cast('PStrObject *', ob).ob_sval,
+                                   size) == obj)
+        p_int = ffi.cast('PIntObject *', ob)
+        # _new_int only uses digits for values that don't fit in ival.
+        if _INT64_MIN <= obj <= _INT64_MAX:
+            return size == 0 and p_int.ival == obj
+        digits = int_to_bytes(abs(obj))
+        return (size == len(digits) and
+                p_int.ival == (-1 if obj < 0 else 1) and
+                _readonly_view(p_int.ob_digit, size) == digits)
+
+    def oids_equal(self, oid1, oid2):
+        """Return True if the objects stored at oid1 and oid2 are equal.
+
+        The same oid is the same object.  Two stored strs, or two stored
+        ints, are compared by their stored bytes.
+        """
+        oid1 = self.otuple(oid1)
+        oid2 = self.otuple(oid2)
+        if oid1 == oid2:
+            return True
+        if not self.is_inline(oid1) and not self.is_inline(oid2):
+            ob1 = ffi.cast('PVarObject *', self.direct(oid1))
+            ob2 = ffi.cast('PVarObject *', self.direct(oid2))
+            type_code = ob1.ob_base.ob_type
+            if type_code == ob2.ob_base.ob_type:
+                size = ob1.ob_size
+                if type_code == self._type_code_cache[str]:
+                    # The ASCII flag follows from the bytes.
+                    return (size == ob2.ob_size and
+                            _readonly_view(
+                                ffi.cast('PStrObject *', ob1).ob_sval, size) ==
+                            _readonly_view(
+                                ffi.cast('PStrObject *', ob2).ob_sval, size))
+                if type_code == self._type_codes.get(
+                        _class_string(1 .__class__)):
+                    p_int1 = ffi.cast('PIntObject *', ob1)
+                    p_int2 = ffi.cast('PIntObject *', ob2)
+                    return (size == ob2.ob_size and
+                            p_int1.ival == p_int2.ival and
+                            _readonly_view(p_int1.ob_digit, size) ==
+                            _readonly_view(p_int2.ob_digit, size))
+        return self.equals(oid1, self.resurrect(oid2))
+
+    # Floats are now always stored inline; this reads those from older pools.
     def _resurrect_builtins_float(self, obj_ptr):
         return ffi.cast('PFloatObject *', obj_ptr).fval
 
     def _persist_builtins_int(self, i):
         # Make sure we get the int type even on python2.  The space is needed.
-        type_code = self._get_type_code(1 .__class__)
+        return self._new_int(i, self._get_type_code(1 .__class__))
+    _persist_builtins_long = _persist_builtins_int
+
+    def _new_int(self, i, type_code):
         # In theory we could copy the actual CPython data directly here,
-        # but that would mean we'd break on PyPy, etc.  So we serialize.
-        i = repr(i)
-        if sys.version_info[0] < 3:
-            i = i.rstrip('L')
+        # but that would mean we'd break on PyPy, etc.  So we serialize:
+        # values that fit go in ival, larger ones in a digit array.
+        if _INT64_MIN <= i <= _INT64_MAX:
+            digits = b''
+        else:
+            digits = int_to_bytes(abs(i))
         with self.transaction():
-            # There's a bit of extra overhead in reusing this, but not much.
-            p_int_oid = self._persist_builtins_str(i)
-            p_int = ffi.cast('PObject *', self.direct(p_int_oid))
-            p_int.ob_type = type_code
+            p_int_oid = self.malloc(ffi.sizeof('PIntObject') + len(digits))
+            p_int = ffi.cast('PIntObject *', self.direct(p_int_oid))
+            p_int.ob_base.ob_base.ob_type = type_code
+            if digits:
+                p_int.ob_base.ob_size = len(digits)
+                p_int.ival = -1 if i < 0 else 1
+                ffi.memmove(p_int.ob_digit, digits, len(digits))
+            else:
+                p_int.ival = i
         return p_int_oid
-    _persist_builtins_long = _persist_builtins_int
 
     def _resurrect_builtins_int(self, obj_ptr):
-        i_str = self._resurrect_builtins_str(obj_ptr)
-        return int(i_str)
-
-    def incref(self, oid):
-        """Increment the reference count of oid."""
+        p_int = ffi.cast('PIntObject *', obj_ptr)
+        size = p_int.ob_base.ob_size
+        if not size:
+            return p_int.ival
+        return p_int.ival * int_from_bytes(ffi.buffer(p_int.ob_digit, size)[:])
+
+    # Refcount changes are not written as they are made.  Each transaction
+    # collects the net change per object, and _apply_refcounts writes them
+    # just before the outermost transaction commits.  So moving an object
+    # between slots, or clearing a container that holds it many times, costs
+    # at most one snapshot of its refcount, and deallocation happens then too.
+
+    def _change_refcount(self, oid, delta):
         oid = self.otuple(oid)
-        if oid == OID_NULL:
+        if oid == OID_NULL or oid[0] in _TAGS:
             # Unlike CPython, we don't ref-track our constants.
             return
-        p_obj = ffi.cast('PObject *', self.direct(oid))
-        log.debug('incref %r %r', oid, p_obj.ob_refcnt + 1)
-        with self.transaction():
-            self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
-                                ffi.sizeof('size_t'))
-            p_obj.ob_refcnt += 1
+        trans = self._transaction
+        if not trans.depth:
+            with trans:
+                self._change_refcount(oid, delta)
+            return
+        if delta > 0 and self._collector is not None:
+            # The write barrier: oid is being stored somewhere, perhaps in
+            # a container the collector has already scanned.
+            self._collector.shade(oid)
+        if oid in trans.freed:
+            return
+        deltas = trans.refcount_deltas
+        deltas[oid] = deltas.get(oid, 0) + delta
+
+    def incref(self, oid):
+        """Increment the reference count of oid."""
+        self._change_refcount(oid, 1)
 
     def decref(self, oid):
-        """Decrement the reference count of oid, and free it if zero."""
-        oid = self.otuple(oid)
-        p_obj = ffi.cast('PObject *', self.direct(oid))
-        log.debug('decref %r %r', oid, p_obj.ob_refcnt - 1)
-        with self.transaction():
-            self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
-                                ffi.sizeof('size_t'))
-            assert p_obj.ob_refcnt > 0, "{} oid refcount {}".format(
-                                        oid, p_obj.ob_refcnt)
-            p_obj.ob_refcnt -= 1
-            if p_obj.ob_refcnt < 1:
+        """Decrement the reference count of oid, and free it if zero.
+
+        Inside a transaction, the object is freed when the outermost
+        transaction commits, if its count is still zero then.
+        """
+        self._change_refcount(oid, -1)
+
+    def _apply_refcounts(self):
+        """Write the refcount changes of the transaction about to commit."""
+        deltas = self._transaction.refcount_deltas
+        while deltas:
+            # Deallocating an object adds the changes to the objects it
+            # refers to, so keep going until there are none.
+            oid, delta = deltas.popitem()
+            p_obj = ffi.cast('PObject *', self.direct(oid))
+            refcnt = p_obj.ob_refcnt + delta
+            log.debug('refcount %r %r', oid, refcnt)
+            assert refcnt >= 0, "{} oid refcount {}".format(oid, refcnt)
+            if delta:
+                self.snapshot_range(ffi.addressof(p_obj, 'ob_refcnt'),
+                                    ffi.sizeof('size_t'))
+                p_obj.ob_refcnt = refcnt
+            if not refcnt:
+                # This includes a new object that was referenced and then
+                # dropped again within the transaction.
                 self._deallocate(oid)
 
     def xdecref(self, oid):
@@ -623,6 +1221,194 @@ class MemoryManager(object):
     OID_NULL = OID_NULL
 
 
+class _IncrementalGC(object):
+    """The state of an incremental collection of a pool's garbage.
+
+    The work is done in small units, so that it can be spread over short
+    steps with normal use of the pool in between.  The phases are:
+
+    catalog
+        Walk the pool's allocations, noting every PObject as white.
+    mark
+        Make the type table and the root object gray, then scan gray
+        objects, making the white objects they refer to gray.  A scanned
+        object is black.
+    pin, clear, release
+        The objects still white are garbage.  Incref each garbage container
+        so that none is freed while the others are being cleared, clear
+        them (which frees the other objects only they refer to), and then
+        decref them, which frees them.
+    orphans
+        Free any garbage that is left: objects that nothing refers to,
+        whatever their refcount says.
+
+    MemoryManager tells us about changes made between steps: shade is the
+    write barrier, called by incref, which makes an object stored into a
+    black container gray; objects allocated during the catalog are skipped
+    by it; and forget is called when memory is freed.  Once marking is over
+    shade rescues a white object, and everything white it refers to, from
+    the rest of the collection instead, so garbage that is linked in again
+    (say, from a python reference to it) is not freed.  A container that
+    had already been cleared stays empty.
+
+    The state is kept only in memory.  If the program crashes the pool is
+    collected in full when it is next opened, and the only persistent change
+    a collection makes before freeing anything is to pin garbage.
+    """
+
+    # The number of allocations cataloged per unit of work.
+    _catalog_unit = 64
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.mm = mm = pool.mm
+        self.phase = 'catalog'
+        self.counts = dict.fromkeys(
+            ['collections-gced', 'orphans0-gced', 'orphans1-gced'], 0)
+        self._cursor = mm.otuple(lib.pmemobj_first(pool._pool_ptr))
+        self._new = set()
+        self._white = set()
+        self._gray = set()
+        self._pending = []
+        self._pinned = []
+        self._pinning = None
+        self._others = []
+
+    def shade(self, oid):
+        if (self.phase == 'catalog' or oid not in self._white
+                or oid == self._pinning):
+            return
+        self._white.remove(oid)
+        if self.phase == 'mark':
+            self._gray.add(oid)
+            return
+        # The garbage has already been found, so nothing will scan oid;
+        # rescue what it refers to now, so that isn't freed from under it.
+        mm = self.mm
+        rescued = [oid]
+        while rescued:
+            obj = mm.resurrect(rescued.pop())
+            if not hasattr(obj, '_traverse'):
+                continue
+            for ref in obj._traverse():
+                ref = mm.otuple(ref)
+                if ref in self._white:
+                    self._white.remove(ref)
+                    rescued.append(ref)
+
+    def allocated(self, oid):
+        if self.phase == 'catalog':
+            self._new.add(oid)
+
+    def forget(self, oid):
+        self._white.discard(oid)
+        self._gray.discard(oid)
+        if oid == self._cursor:
+            # The memory stays valid until the transaction commits, so we
+            # can still move on from it, past anything else this transaction
+            # freed or that was allocated during the catalog.  If it aborts
+            # we just won't collect the objects we skipped this time.
+            freed = self.mm._transaction.freed
+            while oid != OID_NULL and (oid in freed or oid in self._new):
+                oid = self.mm.otuple(lib.pmemobj_next(oid))
+            self._cursor = oid
+
+    def step(self, deadline):
+        """Do units of work until the deadline; return True when done."""
+        while self.phase != 'done':
+            getattr(self, '_' + self.phase)()
+            if _clock() >= deadline:
+                break
+        return self.phase == 'done'
+
+    def _is_container(self, oid):
+        p_obj = ffi.cast('PObject *', self.mm.direct(oid))
+        return hasattr(self.mm._type_class(p_obj.ob_type), '_traverse')
+
+    def _catalog(self):
+        mm = self.mm
+        oid = self._cursor
+        if oid == OID_NULL:
+            self._new.clear()
+            self.counts['objects-total'] = len(self._white)
+            self.phase = 'mark'
+            self.shade(mm._type_table._oid)
+            self.shade(mm.otuple(self.pool._pmem_root.root_object))
+            return
+        oids, type_nums, _, _, self._cursor = _catalog(
+            self.pool._pool_ptr, oid, self._catalog_unit)
+        self._white.update(oid for oid, type_num in zip(oids, type_nums)
+                           if type_num == POBJECT_TYPE_NUM
+                           and oid not in self._new)
+
+    def _mark(self):
+        mm = self.mm
+        if not self._gray:
+            self.phase = 'pin'
+            self._pending = list(self._white)
+            return
+        obj = mm.resurrect(self._gray.pop())
+        if hasattr(obj, '_traverse'):
+            for ref in obj._traverse():
+                self.shade(mm.otuple(ref))
+
+    def _pin(self):
+        if not self._pending:
+            self.phase = 'clear'
+            self._pending = list(self._pinned)
+            return
+        oid = self._pending.pop()
+        if oid not in self._white:
+            return
+        if self._is_container(oid):
+            # The pin is our own reference, not garbage being linked in
+            # again, so the write barrier must let it through.
+            self._pinning = oid
+            try:
+                self.mm.incref(oid)
+            finally:
+                self._pinning = None
+            self._pinned.append(oid)
+        else:
+            self._others.append(oid)
+
+    def _clear(self):
+        if not self._pending:
+            self.phase = 'release'
+            return
+        oid = self._pending.pop()
+        if oid in self._white:
+            self.mm.resurrect(oid)._deallocate()
+
+    def _release(self):
+        if not self._pinned:
+            self.phase = 'orphans'
+            return
+        oid = self._pinned.pop()
+        # A pinned container that was linked in again since it was pinned is
+        # no longer white, but still holds the pin's reference.
+        white = oid in self._white
+        self.mm.decref(oid)
+        if white and oid not in self._white:
+            self.counts['collections-gced'] += 1
+
+    def _orphans(self):
+        mm = self.mm
+        if not self._others:
+            self.phase = 'done'
+            return
+        oid = self._others.pop()
+        if oid not in self._white:
+            return
+        if ffi.cast('PObject *', mm.direct(oid)).ob_refcnt:
+            log.warning("Orphaned with postive refcount: %s: %s",
+                        oid, mm.resurrect(oid))
+            self.counts['orphans1-gced'] += 1
+        else:
+            self.counts['orphans0-gced'] += 1
+        mm._deallocate(oid)
+
+
 class PersistentObjectPool(object):
     """This class represents the persistent object pool created using
     :func:`~nvm.pmemobj.create` or :func:`~nvm.pmemobj.open`.
@@ -632,10 +1418,12 @@ class PersistentObjectPool(object):
 
     lock = RLock()
     closed = False
+    _gc_thread = None
 
     # XXX create should be a keyword-only arg but we don't have those in 2.7.
     def __init__(self, filename, flag='w',
-                       pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
+                       pool_size=MIN_POOL_SIZE, mode=0o666, debug=False,
+                       cache_size=OBJ_CACHE_SIZE):
         """Open or create a persistent object pool backed by filename.
 
         If flag is 'w', raise an OSError if the file does not exist and
@@ -652,6 +1440,10 @@ class PersistentObjectPool(object):
         on some additional sanity-check warnings.  This may have an impact
         on performance.
 
+        cache_size is the number of resurrected immutable objects (such as
+        strings) to keep in memory; persistent containers are kept only as
+        long as the program refers to them.  See MemoryManager.cache_info.
+
         See also the open and create functions of nvm.pmemobj, which are
         convenience functions for the 'w' and 'x' flags, respectively.
         """
@@ -674,22 +1466,163 @@ class PersistentObjectPool(object):
             raise ValueError("Read-only mode is not supported")
         else:
             raise ValueError("Invalid flag value {}".format(flag))
-        mm = self.mm = MemoryManager(self._pool_ptr)
+        mm = self.mm = MemoryManager(self._pool_ptr, cache_size=cache_size)
         pmem_root = lib.pmemobj_root(self._pool_ptr, ffi.sizeof('PRoot'))
         pmem_root = ffi.cast('PRoot *', mm.direct(pmem_root))
         type_table_oid = mm.otuple(pmem_root.type_table)
         if type_table_oid == mm.OID_NULL:
             with mm.transaction():
                 type_table_oid = mm._create_type_table()
-                mm.snapshot_range(pmem_root, ffi.sizeof('PObjPtr'))
+                mm.snapshot_range(pmem_root, ffi.sizeof('PRoot'))
                 pmem_root.type_table = type_table_oid
+                pmem_root.layout_revision = LAYOUT_REVISION
         else:
+            self._upgrade_layout(pmem_root)
             mm._resurrect_type_table(type_table_oid)
         self._pmem_root = pmem_root
-        if exists:
-            # Make sure any objects orphaned by a crash are cleaned up.
-            # XXX should fix this to only be called when there is a crash.
+        if exists and not pmem_root.clean_shutdown:
+            # The pool was not closed cleanly (or was last closed by a version
+            # that didn't record it), so clean up any objects orphaned by a
+            # crash.  After a clean close there can't be any, and walking the
+            # whole pool would make opening it take time linear in its size.
+            log.info('%s was not closed cleanly, collecting garbage', filename)
             self.gc()
+        self._set_clean_shutdown(False)
+
+    def _set_clean_shutdown(self, clean):
+        pmem_root = self._pmem_root
+        if pmem_root.clean_shutdown == clean:
+            return
+        with self.mm.transaction():
+            self.mm.snapshot_range(ffi.addressof(pmem_root, 'clean_shutdown'),
+                                   ffi.sizeof('size_t'))
+            pmem_root.clean_shutdown = clean
+
+    #
+    # Layout upgrades
+    #
+    # These run before the type table is resurrected, and so work on the
+    # raw memory: until the upgrade is done the objects may not be in the
+    # form the resurrectors expect.
+
+    def _upgrade_layout(self, pmem_root):
+        """Bring the pool up to LAYOUT_REVISION, one revision at a time.
+
+        Each revision is upgraded in its own transaction, so a crash leaves
+        the pool at the last revision that was completed.
+        """
+        revision = pmem_root.layout_revision
+        if revision > LAYOUT_REVISION:
+            raise ValueError("{} has layout revision {}, newer than the"
+                             " supported revision {}".format(
+                             self.filename, revision, LAYOUT_REVISION))
+        mm = self.mm
+        while revision < LAYOUT_REVISION:
+            revision += 1
+            log.info('upgrading %s to layout revision %s',
+                     self.filename, revision)
+            with mm.transaction():
+                getattr(self, '_upgrade_to_{}'.format(revision))(pmem_root)
+                mm.snapshot_range(ffi.addressof(pmem_root, 'layout_revision'),
+                                  ffi.sizeof('size_t'))
+                pmem_root.layout_revision = revision
+            mm._init_caches()
+
+    def _iter_pobjects(self):
+        """Return a list of (oid, PObject *) for all PObjects in the pool."""
+        mm = self.mm
+        oids, type_nums, _, _, _ = _catalog(self._pool_ptr)
+        return [(oid, ffi.cast('PObject *', mm.direct(oid)))
+                for oid, type_num in zip(oids, type_nums)
+                if type_num == POBJECT_TYPE_NUM]
+
+    def _type_strings(self, pmem_root):
+        """Return the type table as a list of class strings read from memory.
+        """
+        mm = self.mm
+        table = ffi.cast('PListObject *', mm.direct(pmem_root.type_table))
+        items = ffi.cast('PObjPtr *', mm.direct(table.ob_items))
+        res = []
+        for i in range(table.ob_base.ob_size):
+            body = ffi.cast('char *', mm.direct(items[i]))
+            if pmem_root.layout_revision < 2:
+                # A PObject followed by NUL terminated UTF-8.
+                s = ffi.string(body + ffi.sizeof('PObject'))
+            else:
+                p_str = ffi.cast('PStrObject *', body)
+                s = ffi.buffer(p_str.ob_sval, p_str.ob_base.ob_size)[:]
+            if sys.version_info[0] > 2:
+                s = s.decode('utf-8')
+            res.append(s)
+        return res
+
+    def _replace_references(self, pmem_root, new_oids, type_strings):
+        """Make references to the keys of new_oids point to the values."""
+        mm = self.mm
+        types = [_find_class_from_string(s) for s in type_strings]
+        refs = [pmem_root.root_object]
+        for oid, obj in self._iter_pobjects():
+            typ = types[obj.ob_type]
+            if hasattr(typ, '_traverse'):
+                refs.extend(typ(__manager__=mm, _oid=oid)._traverse())
+        for ref in refs:
+            new_oid = new_oids.get(mm.otuple(ref))
+            if new_oid is not None:
+                ptr = ffi.addressof(ref)
+                mm.snapshot_range(ptr, ffi.sizeof('PObjPtr'))
+                ptr[0] = new_oid
+
+    def _upgrade_to_1(self, pmem_root):
+        """Convert ints from decimal strings to PIntObjects."""
+        mm = self.mm
+        types = self._type_strings(pmem_root)
+        if _class_string(int) not in types:
+            return
+        int_code = types.index(_class_string(int))
+        new_oids = {}
+        for oid, obj in self._iter_pobjects():
+            if obj.ob_type != int_code:
+                continue
+            body = ffi.cast('char *', obj) + ffi.sizeof('PObject')
+            new_oid = mm._new_int(int(ffi.string(body)), int_code)
+            ffi.cast('PObject *', mm.direct(new_oid)).ob_refcnt = obj.ob_refcnt
+            new_oids[oid] = new_oid
+            mm.free(oid)
+        self._replace_references(pmem_root, new_oids, types)
+
+    def _upgrade_to_2(self, pmem_root):
+        """Convert strs from NUL terminated to length prefixed PStrObjects."""
+        mm = self.mm
+        types = self._type_strings(pmem_root)
+        str_code = 1
+        new_oids = {}
+        for oid, obj in self._iter_pobjects():
+            if obj.ob_type != str_code:
+                continue
+            s = ffi.string(ffi.cast('char *', obj) + ffi.sizeof('PObject'))
+            is_ascii = all(c < 0x80 for c in bytearray(s))
+            new_oid = mm._new_str(s, is_ascii, str_code)
+            ffi.cast('PObject *', mm.direct(new_oid)).ob_refcnt = obj.ob_refcnt
+            new_oids[oid] = new_oid
+            mm.free(oid)
+        self._replace_references(pmem_root, new_oids, types)
+
+    def _upgrade_to_3(self, pmem_root):
+        """Replace small int and float objects by inline values."""
+        mm = self.mm
+        types = self._type_strings(pmem_root)
+        codes = [types.index(_class_string(cls)) for cls in (int, float)
+                 if _class_string(cls) in types]
+        new_oids = {}
+        for oid, obj in self._iter_pobjects():
+            if obj.ob_type in codes:
+                cls_str = types[obj.ob_type]
+                resurrector = '_resurrect_' + cls_str.replace(':', '_')
+                tagged = mm._inline(getattr(mm, resurrector)(obj))
+                if tagged is not None:
+                    new_oids[oid] = tagged
+                    mm.free(oid)
+        self._replace_references(pmem_root, new_oids, types)
 
     def close(self):
         """Close the object pool, freeing any unreferenced objects.
@@ -699,6 +1632,7 @@ class PersistentObjectPool(object):
         nvm.pmemobj.open.
 
         """
+        self.stop_gc_thread()
         with self.lock:
             if self.closed:
                 log.debug('already closed')
@@ -707,6 +1641,8 @@ class PersistentObjectPool(object):
             self.closed = True     # doing this early helps with debugging
             # Clean up unreferenced object cycles.
             self.gc()
+            # Tell the next open that it need not look for orphans.
+            self._set_clean_shutdown(True)
             lib.pmemobj_close(self._pool_ptr)
 
     def __del__(self):
@@ -763,7 +1699,7 @@ class PersistentObjectPool(object):
         return typ(*args, __manager__=self.mm, **kw)
 
     # If I didn't have to support python2 I'd make debug keyword only.
-    def gc(self, debug=None):
+    def gc(self, debug=None, generation=None, threads=1):
         # XXX add debug flag to constructor, and a test that orphans
         # generate warning messages when debug=True.
         """Free all unreferenced objects (cyclic garbage).
@@ -774,73 +1710,88 @@ class PersistentObjectPool(object):
         refcounts.  Most garbage is automatically collected when the object is
         no longer referenced.  If debug is true, the debug logging output
         will include reprs of the objects encountered.
+
+        Like CPython, the pool also has generations.  Objects allocated since
+        the last full collection are young: they start in generation 0, and
+        move up a generation each time they survive its collection, until
+        they are old.  If generation is given (0 up to YOUNG_GENERATIONS - 1),
+        only the objects in that generation and the younger ones are
+        examined, so the time taken depends on how many objects have been
+        allocated recently rather than on the size of the pool; garbage that
+        an old object refers to is left for a full collection.  The oldest
+        young generation becomes old once it has more than
+        OLDEST_YOUNG_LIMIT objects.
+
+        A full collection finds the live objects by reading the pointers in
+        the persistent lists, dicts and sets directly, without resurrecting
+        them.  If threads is more than 1, the containers to read are shared
+        out among that many threads, which read them without holding the GIL.
+
+        Return a dict of the number of objects of each type examined, and a
+        dict of counts of what was found and collected.  The counts for a
+        generational collection include genN-total and genN-gced for each
+        generation N that was collected.
+
+        gc must not be called inside a transaction: the refcounts it reads
+        would not include the changes the transaction has yet to apply.
         """
-        # XXX CPython uses a three generation GC in order to obtain more or
-        # less linear performance against the total number of objects.
-        # Currently we are not doing generations; we can get more complicated
-        # later if we want to run the GC periodically.
+        if self.mm._transaction.depth:
+            raise RuntimeError("gc called inside a transaction")
+        if generation is not None:
+            return self._collect_young(generation, debug)
 
         debug = self.debug if debug is None else debug
         log.debug('gc: start')
-        containers = set()
-        other = set()
-        orphans = set()
-        types = {}
         type_counts = collections.defaultdict(int)
         gc_counts = collections.defaultdict(int)
 
         with self.lock:
+            # This does the whole job, so any incremental collection in
+            # progress can be abandoned.
+            self.mm._collector = None
             # Catalog all PObjects.
-            oid = self.mm.otuple(lib.pmemobj_first(self._pool_ptr))
-            while oid != self.mm.OID_NULL:
-                type_num = lib.pmemobj_type_num(oid)
-                # XXX Could make the _PTR lists PObjects too so they are tracked.
-                if type_num == POBJECT_TYPE_NUM:
-                    obj =  ffi.cast('PObject *', self.mm.direct(oid))
-                    if debug:
-                        if obj.ob_refcnt < 0:
-                            log.error("Negative refcount (%s): %s %r",
-                                      obj.ob_refcnt, oid, self.mm.resurrect(oid))
-                    assert obj.ob_refcnt >= 0, '%s has negative refcnt' % oid
-                    # XXX move this cache to the POP?
-                    type_code = obj.ob_type
-                    if type_code not in types:
-                        types[type_code] = _find_class_from_string(
-                                                self.mm._type_table[type_code])
-                    typ = types[type_code]
-                    type_counts[typ.__name__] += 1
-                    assert obj.ob_refcnt >= 0, "{} refcount is {}".format(
-                                                oid, obj.ob_refcnt)
-                    if not obj.ob_refcnt:
-                        if debug:
-                            log.debug('gc: orphan: %s %s %r',
-                                      oid, obj.ob_refcnt, self.mm.resurrect(oid))
-                        orphans.add(oid)
-                    elif hasattr(typ, '_traverse'):
-                        if debug:
-                            log.debug('gc: container: %s %s %r',
-                                      oid, obj.ob_refcnt, self.mm.resurrect(oid))
-                        containers.add(oid)
-                    else:
-                        if debug:
-                            log.debug('gc: other: %s %s %r',
-                                      oid, obj.ob_refcnt, self.mm.resurrect(oid))
-                        other.add(oid)
-                else:
-                    log.debug("gc: non PObject: %s", oid)
-                oid = self.mm.otuple(lib.pmemobj_next(oid))
+            # XXX Could make the _PTR lists PObjects too so they are tracked.
+            oids, type_nums, ob_types, refcnts, _ = _catalog(self._pool_ptr)
+            pobjects = [i for i, type_num in enumerate(type_nums)
+                        if type_num == POBJECT_TYPE_NUM]
+            log.debug("gc: %s non PObjects", len(oids) - len(pobjects))
+            codes = collections.Counter(ob_types[i] for i in pobjects)
+            classes = dict((code, self.mm._type_class(code)) for code in codes)
+            for code, count in codes.items():
+                type_counts[classes[code].__name__] += count
+            container_codes = dict(
+                (code, _REF_LAYOUTS.get(getattr(typ, '_body_type', None), 0))
+                for code, typ in classes.items() if hasattr(typ, '_traverse'))
+            orphans = set(oids[i] for i in pobjects if not refcnts[i])
+            layouts = dict((oids[i], container_codes[ob_types[i]])
+                           for i in pobjects
+                           if refcnts[i] and ob_types[i] in container_codes)
+            containers = set(layouts)
+            other = set(oids[i] for i in pobjects
+                        if refcnts[i] and ob_types[i] not in container_codes)
+            if debug:
+                for kind, group in (('orphan', orphans),
+                                    ('container', containers),
+                                    ('other', other)):
+                    for oid in group:
+                        log.debug('gc: %s: %s %r',
+                                  kind, oid, self.mm.resurrect(oid))
             gc_counts['containers-total'] = len(containers)
             gc_counts['other-total'] = len(other)
 
             # Clean up refcount 0 orphans (from a crash or code bug).
             log.debug("gc: deallocating %s orphans", len(orphans))
             gc_counts['orphans0-gced'] = len(orphans)
+            self.mm._track_free = set()
             for oid in orphans:
                 if debug:
                     # XXX This should be a non debug warning on close.
                     log.warning("deallocating orphan (refcount 0): %s %r",
                                 oid, self.mm.resurrect(oid))
                 self.mm._deallocate(oid)
+            # What the orphans referred to may have gone with them.
+            containers -= self.mm._track_free
+            other -= self.mm._track_free
 
             # Trace the object tree, removing objects that are referenced.
             containers.remove(self.mm._type_table._oid)
@@ -850,44 +1801,48 @@ class PersistentObjectPool(object):
             if hasattr(root, '_traverse'):
                 containers.remove(root_oid)
                 live.append(root_oid)
-            elif root is not None:
+            elif not self.mm.is_inline(root_oid):
                 if debug:
                     log.debug('gc: non-container root: %s %r', root_oid, root)
                 other.remove(root_oid)
-            for oid in live:
-                if debug:
-                    log.debug('gc: checking live %s %r',
-                              oid, self.mm.resurrect(oid))
-                for sub_oid in self.mm.resurrect(oid)._traverse():
-                    sub_key = self.mm.otuple(sub_oid)
-                    if sub_key in containers:
-                        if debug:
-                            log.debug('gc: refed container %s %r',
-                                       sub_key, self.mm.resurrect(sub_oid))
-                        containers.remove(sub_key)
-                        live.append(sub_key)
-                    elif sub_key in other:
-                        if debug:
-                            log.debug('gc: refed oid %s %r',
-                                      sub_key, self.mm.resurrect(sub_oid))
-                        other.remove(sub_key)
-                        gc_counts['other-live'] += 1
+            # Each pass reads the containers found live by the one before.
+            workers = ThreadPool(threads) if threads > 1 else None
+            try:
+                frontier = live[:]
+                while frontier:
+                    if debug:
+                        for oid in frontier:
+                            log.debug('gc: checking live %s %r',
+                                      oid, self.mm.resurrect(oid))
+                    found = []
+                    for sub_key in self._gather_refs(frontier, layouts,
+                                                     workers):
+                        if sub_key in containers:
+                            if debug:
+                                log.debug('gc: refed container %s %r',
+                                          sub_key, self.mm.resurrect(sub_key))
+                            containers.remove(sub_key)
+                            found.append(sub_key)
+                        elif sub_key in other:
+                            if debug:
+                                log.debug('gc: refed oid %s %r',
+                                          sub_key, self.mm.resurrect(sub_key))
+                            other.remove(sub_key)
+                            gc_counts['other-live'] += 1
+                    live.extend(found)
+                    frontier = found
+            finally:
+                if workers is not None:
+                    workers.close()
+                    workers.join()
             gc_counts['containers-live'] = len(live)
 
             # Everything left is unreferenced via the root, deallocate it.
             log.debug('gc: deallocating %s containers', len(containers))
-            self.mm._track_free = set()
-            for oid in containers:
-                if oid in self.mm._track_free:
-                    continue
-                if debug:
-                    log.debug('gc: deallocating container %s %r',
-                              oid, self.mm.resurrect(oid))
-                with self.mm.transaction():
-                    # incref so we don't try to deallocate us during cycle clear.
-                    self.mm.incref(oid)
-                    self.mm._deallocate(oid)
-                    # deallocate frees oid, so no decref.
+            self._free_garbage(
+                containers,
+                dict((oid, self.mm.resurrect(oid)) for oid in containers),
+                debug)
             gc_counts['collections-gced'] = len(containers)
             log.debug('gc: deallocating %s new orphans', len(other))
             for oid in other:
@@ -899,28 +1854,227 @@ class PersistentObjectPool(object):
                 gc_counts['orphans1-gced'] += 1
             gc_counts['other-gced'] = len(other) - gc_counts['orphans1-gced']
             self.mm._track_free = None
+            # Everything left is old.
+            for gen in self.mm._generations:
+                gen.clear()
             log.debug('gc: end')
 
             return dict(type_counts), dict(gc_counts)
 
+    def _gather_refs(self, oids, layouts, workers):
+        """Return the references held by the containers oids, as tuples.
 
-def open(filename, debug=False):
+        layouts maps each container to its _REF_LAYOUTS value, or 0 if it
+        has to be resurrected to be traversed.  The rest are read in chunks
+        of _MARK_CHUNK, by the threads of workers if it is not None.
+        """
+        mm = self.mm
+        refs = []
+        native = []
+        for oid in oids:
+            if layouts[oid]:
+                native.append(oid)
+            else:
+                refs.extend(mm.otuple(ref)
+                            for ref in mm.resurrect(oid)._traverse())
+        chunks = [(native[i:i + _MARK_CHUNK],
+                   [layouts[oid] for oid in native[i:i + _MARK_CHUNK]])
+                  for i in range(0, len(native), _MARK_CHUNK)]
+        if workers is None or len(chunks) < 2:
+            results = [_referents(*chunk) for chunk in chunks]
+        else:
+            results = workers.map(lambda chunk: _referents(*chunk), chunks)
+        for result in results:
+            refs.extend(result)
+        return refs
+
+    def _collect_young(self, generation, debug):
+        """Collect the garbage among generations 0 through generation.
+
+        As in CPython no remembered set is needed, because the refcounts
+        already say how many references each object has.  Subtracting the
+        references from the objects being examined leaves those from older
+        objects and the root, and an object with any of those is live.
+        """
+        if not 0 <= generation < YOUNG_GENERATIONS:
+            raise ValueError("generation must be between 0 and {}, not"
+                             " {}".format(YOUNG_GENERATIONS - 1, generation))
+        debug = self.debug if debug is None else debug
+        mm = self.mm
+        type_counts = collections.defaultdict(int)
+        gc_counts = collections.defaultdict(int)
+        with self.lock:
+            gens = mm._generations[:generation + 1]
+            young = {}
+            for n, gen in enumerate(gens):
+                gc_counts['gen{}-total'.format(n)] = len(gen)
+                gc_counts['gen{}-gced'.format(n)] = 0
+                young.update(dict.fromkeys(gen, n))
+            gc_refs = {}
+            containers = {}
+            for oid in young:
+                obj = ffi.cast('PObject *', mm.direct(oid))
+                typ = mm._type_class(obj.ob_type)
+                type_counts[typ.__name__] += 1
+                gc_refs[oid] = obj.ob_refcnt
+                if hasattr(typ, '_traverse'):
+                    containers[oid] = mm.resurrect(oid)
+            for obj in containers.values():
+                for ref in obj._traverse():
+                    ref = mm.otuple(ref)
+                    if ref in gc_refs:
+                        gc_refs[ref] -= 1
+            # Whatever is left is referenced from outside; trace from there.
+            live = [oid for oid, refs in gc_refs.items() if refs > 0]
+            reached = set(live)
+            for oid in live:
+                if oid not in containers:
+                    continue
+                for ref in containers[oid]._traverse():
+                    ref = mm.otuple(ref)
+                    if ref in gc_refs and ref not in reached:
+                        reached.add(ref)
+                        live.append(ref)
+            garbage = [oid for oid in gc_refs if oid not in reached]
+            log.debug('gc: generation %s: %s young, %s garbage',
+                      generation, len(young), len(garbage))
+            self._free_garbage(garbage, containers, debug)
+            for oid in garbage:
+                gc_counts['gen{}-gced'.format(young[oid])] += 1
+                if oid in containers:
+                    gc_counts['collections-gced'] += 1
+                else:
+                    gc_counts['other-gced'] += 1
+            # The survivors (freed objects have already been forgotten)
+            # move up a generation.
+            survivors = set().union(*gens)
+            for gen in gens:
+                gen.clear()
+            if generation + 1 < YOUNG_GENERATIONS:
+                older = mm._generations[generation + 1]
+                older.update(survivors)
+                if (generation + 2 == YOUNG_GENERATIONS
+                        and len(older) > OLDEST_YOUNG_LIMIT):
+                    older.clear()
+            return dict(type_counts), dict(gc_counts)
+
+    def _free_garbage(self, garbage, containers, debug):
+        """Free the unreachable objects garbage in one transaction.
+
+        containers maps those of them that are containers to their python
+        objects.  Freeing them one at a time would let an object freed
+        earlier be decrefed when a container that refers to it is cleared.
+        Only garbage refers to garbage, so once the containers are cleared
+        every refcount is zero when the transaction commits, and they are
+        all deallocated then.  The increfs make sure each one is considered,
+        orphans included.
+        """
+        if not garbage:
+            return
+        mm = self.mm
+        with mm.transaction():
+            for oid in garbage:
+                mm.incref(oid)
+            for oid in garbage:
+                if oid in containers:
+                    if debug:
+                        log.debug('gc: clearing container %s %r',
+                                  oid, containers[oid])
+                    containers[oid]._deallocate()
+            for oid in garbage:
+                mm.decref(oid)
+
+    def gc_step(self, budget_ms=10):
+        """Do about budget_ms milliseconds of incremental garbage collection.
+
+        A collection frees the same garbage as gc, but is done by many calls
+        to gc_step, so that the pool can be used normally between them.
+        Objects allocated during a collection are left for the next one.
+        Return None until the collection is complete; the call that completes
+        it returns a dict of counts, and the next call starts a new one.
+
+        gc_step must not be called inside a transaction.  It holds the
+        pool's lock while it runs, and the state it reads (the open
+        transaction, the objects being collected) belongs to the pool rather
+        than to a thread, so a thread that uses the pool while another is
+        calling gc_step, as start_gc_thread's thread does, must hold lock.
+        """
+        deadline = _clock() + budget_ms / 1000.0
+        with self.lock:
+            mm = self.mm
+            if mm._transaction.depth:
+                raise RuntimeError("gc_step called inside a transaction")
+            if mm._collector is None:
+                mm._collector = _IncrementalGC(self)
+            collector = mm._collector
+            if not collector.step(deadline):
+                return None
+            mm._collector = None
+            return dict(collector.counts)
+
+    def start_gc_thread(self, interval=0.1, budget_ms=5):
+        """Call gc_step(budget_ms) every interval seconds in a daemon thread.
+
+        Each step holds the pool's lock, and is skipped if a transaction is
+        open.  That only protects the pool if every other thread holds lock
+        for the whole of each use of the pool or its objects, transactions
+        included; otherwise a step could run in the middle of one.  The
+        thread stops when the pool is closed or stop_gc_thread is called.
+        """
+        if self._gc_thread is not None:
+            raise RuntimeError("gc thread already running")
+        stop = Event()
+        def run():
+            while not stop.wait(interval):
+                with self.lock:
+                    if self.closed:
+                        return
+                    if self.mm._transaction.depth:
+                        continue
+                    try:
+                        self.gc_step(budget_ms)
+                    except Exception:
+                        log.exception('gc thread stopped by error')
+                        return
+        thread = Thread(target=run, name='pmemobj-gc')
+        thread.daemon = True
+        self._gc_thread = thread, stop
+        thread.start()
+
+    def stop_gc_thread(self):
+        """Stop the thread started by start_gc_thread, if it is running."""
+        if self._gc_thread is None:
+            return
+        thread, stop = self._gc_thread
+        self._gc_thread = None
+        stop.set()
+        thread.join()
+
+
+def open(filename, debug=False, cache_size=OBJ_CACHE_SIZE):
     """This function opens an existing object pool, returning a
     :class:`PersistentObjectPool`.
 
     Raises RuntimeError if the file cannot be opened or mapped.
 
+    If the pool was not closed cleanly, the objects orphaned by the crash are
+    collected first, which takes time proportional to the size of the pool.
+
     :param filename: Filename must be an existing file containing an object
                      pool as created by :func:`nvm.pmemlog.create`.
                      The application must have permission to open the file
                      and memory map it with read/write permissions.
+    :param cache_size: the number of resurrected immutable objects to keep
+                       in memory.
     :return: a :class:`PersistentObjectPool` instance that manages the pool.
     """
     log.debug('open: %s, debug=%s', filename, debug)
     # Make sure the file exists.
-    return PersistentObjectPool(filename, flag='w', debug=debug)
+    return PersistentObjectPool(filename, flag='w', debug=debug,
+                                cache_size=cache_size)
 
-def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
+def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False,
+           cache_size=OBJ_CACHE_SIZE):
     """The `create()` function creates an object pool with the given total
     `pool_size`.  Since the transactional nature of an object pool requires
     some space overhead, and immutable values are stored alongside the mutable
@@ -934,8 +2088,11 @@ def create(filename, pool_size=MIN_POOL_SIZE, mode=0o666, debug=False):
     :param pool_size: the size of the object pool in bytes.  The default
                       is pmemobj.MIN_POOL_SIZE.
     :param mode: specifies the permissions to use when creating the file.
+    :param cache_size: the number of resurrected immutable objects to keep
+                       in memory.
     :return: a :class:`PersistentObjectPool` instance that manages the pool.
     """
     log.debug('create: %s, %s, %s, debug=%s', filename, pool_size, mode, debug)
     return PersistentObjectPool(filename, flag='x',
-                                pool_size=pool_size, mode=mode, debug=debug)
+                                pool_size=pool_size, mode=mode, debug=debug,
+                                cache_size=cache_size)
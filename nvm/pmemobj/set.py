@@ -0,0 +1,135 @@
+from .compat import recursive_repr, abc
+from .hashtable import _HashTable, _phash
+
+from _pmem import ffi    # XXX refactor to make this import unneeded
+
+
+class PersistentSet(_HashTable, abc.MutableSet):
+    """Persistent version of the 'set' type.
+
+    Each entry of the hash table holds the key's persistent hash alongside
+    the key pointer, so a membership test only resurrects keys whose hash
+    matches.  update and difference_update change the table in a single
+    transaction with one snapshot per table, however many elements they
+    are given.  Operators that build a new set (|, &, -, ^) return a
+    normal set.  Iteration order is arbitrary.
+    """
+
+    # XXX locking!
+
+    _body_type = 'PSetObject'
+    _entry_type = 'PSetEntry'
+
+    def __init__(self, *args, **kw):
+        if '__manager__' not in kw:
+            raise ValueError("__manager__ is required")
+        mm = self.__manager__ = kw.pop('__manager__')
+        if '_oid' not in kw:
+            with mm.transaction():
+                self._oid = mm.malloc(ffi.sizeof('PSetObject'))
+                ob = ffi.cast('PObject *', mm.direct(self._oid))
+                ob.ob_type = mm._get_type_code(PersistentSet)
+        else:
+            self._oid = kw.pop('_oid')
+        if kw:
+            raise TypeError("Unrecognized keyword argument(s) {}".format(kw))
+        self._body = ffi.cast('PSetObject *', mm.direct(self._oid))
+        if len(args) > 1:
+            raise TypeError("PersistentSet takes at most 1"
+                            " argument, {} given".format(len(args)))
+        if args:
+            self.update(*args)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        # A persistent result would need a manager; the abc calls this for
+        # the operators that build a new set.
+        return set(it)
+
+    # Methods and properties needed to implement the ABC required methods.
+
+    def __contains__(self, key):
+        return self._lookup(key, _phash(key))[0] is not None
+
+    def __iter__(self):
+        mm = self.__manager__
+        for table, i in self._iter_entries():
+            yield mm.resurrect(table[i].me_key)
+
+    def add(self, key):
+        mm = self.__manager__
+        h = _phash(key)
+        if self._lookup(key, h)[0] is not None:
+            return
+        with mm.transaction():
+            self._insert_new(h, mm.persist(key))
+            self._migrate()
+
+    def discard(self, key):
+        mm = self.__manager__
+        table, i = self._lookup(key, _phash(key))
+        if table is None:
+            return
+        with mm.transaction():
+            self._delete_entry(table, i)
+            self._migrate()
+
+    # Additional set methods not provided by the ABC.
+
+    def update(self, *others):
+        mm = self.__manager__
+        new = {}
+        for other in others:
+            for key in other:
+                if key in new:
+                    continue
+                h = _phash(key)
+                if self._lookup(key, h)[0] is None:
+                    new[key] = h
+        if not new:
+            return
+        with mm.transaction():
+            self._bulk_insert([(h, mm.persist(key), None)
+                               for key, h in new.items()])
+
+    def difference_update(self, *others):
+        mm = self.__manager__
+        found = {}
+        for other in others:
+            for key in other:
+                table, i = self._lookup(key, _phash(key))
+                if table is not None:
+                    addr = int(ffi.cast('uintptr_t', table))
+                    found.setdefault(addr, (table, set()))[1].add(i)
+        if not found:
+            return
+        with mm.transaction():
+            oids = []
+            for table, slots in found.values():
+                lo, hi = min(slots), max(slots)
+                mm.snapshot_range(ffi.addressof(table, lo),
+                                  (hi - lo + 1) * self._entry_size())
+                for i in slots:
+                    oids.append(mm.otuple(table[i].me_key))
+                    self._clear_entry(table[i])
+            mm.snapshot_range(ffi.addressof(self._body, 'ma_used'),
+                              ffi.sizeof('size_t'))
+            self._body.ma_used -= len(oids)
+            for oid in oids:
+                mm.xdecref(oid)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        if other is self:
+            self.clear()
+        else:
+            self.difference_update(other)
+        return self
+
+    @recursive_repr()
+    def __repr__(self):
+        return "{}([{}])".format(self.__class__.__name__,
+                                 ', '.join(repr(k) for k in self))
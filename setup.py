@@ -2,9 +2,9 @@ from setuptools import setup
 import nvm
 
 install_requirements = ['nose>=1.3.7',
-                        'cffi>=1.0.0']
+                        'cffi>=1.9']
 
-setup_requirements = ['cffi>=1.0.0',
+setup_requirements = ['cffi>=1.9',
                       'nose>=1.3.1',
                       'coveralls>=1.1',
                       'mock']
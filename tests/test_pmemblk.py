@@ -0,0 +1,325 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from nvm import pmemblk
+
+from tests.support import TestCase
+
+POOL_SIZE = 16 * 1024 * 1024
+
+
+class TestBlockPoolRanges(TestCase):
+
+    def _make_pool(self, block_size=512):
+        fn = self._test_fn()
+        pool = pmemblk.create(fn, block_size, pool_size=POOL_SIZE)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_iter_nonzero_skips_zero_blocks(self):
+        pool = self._make_pool()
+        for block_num in (3, 10, 11):
+            pool.write(b'%d' % block_num * pool.block_size, block_num)
+        found = [(n, bytes(data[:2])) for n, data in pool.iter_nonzero()]
+        self.assertEqual(found, [(3, b'33'), (10, b'10'), (11, b'11')])
+
+    def test_iter_nonzero_start_stop(self):
+        pool = self._make_pool()
+        for block_num in (3, 10, 11):
+            pool.write(b'x' * pool.block_size, block_num)
+        self.assertEqual([n for n, _ in pool.iter_nonzero(4, 11)], [10])
+        self.assertEqual([n for n, _ in pool.iter_nonzero(11)], [11])
+
+    def test_set_zero_range(self):
+        pool = self._make_pool()
+        for block_num in range(10):
+            pool.write(b'x' * pool.block_size, block_num)
+        pool.set_zero_range(2, 5)
+        self.assertEqual([n for n, _ in pool.iter_nonzero()],
+                         [0, 1, 7, 8, 9])
+
+    def test_set_zero_range_outside_pool(self):
+        pool = self._make_pool()
+        with self.assertRaises(ValueError):
+            pool.set_zero_range(pool.nblock() - 1, 2)
+        with self.assertRaises(ValueError):
+            pool.set_zero_range(-1, 2)
+
+
+class TestChecksums(TestCase):
+
+    def _make_pool(self, block_size=512):
+        self.fn = self._test_fn()
+        pool = pmemblk.create(self.fn, block_size, pool_size=POOL_SIZE,
+                              checksum=True)
+        self.addCleanup(lambda: pool.close())
+        return pool
+
+    def _corrupt(self, pool, block_num):
+        # Overwrite the block behind the checksumming layer's back.
+        pool.checksum = False
+        pool.write(b'garbage'.ljust(pool.bsize(), b'\0'), block_num)
+        pool.checksum = True
+
+    def test_block_size_excludes_checksum(self):
+        pool = self._make_pool()
+        self.assertEqual(pool.block_size,
+                         pool.bsize() - pmemblk.CHECKSUM_SIZE)
+        with self.assertRaises(ValueError):
+            pool.write(b'x' * pool.bsize(), 0)
+
+    def test_read_verifies_checksum(self):
+        pool = self._make_pool()
+        pool.write(b'abc', 1)
+        self.assertEqual(pool.read(1), b'abc')
+        buf = bytearray(pool.block_size)
+        pool.readinto(buf, 1)
+        self.assertEqual(bytes(buf[:4]), b'abc\0')
+        self._corrupt(pool, 1)
+        with self.assertRaises(pmemblk.ChecksumError) as cm:
+            pool.read(1)
+        self.assertEqual(cm.exception.block_num, 1)
+        with self.assertRaises(pmemblk.ChecksumError):
+            pool.readinto(buf, 1)
+
+    def test_zero_blocks_are_valid(self):
+        pool = self._make_pool()
+        self.assertEqual(pool.read(5), b'')
+        pool.write(b'abc', 5)
+        pool.set_zero(5)
+        self.assertEqual(pool.read(5), b'')
+
+    def test_iter_nonzero_checks_data_only(self):
+        pool = self._make_pool()
+        # A block of zero data still has a non-zero checksum.
+        pool.write(b'\0' * pool.block_size, 2)
+        pool.write(b'abc', 4)
+        self.assertEqual([n for n, _ in pool.iter_nonzero()], [4])
+
+    def test_scrub(self):
+        pool = self._make_pool()
+        for block_num in range(20):
+            pool.write(b'data', block_num)
+        self._corrupt(pool, 3)
+        self._corrupt(pool, 17)
+        self.assertEqual(pool.scrub(workers=3, mark=False), [3, 17])
+        self.assertEqual(pool.scrub(workers=2), [3, 17])
+        with self.assertRaises(RuntimeError):
+            pool.read(3)
+        # Already marked blocks are still reported until rewritten.
+        pool.write(b'fixed', 3)
+        self.assertEqual(pool.scrub(), [17])
+        self.assertEqual(pool.read(3), b'fixed')
+        with self.assertRaises(ValueError):
+            pool.scrub(workers=0)
+
+    def test_scrub_requires_checksums(self):
+        fn = self._test_fn()
+        pool = pmemblk.create(fn, 512, pool_size=POOL_SIZE)
+        self.addCleanup(pool.close)
+        with self.assertRaises(ValueError):
+            pool.scrub()
+
+    def test_mode_is_recorded(self):
+        fn = self._test_fn()
+        pool = pmemblk.create(fn, 512, pool_size=POOL_SIZE, checksum=True)
+        nblock = pool.nblock()
+        pool.write(b'abc', nblock - 1)
+        with self.assertRaises(RuntimeError):
+            pool.write(b'abc', nblock)
+        pool.close()
+        pool = pmemblk.open(fn)
+        self.assertTrue(pool.checksum)
+        self.assertEqual(pool.nblock(), nblock)
+        self.assertEqual(pool.read(nblock - 1), b'abc')
+        pool.close()
+        with self.assertRaises(ValueError):
+            pmemblk.open(fn, checksum=False)
+        fn = self._test_fn()
+        pool = pmemblk.create(fn, 512, pool_size=POOL_SIZE)
+        self.assertEqual(pool.nblock(), nblock + 1)
+        pool.close()
+        with self.assertRaises(ValueError):
+            pmemblk.open(fn, checksum=True)
+        pool = pmemblk.open(fn)
+        self.assertFalse(pool.checksum)
+        pool.close()
+
+    def test_block_store_on_checksummed_pool(self):
+        pool = self._make_pool()
+        store = pmemblk.BlockStore(pool)
+        value = b'v' * 3000
+        store.put(b'k', value)
+        store.close()
+        store = pmemblk.BlockStore(pmemblk.open(self.fn, checksum=True))
+        self.assertEqual(store.get(b'k'), value)
+        store.close()
+
+
+class TestBlockStore(TestCase):
+
+    def _make_store(self, block_size=512):
+        self.fn = self._test_fn()
+        self.block_size = block_size
+        self.store = pmemblk.BlockStore(
+            pmemblk.create(self.fn, block_size, pool_size=POOL_SIZE))
+        self.addCleanup(lambda: self.store.close())
+        return self.store
+
+    def _reopen_store(self):
+        self.store.close()
+        self.store = pmemblk.BlockStore(
+            pmemblk.open(self.fn, self.block_size))
+        return self.store
+
+    def test_put_get_inline(self):
+        store = self._make_store()
+        store.put(b'a', b'small')
+        self.assertEqual(store.get(b'a'), b'small')
+        store = self._reopen_store()
+        self.assertEqual(store.get(b'a'), b'small')
+
+    def test_put_get_multi_block(self):
+        store = self._make_store()
+        value = bytes(bytearray(range(256))) * 10 + b'\0tail'
+        store.put(b'big', value)
+        self.assertEqual(store.get(b'big'), value)
+        store = self._reopen_store()
+        self.assertEqual(store.get(b'big'), value)
+
+    def test_put_get_exact_block_multiple(self):
+        store = self._make_store()
+        value = b'x' * (3 * self.block_size)
+        store.put(b'k', value)
+        self.assertEqual(store.get(b'k'), value)
+
+    def test_unicode_key(self):
+        store = self._make_store()
+        store.put(u'ő', b'v')
+        self.assertEqual(store.get(u'ő'), b'v')
+        self.assertEqual(store.keys(), [u'ő'.encode('utf-8')])
+
+    def test_get_missing_returns_default(self):
+        store = self._make_store()
+        self.assertIsNone(store.get(b'nope'))
+        self.assertEqual(store.get(b'nope', b'd'), b'd')
+
+    def test_replace_releases_old_blocks(self):
+        store = self._make_store()
+        free = store.nfree()
+        store.put(b'k', b'a' * 2000)
+        used = free - store.nfree()
+        store.put(b'k', b'b' * 2000)
+        self.assertEqual(free - store.nfree(), used)
+        self.assertEqual(store.get(b'k'), b'b' * 2000)
+        store = self._reopen_store()
+        self.assertEqual(store.nfree(), free - used)
+        self.assertEqual(store.get(b'k'), b'b' * 2000)
+
+    def test_delete(self):
+        store = self._make_store()
+        free = store.nfree()
+        store.put(b'a', b'1' * 1000)
+        store.put(b'b', b'2')
+        store.delete(b'a')
+        self.assertNotIn(b'a', store)
+        self.assertEqual(len(store), 1)
+        store = self._reopen_store()
+        self.assertEqual(store.keys(), [b'b'])
+        self.assertEqual(store.nfree(), free - 1)
+        with self.assertRaises(KeyError):
+            store.delete(b'a')
+
+    def test_fragmented_allocation(self):
+        store = self._make_store()
+        for i in range(6):
+            store.put(str(i), b'x' * 2)
+        store.delete('1')
+        store.delete('3')
+        store.delete('5')
+        value = b'y' * (self.block_size * 2)
+        store.put(b'big', value)
+        self.assertEqual(store.get(b'big'), value)
+        store = self._reopen_store()
+        self.assertEqual(store.get(b'big'), value)
+
+    def test_free_extents_merge(self):
+        store = self._make_store()
+        free = store.nfree()
+        for i in range(8):
+            store.put(str(i), b'x' * 1000)
+        for i in (1, 2, 0, 3, 6, 5, 7, 4):
+            store.delete(str(i))
+        self.assertEqual(store.nfree(), free)
+        self.assertEqual(store._free_starts,
+                         {store._data_start: free})
+        store.put(b'big', b'y' * (self.block_size * (free - 1)))
+        self.assertEqual(store.nfree(), 0)
+        store = self._reopen_store()
+        self.assertEqual(store.nfree(), 0)
+
+    def test_store_full(self):
+        store = self._make_store()
+        with self.assertRaises(MemoryError):
+            store.put(b'k', b'z' * (self.block_size * (store.nfree() + 1)))
+        self.assertNotIn(b'k', store)
+
+    def test_key_too_long(self):
+        store = self._make_store()
+        with self.assertRaises(ValueError):
+            store.put(b'k' * self.block_size, b'v')
+
+    def test_recovers_leaked_blocks(self):
+        store = self._make_store()
+        store.put(b'a', b'1' * 1000)
+        free = store.nfree()
+        # Simulate a crash after allocation but before the head bit is set.
+        extents = store._allocate(3, 1)
+        store._write_map(store._alloc_map, store._alloc_start,
+                         store._blocks_of(pmemblk._Record(0, 0, 0, extents)))
+        store = self._reopen_store()
+        self.assertEqual(store.nfree(), free)
+        self.assertEqual(store.get(b'a'), b'1' * 1000)
+
+    def test_replace_commits_new_head_before_clearing_old(self):
+        store = self._make_store()
+        store.put(b'a', b'old')
+        old = store._index[b'a']
+        # Put the new head under a different head bitmap block, by using
+        # up the blocks after the old head.
+        store._allocate(store._map_bits - 1, 1)
+        written = []
+        orig = store._write_block
+        def write_block(data, block_num):
+            written.append(block_num)
+            return orig(data, block_num)
+        store._write_block = write_block
+        store.put(b'a', b'new')
+        del store._write_block
+        new = store._index[b'a']
+        head_blocks = [b - store._head_start for b in written
+                       if store._head_start <= b <
+                          store._head_start + store._map_blocks]
+        self.assertEqual(head_blocks, [new.head // store._map_bits,
+                                       old.head // store._map_bits])
+        store = self._reopen_store()
+        self.assertEqual(store.get(b'a'), b'new')
+
+    def test_recovers_interrupted_replace(self):
+        store = self._make_store()
+        store.put(b'a', b'old')
+        old = store._index[b'a']
+        store.put(b'a', b'new')
+        # Simulate a crash that left both head bits set.
+        store._set_bit(store._head_map, old.head, 1)
+        store._write_map(store._head_map, store._head_start, [old.head])
+        store._write_block(
+            pmemblk._HEAD.pack(pmemblk._HEAD_MAGIC, 1, old.seq, 3, 1, 0) +
+            b'aold', old.head)
+        store = self._reopen_store()
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get(b'a'), b'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf8 -*-
+import os
+import unittest
+
+from nvm import pmemobj
+
+from tests.support import TestCase
+
+
+class TestPersistentBlob(TestCase):
+
+    def _make_blob(self, *args, **kw):
+        self.fn = self._test_fn()
+        self.pop = pmemobj.create(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.pop.root = self.pop.new(pmemobj.PersistentBlob, *args, **kw)
+        return self.pop.root
+
+    def _reread_blob(self):
+        self.pop.close()
+        self.pop = pmemobj.open(self.fn)
+        return self.pop.root
+
+    def test_constructor(self):
+        b = self._make_blob(b'abc')
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b.tell(), 0)
+        self.assertEqual(b.read(), b'abc')
+        b = self._reread_blob()
+        self.assertEqual(b.read(), b'abc')
+
+    def test_empty(self):
+        b = self._make_blob()
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.read(), b'')
+        self.assertEqual(list(b.iter_chunks()), [])
+
+    def test_bad_chunk_size(self):
+        self._make_blob()
+        with self.assertRaises(ValueError):
+            self.pop.new(pmemobj.PersistentBlob, chunk_size=0)
+
+    def test_write_across_chunks(self):
+        data = os.urandom(1000)
+        b = self._make_blob(chunk_size=64)
+        self.assertEqual(b.write(data[:10]), 10)
+        b.write(data[10:])
+        self.assertEqual(b.tell(), 1000)
+        self.assertEqual(b._body.nchunks, 16)
+        b = self._reread_blob()
+        self.assertEqual(b.read(), data)
+        self.assertEqual(b''.join(v.tobytes() for v in b.iter_chunks()), data)
+
+    def test_read_size_and_seek(self):
+        b = self._make_blob(b'0123456789', chunk_size=4)
+        self.assertEqual(b.read(3), b'012')
+        self.assertEqual(b.read(3), b'345')
+        self.assertEqual(b.seek(-2, os.SEEK_END), 8)
+        self.assertEqual(b.read(5), b'89')
+        self.assertEqual(b.read(5), b'')
+        b.seek(1)
+        b.seek(2, os.SEEK_CUR)
+        self.assertEqual(b.read(1), b'3')
+        with self.assertRaises(ValueError):
+            b.seek(-1)
+
+    def test_readinto(self):
+        b = self._make_blob(b'0123456789', chunk_size=4)
+        buf = bytearray(6)
+        b.seek(3)
+        self.assertEqual(b.readinto(buf), 6)
+        self.assertEqual(buf, b'345678')
+        self.assertEqual(b.readinto(buf), 1)
+        self.assertEqual(buf[:1], b'9')
+
+    def test_overwrite_and_extend(self):
+        b = self._make_blob(b'0123456789', chunk_size=4)
+        b.seek(8)
+        b.write(b'abcd')
+        b.seek(2)
+        b.write(b'XY')
+        b = self._reread_blob()
+        self.assertEqual(b.read(), b'01XY4567abcd')
+
+    def test_write_past_end_fills_zeros(self):
+        b = self._make_blob(b'ab', chunk_size=4)
+        b.seek(6)
+        b.write(b'z')
+        b = self._reread_blob()
+        self.assertEqual(b.read(), b'ab\0\0\0\0z')
+
+    def test_truncate(self):
+        b = self._make_blob(b'0123456789', chunk_size=4)
+        self.assertEqual(b.truncate(5), 5)
+        self.assertEqual(len(b), 5)
+        self.assertEqual(b._body.nchunks, 2)
+        # Growing again must not bring back the truncated data.
+        b.truncate(10)
+        self.assertEqual(b.read(), b'01234\0\0\0\0\0')
+        b.seek(3)
+        b.truncate()
+        b = self._reread_blob()
+        self.assertEqual(b.read(), b'012')
+        b.truncate(0)
+        self.assertEqual(b._body.nchunks, 0)
+        self.assertEqual(b.read(), b'')
+
+    def test_aborted_write_is_rolled_back(self):
+        b = self._make_blob(b'0123456789', chunk_size=4)
+        with self.assertRaises(RuntimeError):
+            with self.pop.transaction():
+                b.seek(2)
+                b.write(b'abcdefghijkl')
+                raise RuntimeError()
+        b = self._reread_blob()
+        self.assertEqual(len(b), 10)
+        self.assertEqual(b.read(), b'0123456789')
+
+    def test_deallocate_frees_chunks(self):
+        b = self._make_blob(b'x' * 100, chunk_size=16)
+        type_counts, _ = self.pop.gc()
+        self.assertEqual(type_counts['PersistentBlob'], 1)
+        self.pop.root = None
+        type_counts, gc_counts = self.pop.gc()
+        self.assertNotIn('PersistentBlob', type_counts)
+        self.assertEqual(gc_counts['other-gced'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+# -*- coding: utf8 -*-
+import random
+import unittest
+
+from nvm import pmemobj
+from nvm.pmemobj.btree import PersistentBTree
+from _pmem import ffi
+
+from tests.support import TestCase
+
+# Room for 4 keys a node, so a few dozen items make a tree several deep.
+SMALL_NODE = PersistentBTree._node_size(4)
+
+
+class TestPersistentBTree(TestCase):
+
+    def _make_tree(self, *args, **kw):
+        self.fn = self._test_fn()
+        self.pop = pmemobj.create(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.pop.root = self.pop.new(pmemobj.PersistentBTree, *args, **kw)
+        return self.pop.root
+
+    def _reread_tree(self):
+        self.pop.close()
+        self.pop = pmemobj.open(self.fn)
+        return self.pop.root
+
+    def _check(self, tree, expected):
+        """Check tree holds expected, and that its nodes are well formed."""
+        self.assertEqual(list(tree), sorted(expected))
+        self.assertEqual(list(tree.items()), sorted(expected.items()))
+        self.assertEqual(len(tree), len(expected))
+        minimum = tree._body.order // 2
+        root = self.pop.mm.otuple(tree._body.root)
+        depths = set()
+        for oid, node in tree._nodes():
+            if oid != root:
+                self.assertGreaterEqual(node.nkeys, minimum)
+            self.assertLessEqual(node.nkeys, tree._body.order)
+        # Every leaf is at the same depth if the leftmost path is as long
+        # as the path to each key.
+        for key in expected:
+            depths.add(len(tree._descend(key)))
+        self.assertLessEqual(len(depths), 1)
+
+    def test_constructor(self):
+        t = self._make_tree({'b': 1, 'a': 2}, c=3)
+        self.assertEqual(t, {'a': 2, 'b': 1, 'c': 3})
+        self.assertEqual(list(t), ['a', 'b', 'c'])
+        t = self._reread_tree()
+        self.assertEqual(t, {'a': 2, 'b': 1, 'c': 3})
+        with self.assertRaises(ValueError):
+            self.pop.new(pmemobj.PersistentBTree, node_size=SMALL_NODE - 1)
+
+    def test_setitem_getitem_delitem(self):
+        t = self._make_tree()
+        t[2] = 'b'
+        t[1] = 'a'
+        t[2] = 'B'
+        self.assertEqual(t[1], 'a')
+        self.assertEqual(t[2], 'B')
+        with self.assertRaises(KeyError):
+            t[3]
+        self.assertIn(1, t)
+        self.assertNotIn(3, t)
+        t = self._reread_tree()
+        self.assertEqual(t, {1: 'a', 2: 'B'})
+        del t[1]
+        with self.assertRaises(KeyError):
+            del t[1]
+        self.assertEqual(self._reread_tree(), {2: 'B'})
+        del self.pop.root[2]
+        self.assertEqual(len(self.pop.root), 0)
+        with self.assertRaises(KeyError):
+            del self.pop.root[2]
+
+    def test_repr(self):
+        t = self._make_tree({2: 'b', 1: 'a'})
+        self.assertEqual(repr(t), "PersistentBTree({1: 'a', 2: 'b'})")
+
+    def test_many_inserts_and_deletes(self):
+        t = self._make_tree(node_size=SMALL_NODE)
+        rng = random.Random(42)
+        expected = {}
+        keys = list(range(300))
+        rng.shuffle(keys)
+        for k in keys:
+            t[k] = str(k)
+            expected[k] = str(k)
+        self._check(t, expected)
+        t = self._reread_tree()
+        self._check(t, expected)
+        rng.shuffle(keys)
+        for k in keys[:250]:
+            del t[k]
+            del expected[k]
+        self._check(t, expected)
+        for k in keys[250:]:
+            del t[k]
+        self.assertEqual(len(t), 0)
+        self.assertEqual(t._body.root.off, 0)
+        t[1] = 1
+        self.assertEqual(self._reread_tree(), {1: 1})
+
+    def test_str_keys(self):
+        words = [u'pear', u'apple', u'fig', u'ő', u'banana', u'cherry']
+        t = self._make_tree(dict((w, len(w)) for w in words),
+                            node_size=SMALL_NODE)
+        self.assertEqual(list(self._reread_tree()), sorted(words))
+
+    def test_irange(self):
+        t = self._make_tree(dict((k, -k) for k in range(0, 100, 2)),
+                            node_size=SMALL_NODE)
+        self.assertEqual(list(t.irange(10, 20)), [10, 12, 14, 16, 18, 20])
+        self.assertEqual(list(t.irange(9, 21)), [10, 12, 14, 16, 18, 20])
+        self.assertEqual(list(t.irange(10, 20, inclusive=(False, False))),
+                         [12, 14, 16, 18])
+        self.assertEqual(list(t.irange(hi=4)), [0, 2, 4])
+        self.assertEqual(list(t.irange(94)), [94, 96, 98])
+        self.assertEqual(list(t.irange(30, 20)), [])
+        self.assertEqual(list(t.irange(100)), [])
+        self.assertEqual(list(t.irange_items(3, 7)), [(4, -4), (6, -6)])
+        self.assertEqual(list(t.irange()), list(range(0, 100, 2)))
+
+    def test_min_max_floor_ceiling(self):
+        t = self._make_tree(node_size=SMALL_NODE)
+        for method in (t.min, t.max):
+            with self.assertRaises(ValueError):
+                method()
+        for method in (t.floor_key, t.ceiling_key):
+            with self.assertRaises(KeyError):
+                method(1)
+        for k in range(10, 200, 10):
+            t[k] = None
+        self.assertEqual(t.min(), 10)
+        self.assertEqual(t.max(), 190)
+        for key in range(0, 210, 5):
+            below = [k for k in t if k <= key]
+            above = [k for k in t if k >= key]
+            if below:
+                self.assertEqual(t.floor_key(key), below[-1], key)
+            else:
+                with self.assertRaises(KeyError):
+                    t.floor_key(key)
+            if above:
+                self.assertEqual(t.ceiling_key(key), above[0], key)
+            else:
+                with self.assertRaises(KeyError):
+                    t.ceiling_key(key)
+
+    def test_changing_while_iterating(self):
+        t = self._make_tree(dict((k, k) for k in range(20)),
+                            node_size=SMALL_NODE)
+        for k in t:
+            # Replacing values doesn't change the shape of the tree.
+            t[k] = -k
+        self.assertEqual(list(t.values()), [-k for k in range(20)])
+        with self.assertRaises(RuntimeError):
+            for k in t:
+                del t[k]
+
+    def test_aborted_changes_are_rolled_back(self):
+        expected = dict((k, str(k)) for k in range(50))
+        t = self._make_tree(expected, node_size=SMALL_NODE)
+        with self.assertRaises(RuntimeError):
+            with self.pop.transaction():
+                for k in range(25):
+                    del t[k]
+                for k in range(100, 150):
+                    t[k] = k
+                raise RuntimeError()
+        self._check(t, expected)
+        self._check(self._reread_tree(), expected)
+
+    def test_changes_snapshot_only_the_nodes_touched(self):
+        t = self._make_tree(dict((k, k) for k in range(2000)))
+        mm = self.pop.mm
+        sizes = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        for k in range(2000, 2500):
+            t[k] = k
+        for k in range(0, 1000, 3):
+            del t[k]
+        del mm.snapshot_range
+        self.assertLessEqual(max(sizes), t._node_size(t._body.order))
+
+    def test_slots_written_past_the_old_end_are_snapshotted(self):
+        t = self._make_tree({1: 1, 3: 3})
+        mm = self.pop.mm
+        ranges = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            start = int(ffi.cast('uintptr_t', ptr))
+            ranges.append((start, start + size))
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        t[5] = 5
+        del mm.snapshot_range
+        leaf = t._node(t._body.root)
+        for slot in (leaf.slots + 2, t._others(leaf) + 2):
+            addr = int(ffi.cast('uintptr_t', slot))
+            self.assertTrue(any(lo <= addr and addr + ffi.sizeof('PObjPtr')
+                                <= hi for lo, hi in ranges))
+        self.assertEqual(self._reread_tree(), {1: 1, 3: 3, 5: 5})
+
+    def test_gc_frees_removed_items(self):
+        t = self._make_tree(dict((str(k), str(k)) for k in range(40)),
+                            node_size=SMALL_NODE)
+        before, _ = self.pop.gc()
+        for k in range(0, 40, 2):
+            del t[str(k)]
+        t['1'] = 'one'
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(gc_counts['other-gced'], 0)
+        # Each deleted item frees its str (the key and value are one
+        # object), unless a copy of the key in an interior node keeps it.
+        separators = sum(node.nkeys for oid, node in t._nodes()
+                         if not node.is_leaf)
+        self.assertGreaterEqual(type_counts['str'], before['str'] - 20 + 1)
+        self.assertLessEqual(type_counts['str'],
+                             before['str'] - 20 + 1 + separators)
+        self.pop.root = None
+        type_counts, gc_counts = self.pop.gc()
+        self.assertNotIn('PersistentBTree', type_counts)
+        self.assertEqual(gc_counts['other-gced'], 0)
+
+    def test_cycle_is_collected(self):
+        t = self._make_tree(node_size=SMALL_NODE)
+        inner = self.pop.new(pmemobj.PersistentBTree, node_size=SMALL_NODE)
+        inner['outer'] = t
+        for k in range(20):
+            t[k] = inner
+        self.pop.root = None
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 2)
+        type_counts, gc_counts = self.pop.gc()
+        self.assertNotIn('PersistentBTree', type_counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
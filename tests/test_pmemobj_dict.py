@@ -0,0 +1,175 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from nvm import pmemobj
+from nvm.pmemobj.dict import _phash
+
+from tests.support import TestCase
+
+
+class TestPersistentDict(TestCase):
+
+    def _make_dict(self, *args, **kw):
+        self.fn = self._test_fn()
+        self.pop = pmemobj.create(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.pop.root = self.pop.new(pmemobj.PersistentDict, *args, **kw)
+        return self.pop.root
+
+    def _reread_dict(self):
+        self.pop.close()
+        self.pop = pmemobj.open(self.fn)
+        return self.pop.root
+
+    def test_constructor(self):
+        d = self._make_dict({'a': 1}, b=2)
+        self.assertEqual(d, {'a': 1, 'b': 2})
+        d = self._reread_dict()
+        self.assertEqual(d, {'a': 1, 'b': 2})
+
+    def test_setitem_getitem(self):
+        d = self._make_dict()
+        d['a'] = 1
+        d[2] = 'b'
+        d[None] = None
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(d[2], 'b')
+        self.assertIsNone(d[None])
+        d = self._reread_dict()
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(d[2], 'b')
+        self.assertIsNone(d[None])
+
+    def test_setitem_replaces(self):
+        d = self._make_dict({'a': 1})
+        d['a'] = 'z'
+        self.assertEqual(len(d), 1)
+        self.assertEqual(d['a'], 'z')
+        d = self._reread_dict()
+        self.assertEqual(d, {'a': 'z'})
+
+    def test_getitem_key_error(self):
+        d = self._make_dict({'a': 1})
+        with self.assertRaises(KeyError):
+            d['b']
+
+    def test_equal_numbers_are_the_same_key(self):
+        d = self._make_dict({1: 'a'})
+        self.assertEqual(d[1.0], 'a')
+        d[1.0] = 'b'
+        self.assertEqual(len(d), 1)
+        self.assertEqual(d[1], 'b')
+
+    def test_delitem(self):
+        d = self._make_dict({'a': 1, 'b': 2, 'c': 3})
+        del d['b']
+        self.assertEqual(d, {'a': 1, 'c': 3})
+        d = self._reread_dict()
+        self.assertEqual(d, {'a': 1, 'c': 3})
+        with self.assertRaises(KeyError):
+            del d['b']
+        d['b'] = 4
+        self.assertEqual(d, {'a': 1, 'b': 4, 'c': 3})
+
+    def test_delitem_key_error_does_not_abort_transaction(self):
+        d = self._make_dict()
+        with self.pop.transaction():
+            d['a'] = 1
+            with self.assertRaises(KeyError):
+                del d['b']
+        self.assertEqual(d, {'a': 1})
+
+    def test_contains_len_iter(self):
+        d = self._make_dict({'a': 1, 'b': 2})
+        self.assertIn('a', d)
+        self.assertNotIn('z', d)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(sorted(d), ['a', 'b'])
+        self.assertEqual(sorted(d.items()), [('a', 1), ('b', 2)])
+
+    def test_repr(self):
+        d = self._make_dict({'a': 1})
+        self.assertEqual(repr(d), "PersistentDict({'a': 1})")
+        self.assertEqual(repr(self._reread_dict()), "PersistentDict({'a': 1})")
+
+    def test_grow_incrementally(self):
+        d = self._make_dict()
+        expected = {}
+        for i in range(200):
+            d[i] = str(i)
+            expected[i] = str(i)
+            if d._body.ma_oldtable.off:
+                # Check a reread in the middle of a resize, too.
+                d = self._reread_dict()
+                self.assertEqual(d[i], str(i))
+        self.assertEqual(d, expected)
+        for i in range(0, 200, 3):
+            del d[i]
+            del expected[i]
+        d = self._reread_dict()
+        self.assertEqual(d, expected)
+        self.assertEqual(len(d), len(expected))
+
+    def test_clear(self):
+        d = self._make_dict({'a': 1, 'b': 2})
+        d.clear()
+        self.assertEqual(d, {})
+        d['c'] = 3
+        self.assertEqual(d, {'c': 3})
+        self.assertEqual(self._reread_dict(), {'c': 3})
+
+    def test_nested_containers(self):
+        d = self._make_dict()
+        d['l'] = self.pop.new(pmemobj.PersistentList, [1, 2])
+        d['d'] = self.pop.new(pmemobj.PersistentDict, {'x': 'y'})
+        d = self._reread_dict()
+        self.assertEqual(d['l'], [1, 2])
+        self.assertEqual(d['d'], {'x': 'y'})
+
+    def test_unhashable_key(self):
+        d = self._make_dict()
+        with self.assertRaises(TypeError):
+            d[self.pop.new(pmemobj.PersistentList)] = 1
+
+    def test_gc_counts_and_frees(self):
+        d = self._make_dict({'a': 'b'})
+        type_counts, _ = self.pop.gc()
+        self.assertEqual(type_counts['PersistentDict'], 1)
+        d['a'] = 'c'
+        del d['a']
+        before = dict(type_counts)
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(type_counts['str'], before['str'] - 2)
+        self.assertEqual(gc_counts['collections-gced'], 0)
+
+    def test_collect_cycle(self):
+        d = self._make_dict()
+        d['x'] = self.pop.new(pmemobj.PersistentDict)
+        d['x']['self'] = d['x']
+        self.pop.root = None
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 1)
+        type_counts, _ = self.pop.gc()
+        self.assertNotIn('PersistentDict', type_counts)
+
+
+class TestPersistentHash(unittest.TestCase):
+
+    def test_equal_values_hash_equal(self):
+        self.assertEqual(_phash(1), _phash(1.0))
+        self.assertEqual(_phash(1), _phash(True))
+        self.assertEqual(_phash(-3), _phash(-3.0))
+        self.assertEqual(_phash(u'ab'), _phash(b'ab'))
+
+    def test_hash_is_stable(self):
+        # These values are stored in pools, so they must never change.
+        self.assertEqual(_phash(12345), 12345)
+        self.assertEqual(_phash(u'abc'), 0x024d0127352441c2)
+
+    def test_reserved_hashes_not_returned(self):
+        self.assertEqual(_phash(0), 2)
+        self.assertEqual(_phash(1), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
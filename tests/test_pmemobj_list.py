@@ -2,6 +2,7 @@
 import unittest
 
 from nvm import pmemobj
+from _pmem import ffi
 
 from tests.support import TestCase
 
@@ -134,6 +135,356 @@ class TestPersistentList(TestCase):
         lst.append(1)
         self.assertEqual(lst, [1])
 
+    def test_insert_and_delete_shift_in_one_block(self):
+        lst = self._make_list(range(100))
+        mm = self.pop.mm
+        sizes = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        lst.insert(0, 'a')
+        lst.insert(50, 'b')
+        del lst[0]
+        del mm.snapshot_range
+        ptr_size = ffi.sizeof('PObjPtr')
+        pointer_snapshots = [s for s in sizes if s % ptr_size == 0
+                             and s != ffi.sizeof('PListObject')]
+        # One snapshot each of the slots from the index to the end, new or
+        # old, whichever is further.
+        self.assertEqual(pointer_snapshots,
+                         [101 * ptr_size, 52 * ptr_size, 102 * ptr_size])
+        expected = list(range(100))
+        expected.insert(49, 'b')
+        self.assertEqual(self._reread_list(), expected)
+
+    def test_aborted_item_changes_are_rolled_back(self):
+        lst = self._make_list(['a', 'b', 'c'])
+        with self.assertRaises(RuntimeError):
+            with self.pop.transaction():
+                lst[1] = 'x'
+                lst.insert(0, 'y')
+                del lst[2]
+                raise RuntimeError()
+        self.assertEqual(lst, ['a', 'b', 'c'])
+        self.assertEqual(self._reread_list(), ['a', 'b', 'c'])
+
+    def test_extend(self):
+        lst = self._make_list(['a'])
+        lst.extend(['b', 2**70, 3])
+        lst.extend(x for x in 'cd')
+        lst.extend([])
+        lst.extend(lst)
+        expected = ['a', 'b', 2**70, 3, 'c', 'd'] * 2
+        self.assertEqual(lst, expected)
+        lst = self._reread_list()
+        self.assertEqual(lst, expected)
+        lst.append(None)
+        lst += ['e']
+        self.assertEqual(self._reread_list(), expected + [None, 'e'])
+
+    def test_extend_is_one_transaction(self):
+        lst = self._make_list(['a'])
+        mm = self.pop.mm
+        sizes = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        lst.extend(range(1000))
+        del mm.snapshot_range
+        # The pointers were reallocated, so only the list header is
+        # snapshotted.
+        self.assertEqual(sizes, [ffi.sizeof('PListObject')])
+        self.assertEqual(len(lst), 1001)
+
+    def test_append_into_spare_room_snapshots_the_new_slot(self):
+        lst = self._make_list(['a', 'b'])
+        self.assertGreater(lst._allocated, 3)
+        mm = self.pop.mm
+        sizes = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        lst.append('c')
+        del mm.snapshot_range
+        # The slot outside the old end is written, so it has to be part of
+        # the transaction to be flushed when it commits.
+        self.assertIn(ffi.sizeof('PObjPtr'), sizes)
+        self.assertEqual(self._reread_list(), ['a', 'b', 'c'])
+
+    def test_aborted_extend_is_rolled_back(self):
+        lst = self._make_list(['a'])
+        with self.assertRaises(TypeError):
+            lst.extend(['b', 'c', object()])
+        self.assertEqual(lst, ['a'])
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(gc_counts['orphans0-gced'], 0)
+        self.assertEqual(self._reread_list(), ['a'])
+
+    _slices = [slice(None), slice(1, 3), slice(-2, None), slice(3, 1),
+               slice(None, None, 2), slice(1, None, 3), slice(None, None, -1),
+               slice(5, 0, -2), slice(10, 20), slice(-20, 2)]
+
+    def test_getslice(self):
+        expected = ['a', 'b', 'c', 'd', 'e', 'f']
+        lst = self._make_list(expected)
+        for s in self._slices:
+            self.assertEqual(lst[s], expected[s], s)
+        self.assertIsInstance(lst[1:2], list)
+        with self.assertRaises(TypeError):
+            lst[None]
+
+    def test_setslice(self):
+        expected = ['a', 'b', 'c', 'd', 'e', 'f']
+        lst = self._make_list(expected)
+        for new in ([], ['x'], ['x', 'y', 'z'], list('0123456789')):
+            for s in self._slices:
+                if s.step is not None:
+                    continue
+                expected[s] = new
+                lst[s] = new
+                self.assertEqual(lst, expected)
+        lst[1:1] = ('u', 'v')
+        expected[1:1] = ('u', 'v')
+        lst = self._reread_list()
+        self.assertEqual(lst, expected)
+
+    def test_setslice_self(self):
+        lst = self._make_list(['a', 'b', 'c'])
+        lst[1:2] = lst
+        self.assertEqual(lst, ['a', 'a', 'b', 'c', 'c'])
+
+    def test_set_extended_slice(self):
+        expected = ['a', 'b', 'c', 'd', 'e', 'f']
+        lst = self._make_list(expected)
+        lst[::2] = expected[::2] = ['x', 'y', 'z']
+        lst[5:0:-2] = expected[5:0:-2] = [1, 2, 3]
+        self.assertEqual(lst, expected)
+        self.assertEqual(self._reread_list(), expected)
+        with self.assertRaises(ValueError):
+            lst[::2] = ['too', 'short']
+
+    def test_delslice(self):
+        for s in self._slices:
+            expected = ['a', 'b', 'c', 'd', 'e', 'f']
+            lst = self._make_list(expected)
+            del lst[s]
+            del expected[s]
+            self.assertEqual(lst, expected, s)
+            self.assertEqual(self._reread_list(), expected, s)
+            self.pop.close()
+
+    def test_slice_changes_free_replaced_items(self):
+        lst = self._make_list([str(i) for i in range(10)])
+        before, _ = self.pop.gc()
+        lst[2:5] = ['x']
+        del lst[::2]
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(type_counts['str'], before['str'] - 10 + 4)
+        self.assertEqual(gc_counts['other-gced'], 0)
+
+    def test_aborted_setslice_is_rolled_back(self):
+        lst = self._make_list(['a', 'b', 'c', 'd'])
+        with self.assertRaises(RuntimeError):
+            with self.pop.transaction():
+                lst[1:3] = ['x', 'y', 'z', 'w']
+                del lst[::2]
+                raise RuntimeError()
+        self.assertEqual(self._reread_list(), ['a', 'b', 'c', 'd'])
+
+    def test_iter_and_reversed(self):
+        expected = list(range(10))
+        lst = self._make_list(expected)
+        lst._scan_batch = 3
+        self.assertEqual(list(lst), expected)
+        self.assertEqual(list(reversed(lst)), expected[::-1])
+        lst = self._reread_list()
+        self.assertEqual(list(lst), expected)
+        lst.clear()
+        self.assertEqual(list(lst), [])
+        self.assertEqual(list(reversed(lst)), [])
+
+    def test_iter_reads_items_pointer_once(self):
+        lst = self._make_list(list(range(100)))
+        lst = self._reread_list()
+        mm = self.pop.mm
+        calls = []
+        orig = mm.direct
+        def direct(oid):
+            calls.append(oid)
+            return orig(oid)
+        mm.direct = direct
+        self.assertEqual(sum(lst), sum(range(100)))
+        self.assertEqual(lst.count(5), 1)
+        self.assertEqual(lst.index(99), 99)
+        del mm.direct
+        self.assertEqual(len(calls), 1)
+
+    def test_iter_while_changing(self):
+        # The iterator sees what a list iterator would when the list is
+        # changed under it, even across a batch boundary.
+        changes = [lambda l: l.insert(0, 'x'), lambda l: l.pop(0),
+                   lambda l: l.__setitem__(5, 'y'), lambda l: l.extend('zz'),
+                   lambda l: l.__delitem__(slice(2, 7)), lambda l: l.clear()]
+        for change in changes:
+            expected = list(range(10))
+            lst = self._make_list(expected)
+            lst._scan_batch = 4
+            seen = []
+            for values in (lst, expected):
+                seen.append([])
+                for x in values:
+                    seen[-1].append(x)
+                    if len(seen[-1]) == 3:
+                        change(values)
+            self.assertEqual(seen[0], seen[1])
+            self.assertEqual(lst, expected)
+            self.pop.close()
+
+    def test_contains_index_count(self):
+        lst = self._make_list(['a', 'b', 'a', 2**70, None])
+        self.assertIn('a', lst)
+        self.assertIn(2**70, lst)
+        self.assertIn(None, lst)
+        self.assertNotIn('c', lst)
+        self.assertEqual(lst.index('a'), 0)
+        self.assertEqual(lst.index('a', 1), 2)
+        self.assertEqual(lst.index('a', -3), 2)
+        self.assertEqual(lst.index(None, 0, 5), 4)
+        with self.assertRaises(ValueError):
+            lst.index('a', 3)
+        with self.assertRaises(ValueError):
+            lst.index(None, 0, 4)
+        self.assertEqual(lst.count('a'), 2)
+        self.assertEqual(lst.count(2**70), 1)
+        self.assertEqual(lst.count('c'), 0)
+
+    def test_reverse(self):
+        for expected in ([], ['a'], ['a', 'b'], list(range(7))):
+            lst = self._make_list(expected)
+            lst.reverse()
+            expected.reverse()
+            self.assertEqual(lst, expected)
+            self.assertEqual(self._reread_list(), expected)
+            self.pop.close()
+
+    def test_sort(self):
+        expected = [5, 'b', 2**70, -1, 'a', 3.5, 0, 'c']
+        lst = self._make_list(expected)
+        key = lambda x: (isinstance(x, str), x)
+        lst.sort(key=key)
+        expected.sort(key=key)
+        self.assertEqual(lst, expected)
+        lst.sort(key=key, reverse=True)
+        expected.sort(key=key, reverse=True)
+        self.assertEqual(lst, expected)
+        lst = self._reread_list()
+        self.assertEqual(lst, expected)
+        del lst[:]
+        lst.extend([3, 1, 2])
+        lst.sort()
+        self.assertEqual(lst, [1, 2, 3])
+
+    def test_sort_is_stable(self):
+        expected = [(i % 3, str(i)) for i in range(20)]
+        lst = self._make_list([v for k, v in expected])
+        lst.sort(key=lambda v: int(v) % 3)
+        self.assertEqual(lst, [v for k, v in sorted(expected,
+                                                    key=lambda x: x[0])])
+        lst.sort(key=lambda v: int(v) % 3, reverse=True)
+        self.assertEqual(lst, [v for k, v in sorted(expected,
+                                                    key=lambda x: x[0],
+                                                    reverse=True)])
+
+    def test_sort_and_reverse_are_one_snapshot(self):
+        lst = self._make_list([str(i) for i in range(100)])
+        before, _ = self.pop.gc()
+        mm = self.pop.mm
+        sizes = []
+        orig = mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        mm.snapshot_range = snapshot_range
+        # A reorder changes no references.
+        mm.incref = mm.decref = mm.xdecref = None
+        lst.sort(key=int, reverse=True)
+        lst.reverse()
+        del mm.snapshot_range, mm.incref, mm.decref, mm.xdecref
+        ptr_size = ffi.sizeof('PObjPtr')
+        self.assertEqual(sizes, [100 * ptr_size, 100 * ptr_size])
+        self.assertEqual(lst, [str(i) for i in range(100)])
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(type_counts, before)
+        self.assertEqual(gc_counts['other-gced'], 0)
+
+    def test_aborted_sort_is_rolled_back(self):
+        lst = self._make_list(['c', 'a', 'b'])
+        with self.assertRaises(RuntimeError):
+            with self.pop.transaction():
+                lst.sort()
+                lst.reverse()
+                raise RuntimeError()
+        self.assertEqual(lst, ['c', 'a', 'b'])
+        self.assertEqual(self._reread_list(), ['c', 'a', 'b'])
+
+    def test_sort_detects_changes_by_key(self):
+        lst = self._make_list([3, 1, 2])
+        def key(x):
+            lst.append(x)
+            return x
+        with self.assertRaises(ValueError):
+            lst.sort(key=key)
+        self.assertEqual(lst, [3, 1, 2, 3, 1, 2])
+
+    def test_eq(self):
+        lst = self._make_list(['a', 2**70, 1, None])
+        other = self.pop.new(pmemobj.PersistentList, ['a', 2**70, 1, None])
+        self.assertEqual(lst, other)
+        self.assertEqual(lst, lst)
+        self.assertEqual(lst, ['a', 2**70, 1.0, None])
+        self.assertNotEqual(lst, ['a', 2**70, 1])
+        other[1] = 2**71
+        self.assertNotEqual(lst, other)
+        nested = self.pop.new(pmemobj.PersistentList, [lst, 'x'])
+        self.assertEqual(nested, [['a', 2**70, 1, None], 'x'])
+        self.assertEqual(nested, [lst, 'x'])
+
+    def test_search_does_not_resurrect_items(self):
+        values = ['s{}'.format(i) for i in range(20)] + [2**70, 2**71]
+        root = self._make_list([])
+        root.append(self.pop.new(pmemobj.PersistentList, values))
+        # Stored in a new session, the equal values get their own oids.
+        self._reread_list().append(
+            self.pop.new(pmemobj.PersistentList, values))
+        lst, other = self._reread_list()
+        mm = self.pop.mm
+        self.assertNotEqual(lst._items[0].off, other._items[0].off)
+        resurrected = []
+        orig = mm.resurrect
+        def resurrect(oid):
+            resurrected.append(oid)
+            return orig(oid)
+        mm.resurrect = resurrect
+        self.assertIn('s19', lst)
+        self.assertIn(2**71, lst)
+        self.assertNotIn('s20', lst)
+        self.assertEqual(lst.index(2**70), 20)
+        self.assertEqual(lst.count('s3'), 1)
+        self.assertEqual(lst, other)
+        self.assertEqual(resurrected, [])
+        other[0] = 's0!'
+        resurrected[:] = []
+        self.assertNotEqual(lst, other)
+        del mm.resurrect
+        self.assertEqual(resurrected, [])
+        self.assertIn(other, self.pop.root)
+        self.assertNotEqual(other, 1)
 
 if __name__ == '__main__':
     unittest.main()
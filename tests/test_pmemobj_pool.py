@@ -1,9 +1,13 @@
 # -*- coding: utf8 -*-
+import gc
 import logging
 import sys
+import time
 import unittest
 
 from nvm import pmemobj
+from nvm.pmemobj.dict import _phash
+from _pmem import ffi, lib
 
 from tests.support import TestCase, parameterize, errno
 
@@ -127,7 +131,20 @@ class TestPersistentObjectPool(TestCase):
 class TestSimpleImmutablePersistence(TestCase):
 
     objs_params = dict(int=5,
+                       nul_string='a\x00b',
+                       empty_string='',
+                       negative_int=-5,
+                       int64_max=2**63 - 1,
+                       int64_min=-2**63,
+                       big_int=2**63,
+                       negative_big_int=-2**100 - 1,
                        float=10.5,
+                       negative_float=-0.0,
+                       infinity=float('inf'),
+                       true=True,
+                       false=False,
+                       bytes=(b'a\x00b\xff',),
+                       bytearray=(bytearray(b'xy'),),
                        string='abcde',
                        ustring='abő',
                        none=None)
@@ -146,6 +163,223 @@ class TestSimpleImmutablePersistence(TestCase):
         pop.close()
 
 
+class TestRawStrings(TestCase):
+
+    def _pop(self):
+        pop = pmemobj.create(self._test_fn())
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_str_buffer(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, [u'abő', 1])
+        oid = pop.root._items[0]
+        buf = pop.mm.str_buffer(oid)
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(buf.tobytes(), u'abő'.encode('utf-8'))
+        self.assertEqual(_phash(buf), _phash(u'abő'))
+        with self.assertRaises(TypeError):
+            pop.mm.str_buffer(pop.root._items[1])
+
+    def test_bytes_buffer(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, [b'ab\x00', 1])
+        buf = pop.mm.bytes_buffer(pop.root._items[0])
+        self.assertEqual(buf.tobytes(), b'ab\x00')
+        with self.assertRaises(TypeError):
+            pop.mm.bytes_buffer(pop.root._items[1])
+
+    def test_bytearray_is_not_cached(self):
+        pop = self._pop()
+        b = bytearray(b'ab')
+        pop.root = pop.new(pmemobj.PersistentList, [b])
+        b[0:1] = b'x'
+        pop.root.append(b)
+        self.assertEqual(list(pop.root), [bytearray(b'ab'), bytearray(b'xb')])
+        # Changing a resurrected copy doesn't change the stored value.
+        pop.root[0].append(ord('c'))
+        self.assertEqual(pop.root[0], bytearray(b'ab'))
+
+    def test_equals_does_not_resurrect_str(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, ['abc'])
+        pop.close()
+        pop = pmemobj.open(pop.filename)
+        self.addCleanup(pop.close)
+        oid = pop.mm.otuple(pop.root._items[0])
+        self.assertTrue(pop.mm.equals(oid, 'abc'))
+        self.assertFalse(pop.mm.equals(oid, 'abd'))
+        with self.assertRaises(KeyError):
+            pop.mm._obj_cache.obj_from_oid(oid)
+        self.assertFalse(pop.mm.equals(oid, 1))
+        if sys.version_info[0] > 2:
+            # A str that can't be encoded can't have been stored.
+            self.assertFalse(pop.mm.equals(oid, u'\ud800'))
+            self.assertNotIn(u'\ud800', pop.root)
+
+    def test_equals_does_not_resurrect_int(self):
+        pop = self._pop()
+        values = [2**70, -2**70, 2**64 + 1]
+        pop.root = pop.new(pmemobj.PersistentList, values)
+        pop.close()
+        pop = pmemobj.open(pop.filename)
+        self.addCleanup(pop.close)
+        oids = [pop.mm.otuple(pop.root._items[i]) for i in range(3)]
+        for oid, value in zip(oids, values):
+            self.assertTrue(pop.mm.equals(oid, value))
+            self.assertFalse(pop.mm.equals(oid, -value))
+            self.assertFalse(pop.mm.equals(oid, value + 1))
+            self.assertFalse(pop.mm.equals(oid, 5))
+            self.assertFalse(pop.mm.equals(oid, 'abc'))
+        for oid in oids:
+            with self.assertRaises(KeyError):
+                pop.mm._obj_cache.obj_from_oid(oid)
+        self.assertTrue(pop.mm.equals(oids[0], float(2**70)))
+
+    def test_oids_equal(self):
+        pop = self._pop()
+        values = [u'abő', u'abő', 'abc', 2**70, 2**70, 2**71, 1, 1.0,
+                  b'ab', b'ab']
+        pop.root = pop.new(pmemobj.PersistentList, [])
+        mm = pop.mm
+        # Store equal values separately, so they have different oids.
+        oids = []
+        for value in values:
+            pop.root.append(value)
+            oids.append(mm.otuple(pop.root._items[len(pop.root) - 1]))
+            mm._obj_cache.clear()
+        self.assertNotEqual(oids[0], oids[1])
+        for i, a in enumerate(values):
+            for j, b in enumerate(values):
+                self.assertEqual(mm.oids_equal(oids[i], oids[j]), a == b,
+                                 (a, b))
+
+
+class TestInlineValues(TestCase):
+
+    def _pop(self):
+        pop = pmemobj.create(self._test_fn())
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_small_values_are_not_allocated(self):
+        pop = self._pop()
+        values = [0, -1, 2**63 - 1, -2**63, 1.5, True, False, None]
+        pop.root = pop.new(pmemobj.PersistentList, values)
+        for i in range(len(values)):
+            self.assertTrue(pop.mm.is_inline(pop.root._items[i]))
+        type_counts, _ = pop.gc()
+        self.assertEqual(type_counts['PersistentList'], 2)
+        self.assertNotIn('int', type_counts)
+        self.assertNotIn('float', type_counts)
+        self.assertNotIn('bool', type_counts)
+
+    def test_types_are_preserved(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, [1, True, 1.0, 2**63])
+        pop.close()
+        pop = pmemobj.open(pop.filename)
+        self.addCleanup(pop.close)
+        self.assertEqual([type(x) for x in pop.root],
+                         [int, bool, float, type(2**63)])
+        self.assertFalse(pop.mm.is_inline(pop.root._items[3]))
+
+    def test_refcounting_skips_inline_values(self):
+        pop = self._pop()
+        oid = pop.mm.persist(5)
+        with pop.transaction():
+            pop.mm.incref(oid)
+            pop.mm.decref(oid)
+            pop.mm.xdecref(oid)
+        self.assertEqual(pop.mm.resurrect(oid), 5)
+
+
+class TestObjectCache(TestCase):
+
+    def _pop(self, **kw):
+        pop = pmemobj.create(self._test_fn(), **kw)
+        self.addCleanup(pop.close)
+        return pop
+
+    def test_immutables_cache_is_bounded(self):
+        pop = self._pop(cache_size=10)
+        values = ['s{}'.format(i) for i in range(100)]
+        pop.root = pop.new(pmemobj.PersistentList, values)
+        pop.mm._init_caches()
+        self.assertEqual(list(pop.root), values)
+        info = pop.mm.cache_info()
+        self.assertEqual(info.maxsize, 10)
+        self.assertLessEqual(info.currsize, 10)
+        self.assertGreater(info.evictions, 0)
+
+    def test_hits_and_misses(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList, ['a'])
+        pop.mm._init_caches()
+        lst = pop.root
+        before = pop.mm.cache_info()
+        lst[0]
+        lst[0]
+        after = pop.mm.cache_info()
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 1)
+
+    def test_persistent_objects_are_held_weakly(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [pop.new(pmemobj.PersistentList, [i])
+                            for i in range(20)])
+        gc.collect()
+        before = pop.mm.cache_info().persistent
+        for sub in pop.root:
+            self.assertEqual(len(sub), 1)
+        del sub
+        gc.collect()
+        self.assertEqual(pop.mm.cache_info().persistent, before)
+        # Still the same object while it is referenced.
+        first = pop.root[0]
+        self.assertIs(pop.root[0], first)
+
+    def test_negative_cache_size(self):
+        with self.assertRaises(ValueError):
+            pmemobj.create(self._test_fn(), cache_size=-1)
+
+
+class TestTypeTable(TestCase):
+
+    def test_type_codes_come_from_the_index(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [pop.new(pmemobj.PersistentDict)])
+        code = pop.mm._get_type_code(pmemobj.PersistentDict)
+        pop.close()
+        pop = pmemobj.open(fn)
+        self.addCleanup(pop.close)
+        def index(*args):
+            self.fail("type table was scanned")
+        pop.mm._type_table.index = index
+        self.assertEqual(pop.mm._get_type_code(pmemobj.PersistentDict), code)
+        self.assertEqual(pop.root[0], {})
+
+    def test_aborted_new_type_is_dropped_from_index(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        pop.root = pop.new(pmemobj.PersistentList)
+        with self.assertRaises(RuntimeError):
+            with pop.transaction():
+                pop.root.append(pop.new(pmemobj.PersistentSet))
+                raise RuntimeError()
+        pop.root.append(pop.new(pmemobj.PersistentDict))
+        code = pop.mm._get_type_code(pmemobj.PersistentDict)
+        self.assertEqual(code, len(pop.mm._type_table) - 1)
+        pop.root.append(pop.new(pmemobj.PersistentSet, ['a']))
+        pop.close()
+        pop = pmemobj.open(fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(list(pop.root), [{}, {'a'}])
+
+
 class TestTransactions(TestCase):
 
     def _setup(self):
@@ -224,7 +458,7 @@ class TestTransactions(TestCase):
         with pop.transaction():
             pop.root = 10
 
-    def xest_unclosed_non_context_transaction_in_context_aborts(self):
+    def test_unclosed_non_context_transaction_in_context_aborts(self):
         pop = self._setup()
         with self.assertRaises(RuntimeError):
             with pop.transaction() as trans:
@@ -278,6 +512,159 @@ class TestTransactions(TestCase):
         with pop.transaction():
             pop.root = 10
 
+    def test_inner_abort_aborts_outer_transaction(self):
+        pop = self._setup()
+        with self.assertRaises(OSError):
+            with pop.transaction():
+                pop.root = 10
+                try:
+                    with pop.transaction():
+                        pop.root = 20
+                        raise Exception('boo')
+                except Exception:
+                    pass
+        self.assertIsNone(pop.root)
+        with pop.transaction():
+            pop.root = 10
+        self.assertEqual(pop.root, 10)
+
+    def test_nested_non_context_commit(self):
+        pop = self._setup()
+        trans = pop.transaction()
+        trans.begin()
+        pop.root = 10
+        trans.begin()
+        pop.root = 20
+        trans.commit()
+        self.assertEqual(trans.depth, 1)
+        trans.commit()
+        self.assertEqual(trans.depth, 0)
+        pop = self._reopen_pop()
+        self.assertEqual(pop.root, 20)
+
+    def test_overlapping_snapshots_roll_back(self):
+        pop = self._setup()
+        pop.root = pop.new(pmemobj.PersistentBlob, b'0123456789')
+        blob = pop.root
+        with self.assertRaises(RuntimeError):
+            with pop.transaction():
+                blob.seek(2)
+                blob.write(b'ab')
+                blob.seek(0)
+                blob.write(b'ABCDEF')
+                blob.seek(4)
+                blob.write(b'xyzw')
+                raise RuntimeError()
+        blob.seek(0)
+        self.assertEqual(blob.read(), b'0123456789')
+
+
+class TestRangeSet(unittest.TestCase):
+
+    def test_add_returns_missing_parts(self):
+        r = pmemobj.pool._RangeSet()
+        self.assertEqual(r.add(10, 20), [(10, 20)])
+        self.assertEqual(r.add(12, 18), [])
+        self.assertEqual(r.add(30, 40), [(30, 40)])
+        self.assertEqual(r.add(5, 45), [(5, 10), (20, 30), (40, 45)])
+        self.assertEqual(r._starts, [5])
+        self.assertEqual(r._ends, [45])
+
+    def test_touching_ranges_merge(self):
+        r = pmemobj.pool._RangeSet()
+        r.add(0, 8)
+        r.add(16, 24)
+        self.assertEqual(r.add(8, 16), [(8, 16)])
+        self.assertEqual(r._starts, [0])
+        self.assertEqual(r._ends, [24])
+        r.clear()
+        self.assertEqual(r.add(0, 8), [(0, 8)])
+
+
+class TestRefcounting(TestCase):
+
+    def _pop(self):
+        pop = pmemobj.create(self._test_fn())
+        self.addCleanup(pop.close)
+        return pop
+
+    def _refcnt(self, pop, obj):
+        return ffi.cast('PObject *', pop.mm.direct(obj._oid)).ob_refcnt
+
+    def _count_snapshots(self, pop):
+        sizes = []
+        orig = pop.mm.snapshot_range
+        def snapshot_range(ptr, size):
+            sizes.append(size)
+            return orig(ptr, size)
+        pop.mm.snapshot_range = snapshot_range
+        self.addCleanup(lambda: pop.mm.__dict__.pop('snapshot_range', None))
+        return sizes
+
+    def test_changes_are_applied_at_outermost_commit(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        x = pop.new(pmemobj.PersistentList)
+        with pop.transaction():
+            with pop.transaction():
+                pop.root.append(x)
+                pop.root.append(x)
+            self.assertEqual(self._refcnt(pop, x), 0)
+        self.assertEqual(self._refcnt(pop, x), 2)
+
+    def test_net_zero_changes_are_not_written(self):
+        pop = self._pop()
+        x = pop.new(pmemobj.PersistentList)
+        pop.root = pop.new(pmemobj.PersistentList, [x, None])
+        sizes = self._count_snapshots(pop)
+        with pop.transaction():
+            for i in range(10):
+                pop.root[(i + 1) % 2] = x
+                pop.root[i % 2] = None
+        self.assertEqual(len(sizes), 20)
+        self.assertEqual(self._refcnt(pop, x), 1)
+
+    def test_clear_snapshots_each_refcount_once(self):
+        pop = self._pop()
+        x = pop.new(pmemobj.PersistentList)
+        pop.root = pop.new(pmemobj.PersistentList, [x] * 100)
+        pop.root.append(pop.root)
+        sizes = self._count_snapshots(pop)
+        pop.root.clear()
+        refcnt_size = ffi.sizeof('size_t')
+        # x and the root itself.
+        self.assertEqual(sizes.count(refcnt_size), 2)
+        type_counts, _ = pop.gc()
+        self.assertEqual(type_counts['PersistentList'], 2)
+
+    def test_deallocation_is_deferred(self):
+        pop = self._pop()
+        x = pop.new(pmemobj.PersistentList)
+        pop.root = pop.new(pmemobj.PersistentList, [x])
+        with pop.transaction():
+            del pop.root[0]
+            pop.root.append(x)
+        self.assertEqual(pop.root[0], [])
+        self.assertEqual(self._refcnt(pop, x), 1)
+        with pop.transaction():
+            del pop.root[0]
+            self.assertEqual(self._refcnt(pop, x), 1)
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(type_counts['PersistentList'], 2)
+        self.assertEqual(gc_counts['orphans0-gced'], 0)
+
+    def test_abort_discards_changes(self):
+        pop = self._pop()
+        x = pop.new(pmemobj.PersistentList)
+        pop.root = pop.new(pmemobj.PersistentList, [x])
+        with self.assertRaises(RuntimeError):
+            with pop.transaction():
+                pop.root.append(x)
+                raise RuntimeError()
+        self.assertEqual(self._refcnt(pop, x), 1)
+        pop.root.append(x)
+        self.assertEqual(self._refcnt(pop, x), 2)
+
 
 class TestGC(TestCase):
 
@@ -300,14 +687,14 @@ class TestGC(TestCase):
             'PersistentList': 1,
             'str': 2,
             })
-        pop.root = pop.new(pmemobj.PersistentList, [1, 'a', 3.6, 3])
+        pop.root = pop.new(pmemobj.PersistentList, [1, 'a', 3.6, 3, 2**64])
         type_counts, gc_counts = pop.gc(debug=True)
-        # Now we also have two additional types.
+        # Now we also have two additional types.  Small ints and floats are
+        # stored inline in the list, so only the big int is an object.
         self.assertEqual(type_counts, {
             'PersistentList': 2,
-            'int': 2,
-            'str': 5,
-            'float': 1,
+            'int': 1,
+            'str': 4,
             })
 
 
@@ -341,6 +728,95 @@ class TestGC(TestCase):
         self.assertEqual(gc_counts['orphans0-gced'], 1)
         self.assertGCCollectedNothing(pop.gc()[1])
 
+    def test_collect_orphan_with_contents(self):
+        pop = self._pop()
+        pop.new(pmemobj.PersistentList,
+                [pop.new(pmemobj.PersistentList, [2**70]), 2**71])
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(type_counts['PersistentList'], 3)
+        self.assertEqual(type_counts['int'], 2)
+        # What only the orphan refers to is freed with it, not collected.
+        self.assertEqual(gc_counts['orphans0-gced'], 1)
+        self.assertGCCollectedNothing(dict(gc_counts, **{'orphans0-gced': 0}))
+        type_counts, gc_counts = pop.gc()
+        # The type table and its strs for PersistentList, str and int.
+        self.assertEqual(type_counts, {'PersistentList': 1, 'str': 3})
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_collect_tangled_cycles(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        with pop.transaction():
+            lists = [pop.new(pmemobj.PersistentList) for i in range(6)]
+            for i, lst in enumerate(lists):
+                for j in (i + 1, i + 2, i + 4):
+                    lst.append(lists[j % len(lists)])
+            pop.root.extend(lists)
+            pop.root.clear()
+        del lists, lst
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 6)
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(type_counts['PersistentList'], 2)
+        self.assertGCCollectedNothing(gc_counts)
+
+    def test_catalog(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+                           ['a', 'b', 2**70, pop.new(pmemobj.PersistentList)])
+        expected = []
+        oid = pop.mm.otuple(lib.pmemobj_first(pop._pool_ptr))
+        while oid != pop.mm.OID_NULL:
+            expected.append(oid)
+            oid = pop.mm.otuple(lib.pmemobj_next(oid))
+        pool = pmemobj.pool
+        self.addCleanup(setattr, pool, '_CATALOG_BATCH', pool._CATALOG_BATCH)
+        pool._CATALOG_BATCH = 3
+        oids, type_nums, ob_types, refcnts, cursor = pool._catalog(
+            pop._pool_ptr)
+        self.assertEqual(oids, expected)
+        self.assertEqual(cursor, pop.mm.OID_NULL)
+        root = oids.index(pop.mm.otuple(pop._pmem_root.root_object))
+        self.assertEqual(type_nums[root], pool.POBJECT_TYPE_NUM)
+        self.assertEqual(ob_types[root],
+                         pop.mm._get_type_code(pmemobj.PersistentList))
+        self.assertEqual(refcnts[root], 1)
+        for i, type_num in enumerate(type_nums):
+            if type_num != pool.POBJECT_TYPE_NUM:
+                self.assertEqual((ob_types[i], refcnts[i]), (0, 0))
+        oids, _, _, _, cursor = pool._catalog(pop._pool_ptr, limit=4)
+        self.assertEqual(oids, expected[:4])
+        self.assertEqual(cursor, expected[4])
+        oids, _, _, _, cursor = pool._catalog(pop._pool_ptr, cursor)
+        self.assertEqual(oids, expected[4:])
+
+    def _crash(self, pop):
+        # Close the pool without going through PersistentObjectPool.close.
+        lib.pmemobj_close(pop._pool_ptr)
+        pop.closed = True
+
+    def test_open_after_crash_collects_orphans(self):
+        pop = self._pop()
+        pop.new(pmemobj.PersistentList)
+        self._crash(pop)
+        pop = pmemobj.open(self.fn)
+        self.addCleanup(pop.close)
+        self.assertGCCollectedNothing(pop.gc()[1])
+
+    def test_open_after_clean_close_skips_gc(self):
+        pop = self._pop()
+        pop.close()
+        pop = pmemobj.open(self.fn)
+        self.assertEqual(pop._pmem_root.clean_shutdown, 0)
+        # Mark the pool clean with an orphan in it, which a clean close
+        # can't leave; open must not look for it.
+        pop.new(pmemobj.PersistentList)
+        pop._set_clean_shutdown(True)
+        self._crash(pop)
+        pop = pmemobj.open(self.fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(pop.gc()[1]['orphans0-gced'], 1)
+
     def test_collect_cycle(self):
         pop = self._pop()
         pop.root = pop.new(pmemobj.PersistentList)
@@ -355,6 +831,414 @@ class TestGC(TestCase):
         self.assertEqual(type_counts['PersistentList'], 4)
         self.assertEqual(gc_counts['collections-gced'], 2)
 
+    def test_referents(self):
+        pop = self._pop()
+        pool = pmemobj.pool
+        lst = pop.new(pmemobj.PersistentList, ['a', None, 1, 2**70, 'b'])
+        s = pop.new(pmemobj.PersistentSet, ['a', 'b', 'c'])
+        d = pop.new(pmemobj.PersistentDict)
+        # Stop while the dict's table is being resized, so that its entries
+        # are split between the old and new tables.
+        i = 0
+        while d._body.ma_oldtable.off == 0:
+            d['k{}'.format(i)] = None if i % 2 else 'v{}'.format(i)
+            i += 1
+        containers = [lst, s, d, pop.new(pmemobj.PersistentList)]
+        layouts = [pool._REF_LAYOUTS[c._body_type] for c in containers]
+        expected = [pop.mm.otuple(ref) for c in containers
+                    for ref in c._traverse()]
+        expected = [ref for ref in expected if ref != pop.mm.OID_NULL]
+        self.addCleanup(setattr, pool, '_REFS_BATCH', pool._REFS_BATCH)
+        pool._REFS_BATCH = 3
+        refs = pool._referents([c._oid for c in containers], layouts)
+        self.assertEqual(sorted(refs), sorted(expected))
+
+    def _make_heap(self, pop):
+        pop.root = pop.new(pmemobj.PersistentList)
+        for i in range(20):
+            d = pop.new(pmemobj.PersistentDict, {'n': i, 'big': 2**70 + i})
+            d['set'] = pop.new(pmemobj.PersistentSet, ['x{}'.format(i)])
+            d['list'] = pop.new(pmemobj.PersistentList, [str(i), d])
+            pop.root.append(d)
+        garbage = pop.new(pmemobj.PersistentList, ['garbage'])
+        garbage.append(pop.new(pmemobj.PersistentDict, {'back': garbage}))
+        del pop.root[5]
+
+    def test_threaded_mark_matches_sequential(self):
+        pool = pmemobj.pool
+        self.addCleanup(setattr, pool, '_MARK_CHUNK', pool._MARK_CHUNK)
+        pool._MARK_CHUNK = 2
+        results = []
+        for threads in (1, 4):
+            pop = self._pop()
+            self._make_heap(pop)
+            results.append(pop.gc(threads=threads))
+            self.assertGCCollectedNothing(pop.gc()[1])
+            pop.close()
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1]['collections-gced'], 5)
+
+    def test_gc_refused_in_transaction(self):
+        pop = self._pop()
+        with pop.transaction():
+            pop.root = pop.new(pmemobj.PersistentList, ['x'])
+            for generation in (None, 0):
+                with self.assertRaises(RuntimeError):
+                    pop.gc(generation=generation)
+        self.assertEqual(pop.root, ['x'])
+        self.assertGCCollectedNothing(pop.gc()[1])
+
+
+class TestGenerationalGC(TestCase):
+
+    def _pop(self):
+        pop = pmemobj.create(self._test_fn())
+        self.addCleanup(pop.close)
+        pop.root = pop.new(pmemobj.PersistentList)
+        # Start with everything old.
+        pop.gc()
+        return pop
+
+    def _make_cycle(self, pop, holder):
+        with pop.transaction():
+            a = pop.new(pmemobj.PersistentList, ['only here'])
+            b = pop.new(pmemobj.PersistentList, [a])
+            a.append(b)
+            holder.append(a)
+        return a
+
+    def test_young_cycle(self):
+        pop = self._pop()
+        self._make_cycle(pop, pop.root)
+        pop.root.clear()
+        type_counts, gc_counts = pop.gc(generation=0)
+        self.assertEqual(type_counts, {'PersistentList': 2, 'str': 1})
+        self.assertEqual(gc_counts['gen0-total'], 3)
+        self.assertEqual(gc_counts['gen0-gced'], 3)
+        self.assertEqual(gc_counts['collections-gced'], 2)
+        self.assertEqual(gc_counts['other-gced'], 1)
+        _, gc_counts = pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 0)
+        self.assertEqual(gc_counts['orphans0-gced'], 0)
+
+    def test_survivors_are_promoted(self):
+        pop = self._pop()
+        self._make_cycle(pop, pop.root)
+        self.assertEqual(len(pop.mm._generations[0]), 3)
+        _, gc_counts = pop.gc(generation=0)
+        self.assertEqual(gc_counts['gen0-gced'], 0)
+        self.assertEqual([len(g) for g in pop.mm._generations], [0, 3])
+        _, gc_counts = pop.gc(generation=1)
+        self.assertEqual(gc_counts['gen0-total'], 0)
+        self.assertEqual(gc_counts['gen1-total'], 3)
+        self.assertEqual([len(g) for g in pop.mm._generations], [0, 0])
+        self.assertEqual(len(pop.root), 1)
+
+    def test_oldest_young_generation_is_capped(self):
+        pop = self._pop()
+        pool = pmemobj.pool
+        self.addCleanup(setattr, pool, 'OLDEST_YOUNG_LIMIT',
+                        pool.OLDEST_YOUNG_LIMIT)
+        pool.OLDEST_YOUNG_LIMIT = 4
+        self._make_cycle(pop, pop.root)
+        pop.gc(generation=0)
+        self.assertEqual([len(g) for g in pop.mm._generations], [0, 3])
+        self._make_cycle(pop, pop.root)
+        pop.gc(generation=0)
+        # The second cycle shares the first one's str, but five survivors
+        # are still too many, so they are all old now.
+        self.assertEqual([len(g) for g in pop.mm._generations], [0, 0])
+        pop.root.clear()
+        _, gc_counts = pop.gc(generation=1)
+        self.assertEqual(gc_counts['gen1-total'], 0)
+        _, gc_counts = pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 4)
+
+    def test_old_references_keep_young_objects(self):
+        pop = self._pop()
+        old = pop.new(pmemobj.PersistentList)
+        pop.root.append(old)
+        pop.gc()
+        self._make_cycle(pop, old)
+        _, gc_counts = pop.gc(generation=0)
+        self.assertEqual(gc_counts['gen0-gced'], 0)
+        old.clear()
+        _, gc_counts = pop.gc(generation=1)
+        self.assertEqual(gc_counts['gen1-gced'], 3)
+
+    def test_old_garbage_is_left_for_full_gc(self):
+        pop = self._pop()
+        self._make_cycle(pop, pop.root)
+        pop.gc()
+        pop.root.clear()
+        type_counts, gc_counts = pop.gc(generation=1)
+        self.assertEqual(type_counts, {})
+        self.assertEqual(gc_counts.get('collections-gced', 0), 0)
+        _, gc_counts = pop.gc()
+        self.assertEqual(gc_counts['collections-gced'], 2)
+
+    def test_aborted_allocations_are_not_young(self):
+        pop = self._pop()
+        with self.assertRaises(RuntimeError):
+            with pop.transaction():
+                pop.new(pmemobj.PersistentList, ['x'])
+                raise RuntimeError()
+        self.assertEqual([len(g) for g in pop.mm._generations], [0, 0])
+        pop.gc(generation=0)
+
+    def test_bad_generation(self):
+        pop = self._pop()
+        with self.assertRaises(ValueError):
+            pop.gc(generation=pmemobj.pool.YOUNG_GENERATIONS)
+
+
+class TestIncrementalGC(TestCase):
+
+    def _pop(self):
+        self.fn = self._test_fn()
+        pop = pmemobj.create(self.fn)
+        self.addCleanup(pop.close)
+        return pop
+
+    def _make_cycle(self, pop):
+        # Two lists that refer to each other, and a str only they refer to.
+        with pop.transaction():
+            a = pop.new(pmemobj.PersistentList, ['only here'])
+            b = pop.new(pmemobj.PersistentList, [a])
+            a.append(b)
+            pop.root.append(a)
+            pop.root.clear()
+        return a
+
+    def _collect(self, pop):
+        # With a zero budget each step does one unit of work.
+        steps = 1
+        counts = pop.gc_step(0)
+        while counts is None:
+            steps += 1
+            counts = pop.gc_step(0)
+        return steps, counts
+
+    def _step_until(self, pop, cond):
+        self.assertIsNone(pop.gc_step(0))
+        while not cond(pop.mm._collector):
+            self.assertIsNone(pop.gc_step(0))
+
+    def test_collects_cycle_in_steps(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        before, _ = pop.gc()
+        self._make_cycle(pop)
+        steps, counts = self._collect(pop)
+        self.assertGreater(steps, 10)
+        self.assertEqual(counts['collections-gced'], 2)
+        self.assertEqual(counts['orphans0-gced'], 0)
+        self.assertEqual(counts['orphans1-gced'], 0)
+        type_counts, gc_counts = pop.gc()
+        self.assertEqual(type_counts, before)
+        self.assertEqual(gc_counts['collections-gced'], 0)
+
+    def test_write_barrier(self):
+        pop = self._pop()
+        x = pop.new(pmemobj.PersistentList, ['payload'])
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [pop.new(pmemobj.PersistentList, [x])])
+        a, b = pop.root, pop.root[0]
+        # Stop when the root has been scanned but b has not.
+        self._step_until(pop, lambda c: c.phase == 'mark'
+                         and a._oid not in c._gray and b._oid in c._gray)
+        a.append(x)
+        b.clear()
+        steps, counts = self._collect(pop)
+        self.assertEqual(counts['collections-gced'], 0)
+        self.assertEqual(pop.root, [[], ['payload']])
+        self.assertEqual(pop.gc()[1]['collections-gced'], 0)
+
+    def _relink_during(self, phase, relink_cycle=True):
+        # Link garbage in again from python references to it once the
+        # collection has reached phase.
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        a = self._make_cycle(pop)
+        big = 2**70
+        pop.mm.persist(big)     # An orphan, kept in the object cache.
+        self._step_until(pop, lambda c: c.phase == phase)
+        if relink_cycle:
+            pop.root.append(a)
+        pop.root.append(big)
+        steps, counts = self._collect(pop)
+        self.assertEqual(counts['orphans0-gced'], 0)
+        self.assertEqual(pop.root[-1], big)
+        gc_counts = pop.gc()[1]
+        self.assertEqual(gc_counts['collections-gced'], 0)
+        self.assertEqual(gc_counts['orphans0-gced'], 0)
+        return pop, counts
+
+    def test_relink_while_pinning(self):
+        pop, counts = self._relink_during('pin')
+        self.assertEqual(counts['collections-gced'], 0)
+        a = pop.root[0]
+        self.assertEqual(a[0], 'only here')
+        self.assertEqual(a[1][0]._oid, a._oid)
+
+    def test_relink_while_clearing(self):
+        pop, counts = self._relink_during('clear')
+        self.assertEqual(counts['collections-gced'], 0)
+        a = pop.root[0]
+        self.assertEqual(a[0], 'only here')
+        self.assertEqual(a[1][0]._oid, a._oid)
+
+    def test_relink_while_releasing(self):
+        # Both lists have been cleared, so only the one linked in survives.
+        pop, counts = self._relink_during('release')
+        self.assertEqual(counts['collections-gced'], 1)
+        self.assertEqual(pop.root, [[], 2**70])
+
+    def test_relink_while_freeing_orphans(self):
+        pop, counts = self._relink_during('orphans', relink_cycle=False)
+        self.assertEqual(counts['collections-gced'], 2)
+        self.assertEqual(pop.root, [2**70])
+
+    def test_objects_allocated_during_collection_are_kept(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        self._make_cycle(pop)
+        pop.gc_step(0)
+        x = pop.new(pmemobj.PersistentList, ['new'])
+        steps, counts = self._collect(pop)
+        self.assertEqual(counts['collections-gced'], 2)
+        pop.root.append(x)
+        self.assertEqual(pop.root, [['new']])
+
+    def test_freeing_the_catalog_cursor(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList,
+                           [pop.new(pmemobj.PersistentList) for i in range(20)])
+        oids = [pop.mm.otuple(oid) for oid in pop.root._traverse()]
+        collector = pmemobj.pool._IncrementalGC
+        self.addCleanup(setattr, collector, '_catalog_unit',
+                        collector._catalog_unit)
+        collector._catalog_unit = 1
+        self._step_until(pop, lambda c: c._cursor in oids)
+        del pop.root[oids.index(pop.mm._collector._cursor)]
+        self._collect(pop)
+        self.assertEqual(len(pop.root), 19)
+        self.assertEqual(pop.gc()[1]['orphans0-gced'], 0)
+
+    def test_gc_step_refused_in_transaction(self):
+        pop = self._pop()
+        with pop.transaction():
+            with self.assertRaises(RuntimeError):
+                pop.gc_step()
+
+    def test_gc_thread(self):
+        pop = self._pop()
+        pop.root = pop.new(pmemobj.PersistentList)
+        self._make_cycle(pop)
+        results = []
+        gc_step = pop.gc_step
+        def record(budget_ms):
+            counts = gc_step(budget_ms)
+            if counts is not None:
+                results.append(counts)
+        pop.gc_step = record
+        pop.start_gc_thread(interval=0.001)
+        with self.assertRaises(RuntimeError):
+            pop.start_gc_thread()
+        for i in range(500):
+            with pop.lock:
+                if results:
+                    break
+            time.sleep(0.01)
+        pop.stop_gc_thread()
+        self.assertEqual(results[0]['collections-gced'], 2)
+
+
+class TestLayoutUpgrade(TestCase):
+
+    def _legacy_int(self, pop, i):
+        # Revision 0 stored ints as their repr, like strings.
+        mm = pop.mm
+        s = repr(i).rstrip('L').encode()
+        oid = mm.malloc(ffi.sizeof('PObject') + len(s) + 1)
+        ob = ffi.cast('PObject *', mm.direct(oid))
+        ob.ob_type = mm._get_type_code(int)
+        body = ffi.cast('char *', ob) + ffi.sizeof('PObject')
+        ffi.buffer(body, len(s))[:] = s
+        return oid
+
+    def _set_revision(self, pop, revision):
+        root = pop._pmem_root
+        pop.mm.snapshot_range(ffi.addressof(root, 'layout_revision'),
+                              ffi.sizeof('size_t'))
+        root.layout_revision = revision
+
+    def _close_as_revision_0(self, pop):
+        # Revision 0 stored strs as a PObject followed by NUL terminated
+        # UTF-8, which fits in the space of the current form.
+        with pop.transaction():
+            for oid, obj in pop._iter_pobjects():
+                if obj.ob_type != 1:
+                    continue
+                p_str = ffi.cast('PStrObject *', obj)
+                s = ffi.buffer(p_str.ob_sval, p_str.ob_base.ob_size)[:]
+                pop.mm.snapshot_range(obj, ffi.sizeof('PStrObject') + len(s))
+                body = ffi.cast('char *', obj) + ffi.sizeof('PObject')
+                ffi.memmove(body, s + b'\0', len(s) + 1)
+            self._set_revision(pop, 0)
+        # Skip the gc done by close, which can't read the old strs.
+        lib.pmemobj_close(pop._pool_ptr)
+        pop.closed = True
+
+    def test_new_pool_has_current_revision(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(pop._pmem_root.layout_revision,
+                         pmemobj.pool.LAYOUT_REVISION)
+
+    def test_upgrade_from_revision_0(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        values = [0, -7, 2**63, -2**100]
+        with pop.transaction():
+            d = pop.new(pmemobj.PersistentDict, {'x': None, u'ő': u'ß'})
+            lst = pop.new(pmemobj.PersistentList, values + [None, d, 'abc'])
+            shared = self._legacy_int(pop, 42)
+            for i, v in enumerate(values + [None]):
+                oid = shared if v is None else self._legacy_int(pop, v)
+                pop.mm.xdecref(lst._items[i])
+                lst._items[i] = oid
+                pop.mm.incref(oid)
+            table, i = d._lookup('x', _phash('x'))
+            table[i].me_value = shared
+            pop.mm.incref(shared)
+            pop.root = lst
+        self._close_as_revision_0(pop)
+        pop = pmemobj.open(fn)
+        self.addCleanup(pop.close)
+        self.assertEqual(pop._pmem_root.layout_revision,
+                         pmemobj.pool.LAYOUT_REVISION)
+        self.assertEqual(list(pop.root),
+                         values + [42, {'x': 42, u'ő': u'ß'}, 'abc'])
+        type_counts, gc_counts = pop.gc()
+        for k in [k for k in gc_counts.keys() if k.endswith('-gced')]:
+            self.assertEqual(gc_counts[k], 0)
+        # Only the ints too big to be inline are still objects.
+        self.assertEqual(type_counts['int'], 2)
+        # The type table still works.
+        pop.root.append(pop.new(pmemobj.PersistentDict))
+        self.assertEqual(type_counts['PersistentDict'], 1)
+
+    def test_newer_revision_is_refused(self):
+        fn = self._test_fn()
+        pop = pmemobj.create(fn)
+        with pop.transaction():
+            self._set_revision(pop, pmemobj.pool.LAYOUT_REVISION + 1)
+        pop.close()
+        with self.assertRaises(ValueError):
+            pmemobj.open(fn)
+
 
 if __name__ == '__main__':
     unittest.main()
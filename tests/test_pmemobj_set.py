@@ -0,0 +1,136 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from nvm import pmemobj
+
+from tests.support import TestCase
+
+
+class TestPersistentSet(TestCase):
+
+    def _make_set(self, *args):
+        self.fn = self._test_fn()
+        self.pop = pmemobj.create(self.fn)
+        self.addCleanup(lambda: self.pop.close())
+        self.pop.root = self.pop.new(pmemobj.PersistentSet, *args)
+        return self.pop.root
+
+    def _reread_set(self):
+        self.pop.close()
+        self.pop = pmemobj.open(self.fn)
+        return self.pop.root
+
+    def test_constructor(self):
+        s = self._make_set(['a', 'b', 'a'])
+        self.assertEqual(s, {'a', 'b'})
+        self.assertEqual(len(s), 2)
+        s = self._reread_set()
+        self.assertEqual(s, {'a', 'b'})
+        with self.assertRaises(TypeError):
+            self.pop.new(pmemobj.PersistentSet, ['a'], bogus=1)
+
+    def test_add_discard(self):
+        s = self._make_set()
+        s.add('a')
+        s.add(1)
+        s.add(1.0)
+        s.add(None)
+        self.assertEqual(len(s), 3)
+        s.discard('a')
+        s.discard('z')
+        s = self._reread_set()
+        self.assertEqual(s, {1, None})
+        s.remove(1)
+        with self.assertRaises(KeyError):
+            s.remove(1)
+        self.assertEqual(s, {None})
+
+    def test_contains(self):
+        s = self._make_set(['a', 2])
+        self.assertIn('a', s)
+        self.assertIn(2.0, s)
+        self.assertNotIn('b', s)
+        with self.assertRaises(TypeError):
+            self.pop.new(pmemobj.PersistentList) in s
+
+    def test_repr(self):
+        s = self._make_set(['a'])
+        self.assertEqual(repr(s), "PersistentSet(['a'])")
+
+    def test_update(self):
+        s = self._make_set(['a'])
+        s.update(['a', 'b'], 'cd')
+        self.assertEqual(s, set('abcd'))
+        s |= {'e'}
+        s = self._reread_set()
+        self.assertEqual(s, set('abcde'))
+
+    def test_update_grows_table(self):
+        s = self._make_set()
+        s.update(range(10))
+        s.update(range(5, 500))
+        s = self._reread_set()
+        self.assertEqual(s, set(range(500)))
+        # Mix with incremental growth from single adds.
+        for i in range(500, 600):
+            s.add(i)
+        s.update(range(600, 700))
+        self.assertEqual(s, set(range(700)))
+        self.assertEqual(self._reread_set(), set(range(700)))
+
+    def test_update_snapshots_table_once(self):
+        s = self._make_set(range(100))
+        entries = []
+        orig = self.pop.mm.snapshot_range
+        def snapshot_range(ptr, size):
+            entries.append(size)
+            return orig(ptr, size)
+        self.pop.mm.snapshot_range = snapshot_range
+        s.update(range(100, 150))
+        del self.pop.mm.snapshot_range
+        entry_size = s._entry_size()
+        self.assertEqual(len([n for n in entries if n >= entry_size]), 1)
+        self.assertEqual(s, set(range(150)))
+
+    def test_difference_update(self):
+        s = self._make_set(range(100))
+        s.difference_update(range(0, 100, 2), [1, 3, 'x'])
+        s -= {5}
+        expected = set(range(7, 100, 2))
+        self.assertEqual(s, expected)
+        s = self._reread_set()
+        self.assertEqual(s, expected)
+        self.assertEqual(len(s), len(expected))
+        s -= s
+        self.assertEqual(len(s), 0)
+
+    def test_operators_return_set(self):
+        s = self._make_set('abc')
+        self.assertEqual(s | {'d'}, set('abcd'))
+        self.assertEqual(s & {'a', 'z'}, {'a'})
+        self.assertEqual(s - {'a'}, {'b', 'c'})
+        self.assertIsInstance(s ^ {'a'}, set)
+        self.assertTrue(s.isdisjoint('xyz'))
+
+    def test_clear_and_pop(self):
+        s = self._make_set('ab')
+        x = s.pop()
+        self.assertIn(x, 'ab')
+        self.assertEqual(len(s), 1)
+        s.clear()
+        self.assertEqual(len(s), 0)
+        s.add('c')
+        self.assertEqual(self._reread_set(), {'c'})
+
+    def test_gc_frees_removed_keys(self):
+        s = self._make_set(['a', 'b'])
+        before, _ = self.pop.gc()
+        self.assertEqual(before['PersistentSet'], 1)
+        s.difference_update(['a', 'b'])
+        type_counts, gc_counts = self.pop.gc()
+        self.assertEqual(type_counts['str'], before['str'] - 2)
+        self.assertEqual(gc_counts['collections-gced'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()